@@ -0,0 +1,211 @@
+"""Inter-annotator agreement for images that were annotated more than once.
+
+An overlap is a near-duplicate cluster whose members have masks (the same
+inscription exported under different names and annotated by different
+people, see notes.txt) or an image with several mask files (e.g. both a
+_mask.png and a _mask.jpg). Every pair of masks in an overlap is compared
+by IoU, Dice and boundary F-score. Results are cached in the state store
+with both masks' mtime and size, so only pairs with a changed mask are
+recomputed. Run directly to refresh and print the table:
+
+    python agreement.py ./images_train/ --db annotation_state.db
+"""
+import os
+import time
+import argparse
+import threading
+from itertools import combinations
+from concurrent.futures import ProcessPoolExecutor
+
+from lazy_imports import cv2, np
+from mask_kernels import read_binary_mask
+from storage_layout import as_layout, add_layout_arguments, layout_from_args
+
+# Masks are compared on a grid with this long side; boundaries match within BOUNDARY_TOLERANCE grid pixels
+AGREEMENT_MAX_DIM = 512
+BOUNDARY_TOLERANCE = 2
+MASK_EXTENSIONS = ('png', 'jpg', 'jpeg', 'bmp', 'gif')
+
+_POPCOUNT_TABLE = [bin(i).count('1') for i in range(256)]
+
+
+def _popcount(packed):
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(packed).sum(dtype=np.int64))
+    return int(np.asarray(_POPCOUNT_TABLE, dtype=np.uint8)[packed].sum(dtype=np.int64))
+
+
+def pack_mask(binary, grid, tolerance=BOUNDARY_TOLERANCE):
+    """Downsamples a 0/255 mask to grid (width, height) and returns the bit-packed
+    (foreground, boundary, boundary dilated by tolerance) rows."""
+    small = cv2.resize(binary, grid, interpolation=cv2.INTER_AREA)
+    cv2.threshold(small, 127, 255, cv2.THRESH_BINARY, dst=small)
+    boundary = cv2.subtract(small, cv2.erode(small, np.ones((3, 3), np.uint8)))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * tolerance + 1, 2 * tolerance + 1))
+    near_boundary = cv2.dilate(boundary, kernel)
+    return tuple(np.packbits(img > 0) for img in (small, boundary, near_boundary))
+
+
+def compare_packed(a, b):
+    """IoU, Dice and boundary precision/recall/F-score of two pack_mask() results."""
+    fg_a, boundary_a, near_a = a
+    fg_b, boundary_b, near_b = b
+    area_a, area_b = _popcount(fg_a), _popcount(fg_b)
+    intersection = _popcount(fg_a & fg_b)
+    union = area_a + area_b - intersection
+    edges_a, edges_b = _popcount(boundary_a), _popcount(boundary_b)
+    # Two empty masks agree perfectly
+    precision = _popcount(boundary_a & near_b) / edges_a if edges_a else float(edges_b == 0)
+    recall = _popcount(boundary_b & near_a) / edges_b if edges_b else float(edges_a == 0)
+    return {
+        "iou": intersection / union if union else 1.0,
+        "dice": 2 * intersection / (area_a + area_b) if area_a + area_b else 1.0,
+        "boundary_precision": precision,
+        "boundary_recall": recall,
+        "boundary_f": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+    }
+
+
+def compare_mask_files(path_a, path_b, max_dim=AGREEMENT_MAX_DIM, tolerance=BOUNDARY_TOLERANCE):
+    """Returns (metrics, error_msg) for two mask files. Both are resampled to the
+    grid of the first one, so near-duplicates of different resolution compare."""
+    binary_a = read_binary_mask(path_a)
+    binary_b = read_binary_mask(path_b)
+    if binary_a is None or binary_b is None:
+        return None, f"Could not read mask {os.path.basename(path_a if binary_a is None else path_b)}."
+    height, width = binary_a.shape[:2]
+    scale = min(1.0, max_dim / float(max(width, height)))
+    grid = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return compare_packed(pack_mask(binary_a, grid, tolerance), pack_mask(binary_b, grid, tolerance)), None
+
+
+def _pair_job(args):
+    mask_a, mask_b, path_a, path_b, max_dim, tolerance = args
+    metrics, error_msg = compare_mask_files(path_a, path_b, max_dim, tolerance)
+    return mask_a, mask_b, metrics, error_msg
+
+
+def find_mask_files(layout, extensions=MASK_EXTENSIONS):
+    """{base: {mask filename: (mtime, size)}} from a single pass over the annotation files."""
+    suffixes = tuple(f"_mask.{ext}" for ext in extensions)
+    masks = {}
+    for entry in as_layout(layout).iter_annotations():
+        if not entry.name.endswith(suffixes):
+            continue
+        try:
+            st = entry.stat()
+        except OSError:
+            continue
+        base = entry.name[:entry.name.rindex('_mask.')]
+        masks.setdefault(base, {})[entry.name] = (st.st_mtime, st.st_size)
+    return masks
+
+
+def overlap_pairs(mask_files, clusters):
+    """Sorted (mask_a, mask_b) pairs to compare: all pairs of masks within each
+    near-duplicate cluster of originals, and within each base with several masks."""
+    pairs = set()
+    grouped = set()
+    for cluster in clusters:
+        bases = [os.path.splitext(filename)[0] for filename in cluster]
+        grouped.update(bases)
+        masks = sorted(m for base in bases for m in mask_files.get(base, ()))
+        pairs.update(combinations(masks, 2))
+    for base, masks in mask_files.items():
+        if base not in grouped:
+            pairs.update(combinations(sorted(masks), 2))
+    return sorted(pairs)
+
+
+class AgreementEngine:
+    """Keeps the state store's agreement table in step with the masks on disk."""
+
+    def __init__(self, store, layout, max_workers=None, max_dim=AGREEMENT_MAX_DIM,
+                 tolerance=BOUNDARY_TOLERANCE):
+        self.store = store
+        self.layout = as_layout(layout)
+        self.max_workers = max_workers
+        self.max_dim = max_dim
+        self.tolerance = tolerance
+        self._refresh_lock = threading.Lock()
+        self.last_refresh = None # {"finished": ..., "computed": ..., "cached": ..., "failed": ...}
+
+    def refresh(self, clusters):
+        """Compares every overlap pair whose masks changed since it was last compared
+        (in a process pool) and drops pairs that no longer exist. Returns a summary."""
+        with self._refresh_lock:
+            mask_files = find_mask_files(self.layout)
+            versions = {name: version for masks in mask_files.values() for name, version in masks.items()}
+            pairs = overlap_pairs(mask_files, clusters)
+            cached = self.store.agreement_versions()
+            todo = [(a, b) for a, b in pairs
+                    if cached.get((a, b)) != (versions[a] + versions[b] + (self.max_dim, self.tolerance))]
+            self.store.prune_agreement(pairs)
+
+            failed = 0
+            if todo:
+                print(f"Comparing {len(todo)} of {len(pairs)} overlapping mask pairs...")
+                jobs = [(a, b, self.layout.annotation_path(a), self.layout.annotation_path(b),
+                         self.max_dim, self.tolerance) for a, b in todo]
+                results = []
+                with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                    for mask_a, mask_b, metrics, error_msg in pool.map(_pair_job, jobs, chunksize=4):
+                        if error_msg:
+                            failed += 1
+                            print(f"  {mask_a} vs {mask_b}: {error_msg}")
+                        results.append((mask_a, mask_b, versions[mask_a], versions[mask_b], metrics, error_msg))
+                self.store.save_agreement(results, self.max_dim, self.tolerance)
+            self.last_refresh = {"finished": time.time(), "pairs": len(pairs), "computed": len(todo) - failed,
+                                 "cached": len(pairs) - len(todo), "failed": failed}
+            return self.last_refresh
+
+    @property
+    def refreshing(self):
+        return self._refresh_lock.locked()
+
+    def refresh_in_background(self, get_clusters):
+        """Starts refresh(get_clusters()) in a thread unless one is already running."""
+        if self.refreshing:
+            return False
+
+        def run():
+            try:
+                self.refresh(get_clusters())
+            except Exception as e:
+                print(f"Agreement refresh failed: {e}")
+
+        threading.Thread(target=run, name='agreement-refresh', daemon=True).start()
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_layout_arguments(parser, positional=True)
+    parser.add_argument('--db', default='annotation_state.db')
+    parser.add_argument('--index-file', default='image_hashes.json')
+    parser.add_argument('--max-distance', type=int, default=10, help='Near-duplicate threshold, bits out of 64')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    from state_store import StateStore
+    from dedup_index import NearDuplicateIndex
+    layout = layout_from_args(args)
+    filenames = sorted(entry.name for entry in layout.iter_originals())
+    index = NearDuplicateIndex(args.index_file, layout, args.max_distance, args.workers)
+    index.update(filenames)
+
+    store = StateStore(args.db)
+    engine = AgreementEngine(store, layout, max_workers=args.workers)
+    summary = engine.refresh([c for c in index.clusters(filenames) if len(c) > 1])
+    print(f"{summary['pairs']} pairs: {summary['computed']} computed, {summary['cached']} cached, "
+          f"{summary['failed']} failed.")
+    for row in store.agreement_report():
+        if row['error']:
+            print(f"  {row['mask_a']} vs {row['mask_b']}: {row['error']}")
+            continue
+        print(f"  IoU {row['iou']:.3f}  Dice {row['dice']:.3f}  BF {row['boundary_f']:.3f}  "
+              f"{row['mask_a']} ({row['annotator_a'] or '-'}) vs {row['mask_b']} ({row['annotator_b'] or '-'})")
+
+
+if __name__ == '__main__':
+    main()
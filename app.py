@@ -3,6 +3,7 @@ import random
 import json
 from flask import Flask, render_template, request, redirect, url_for, send_from_directory, flash
 from werkzeug.utils import secure_filename
+from assignment_engine import plan_rebalance, report_changed, format_report
 
 # --- Configuration ---
 # IMPORTANT: Change this to your actual image directory
@@ -22,6 +23,7 @@ ANNOTATOR_QUOTAS = {
     "Aarnav": 48
 }
 ASSIGNMENTS_FILE = 'assignments.json'
+QUOTAS_FILE = 'assignment_quotas.json' # The quotas ASSIGNMENTS_FILE was last saved with
 
 app = Flask(__name__)
 app.secret_key = 'your_very_secret_key_here' # Important for flashing messages
@@ -43,6 +45,25 @@ def get_image_files(directory):
             images.append(f)
     return images
 
+def annotation_started(filename):
+    base = os.path.join(IMAGES_BASE_DIR, os.path.splitext(filename)[0])
+    return os.path.exists(base + '.xcf') or \
+           any(os.path.exists(base + "_mask." + ext) for ext in ALLOWED_MASK_EXTENSIONS)
+
+def load_saved_quotas():
+    """Quotas the assignments were last saved with; None (nothing counts as reduced) if unknown."""
+    try:
+        with open(QUOTAS_FILE, 'r') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, IOError):
+        return None
+
+def save_assignments_file(assignments):
+    with open(ASSIGNMENTS_FILE, 'w') as f:
+        json.dump(assignments, f, indent=4)
+    with open(QUOTAS_FILE, 'w') as f:
+        json.dump(ANNOTATOR_QUOTAS, f, indent=4)
+
 def assign_images():
     """Assigns images to annotators or loads existing assignments."""
     if os.path.exists(ASSIGNMENTS_FILE):
@@ -50,16 +71,16 @@ def assign_images():
             with open(ASSIGNMENTS_FILE, 'r') as f:
                 assignments = json.load(f)
             print("Loaded existing image assignments.")
-            # Verify that assigned files still exist
-            all_assigned_files = set()
-            for annotator_files in assignments.values():
-                all_assigned_files.update(annotator_files)
-
-            current_files = set(get_image_files(IMAGES_BASE_DIR))
-            if not all_assigned_files.issubset(current_files):
-                print("Warning: Some assigned files are missing. Re-assigning...")
-                return create_new_assignments()
-            return assignments
+            # Keep everything still valid and only redistribute the delta
+            # (removed/added files, annotator list or quota changes)
+            new_assignments, report = plan_rebalance(assignments, get_image_files(IMAGES_BASE_DIR),
+                                                     ANNOTATOR_QUOTAS, is_started=annotation_started,
+                                                     previous_quotas=load_saved_quotas())
+            if report_changed(report) or load_saved_quotas() != ANNOTATOR_QUOTAS:
+                print("Rebalancing assignments:")
+                print(format_report(report))
+                save_assignments_file(new_assignments)
+            return new_assignments
         except (json.JSONDecodeError, IOError) as e:
             print(f"Error loading assignments file ({e}), creating new assignments.")
             return create_new_assignments()
@@ -94,8 +115,7 @@ def create_new_assignments():
 
     # Save assignments
     try:
-        with open(ASSIGNMENTS_FILE, 'w') as f:
-            json.dump(assignments, f, indent=4)
+        save_assignments_file(assignments)
         print(f"Saved new assignments to {ASSIGNMENTS_FILE}")
     except IOError as e:
         print(f"Error saving assignments: {e}")
@@ -1,17 +1,51 @@
 import os
 import random
 import json
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, flash, Response
+from flask import Flask, render_template, request, redirect, url_for, flash, Response, jsonify, g
 from werkzeug.utils import secure_filename
-import cv2 # Added
-import numpy as np # Added
 import io # Added
+import gzip
+import time
+import threading
+from lazy_imports import cv2, np # Imported on first use, not at start-up
+from derived_cache import DerivedImageCache
+from image_pyramid import (negotiate_format, get_pyramid_level, lookup_pyramid_level, pyramid_key,
+                           preview_mimetype, render_thumbnail, has_cheap_reduced_decode)
+from status_index import AnnotationStatusIndex
+from chunked_upload import ChunkedUploadManager
+from bulk_upload import ingest_archive, MEMBER_STATUSES, ACCEPTED
+from zip_stream import stream_zip
+from image_processing import encode_cv_image, load_image, load_binary_mask, load_overlay, render_png, render_packed_mask
+from postprocess import PostProcessingPipeline, precompute_mask_outputs
+from render_guard import RenderGuard, ServerBusy
+from dedup_index import NearDuplicateIndex
+from assignment_engine import plan_rebalance, lazy_cluster_key, report_changed, format_report
+from state_store import StateStore, STATUS_FILTERS, QC_SORT_COLUMNS
+from file_serving import FileServer, file_version
+from replication import Replicator
+from blob_store import BlobStore, RevisionStore
+from mask_kernels import OVERLAY_ALPHA, OVERLAY_COLOR_BGR
+from mask_qc import FLAGS as QC_FLAGS
+from agreement import AgreementEngine
+from storage_layout import StorageLayout
+import metrics
+from metrics import stage
+from request_metrics import instrument_app
 
 # --- Configuration ---
 # IMAGES_BASE_DIR = '/ssd_scratch/pratyush.jena/Aug_LineTR/GA_unified_v2/GA_unified_v2_Train/images_train'
 # IMAGES_BASE_DIR = './sample_images' # For local testing
 IMAGES_BASE_DIR = './images_train/'
 
+# Storage layout (see storage_layout.py). XCF / mask files go to ANNOTATIONS_DIR (None = next to
+# the originals in IMAGES_BASE_DIR); originals missing from IMAGES_BASE_DIR are looked up in
+# ORIGINAL_SOURCE_DIRS, in order, which are only ever read. With STORAGE_SHARD_LEVELS > 0 every
+# root is split into hash-prefixed subdirectories (1: 256, 2: 65536); convert a flat directory
+# with `python storage_layout.py`.
+ANNOTATIONS_DIR = None
+ORIGINAL_SOURCE_DIRS = []
+STORAGE_SHARD_LEVELS = 0
+
 ALLOWED_XCF_EXTENSIONS = {'xcf'}
 ALLOWED_MASK_EXTENSIONS = {'png'}
 
@@ -23,93 +57,221 @@ ANNOTATOR_QUOTAS = {
     "Abhinav": 50,
     "Arnav": 50
 }
-ASSIGNMENTS_FILE = 'assignments.json'
+ASSIGNMENTS_FILE = 'assignments.json' # Only read once, to migrate into STATE_DB_FILE
+
+# Assignments, annotation status and the upload log (SQLite, WAL mode; safe with several workers).
+# Edits to the quotas above are rebalanced incrementally at startup; preview with assignment_engine.py
+STATE_DB_FILE = 'annotation_state.db'
+
+# Perceptual hashes used to keep near-duplicate images (re-scans) on one annotator
+NEAR_DUPLICATE_INDEX_FILE = 'image_hashes.json'
+NEAR_DUPLICATE_MAX_DISTANCE = 10 # Differing bits out of 64
+NEAR_DUPLICATE_HASH_WORKERS = None # None = one process per CPU
+NEAR_DUPLICATE_MAX_QUOTA_OVERFLOW = 5 # Beyond this many images over a quota, a cluster is split after all
+
+# Rendered binary masks / overlays are cached in memory (LRU, bounded) and on disk
+DERIVED_CACHE_DIR = './derived_cache/'
+DERIVED_CACHE_MEMORY_BYTES = 512 * 1024 * 1024
+
+# /view/* routes serve downscaled previews unless ?full=1 is given
+DEFAULT_PREVIEW_MAX_DIM = 1024
+PREVIEW_MIN_DIM = 256 # Smallest pyramid level
+PREVIEW_TOP_DIM = 2048 # Largest pyramid level; bigger max_dim requests get this one (full size: ?full=1)
+
+# How often the in-memory annotation status index is reconciled with the directory
+STATUS_RECONCILE_SECONDS = 300
+
+# Unfinished chunked uploads are discarded after this long
+CHUNKED_UPLOAD_EXPIRY_SECONDS = 2 * 24 * 3600
+
+# Background rendering of binary mask / overlay / previews after a mask upload
+POSTPROCESS_WORKERS = None # None = one process per CPU
+POSTPROCESS_MAX_QUEUED = 64
+POSTPROCESS_MAX_RETRIES = 2
+POSTPROCESS_PREVIEW_FORMATS = ('webp', 'jpeg')
+
+# Uploaded masks are replaced by a 1-bit PNG at the original's size once QC has seen them; the
+# upload itself stays in the blob store as the previous revision (MASK_ARCHIVE_DIR keeps another
+# copy, None = not). Convert existing masks with mask_ingest.py
+CANONICAL_MASKS = True
+MASK_ARCHIVE_DIR = None
+
+# Every version of an XCF / mask is kept here once, named by its SHA-256; the files in
+# ANNOTATIONS_DIR are hard links to the current version. Should be on the same filesystem.
+BLOB_STORE_DIR = './blob_store/'
+
+# Bulk upload (/upload/<annotator>/bulk): a ZIP or tar of <image>.xcf / <image>_mask.png files.
+# BULK_UPLOAD_WORKERS threads store members while the next ones are read from the archive; at
+# most BULK_UPLOAD_MAX_PENDING are buffered, in memory up to BULK_UPLOAD_SPOOL_BYTES each.
+BULK_UPLOAD_WORKERS = 4
+BULK_UPLOAD_MAX_PENDING = 8
+BULK_UPLOAD_SPOOL_BYTES = 16 * 1024 * 1024
+BULK_UPLOAD_MAX_MEMBER_BYTES = 4 * 1024 * 1024 * 1024
+
+# In-request rendering limits: identical renders are coalesced, at most
+# RENDER_MAX_CONCURRENT run at once and RENDER_MAX_WAITING wait; beyond that -> 503
+RENDER_MAX_CONCURRENT = 2
+RENDER_MAX_WAITING = 8
+RENDER_WAIT_TIMEOUT_SECONDS = 60
+RENDER_RETRY_AFTER_SECONDS = 5
+
+# Every saved upload is copied to this mirror (e.g. the NAS) by a background worker within
+# seconds; pending copies are journaled and resumed after a restart. None disables it.
+# REPLICATION_MIRROR_DIR = '/nas/pratyush.jena/Aug_LineTR/annotation_tool/images_train/'
+REPLICATION_MIRROR_DIR = None
+REPLICATION_MAX_ATTEMPTS = 5
+REPLICATION_RETRY_SECONDS = 30
+
+# Annotator page: rows per page (further pages load as the user scrolls) and thumbnail size.
+# Previews up to THUMBNAIL_MAX_DIM come from a reduced decode and take no render slot.
+ANNOTATOR_PAGE_SIZE = 50
+ANNOTATOR_MAX_PAGE_SIZE = 500
+THUMBNAIL_MAX_DIM = 96
+
+# Live progress: completions/hour are averaged over the last PROGRESS_RATE_WINDOW_SECONDS;
+# /progress/stream checks the store for changes every PROGRESS_STREAM_POLL_SECONDS
+PROGRESS_RATE_WINDOW_SECONDS = 24 * 3600
+PROGRESS_STREAM_POLL_SECONDS = 1
+PROGRESS_STREAM_MAX_SECONDS = 600 # Browsers reconnect EventSource streams on their own
+
+# Originals and masks: 'x-sendfile' (Apache/lighttpd) or 'x-accel' (nginx) hands the transfer
+# to the front-end server; None streams from Flask. For nginx, FILE_OFFLOAD_ACCEL_PREFIX must be
+# an `internal` location aliasing IMAGES_BASE_DIR; ANNOTATIONS_DIR and ORIGINAL_SOURCE_DIRS need
+# one each, in FILE_OFFLOAD_EXTRA_ACCEL_PREFIXES ({directory: prefix}).
+FILE_OFFLOAD_MODE = None
+FILE_OFFLOAD_ACCEL_PREFIX = '/protected-images/'
+FILE_OFFLOAD_EXTRA_ACCEL_PREFIXES = {}
+VERSIONED_FILE_MAX_AGE_SECONDS = 365 * 24 * 3600 # For ?v=<version> URLs, which never change content
+BLOB_OFFLOAD_ACCEL_PREFIX = '/protected-blobs/' # nginx `internal` location aliasing BLOB_STORE_DIR
+
+# Mask QC report (/qc): rows per page. Masks skipped by a full post-processing queue get
+# their QC from `python mask_qc.py`.
+QC_REPORT_PAGE_SIZE = 100
+
+# Inter-annotator agreement (/agreement) between masks of near-duplicate images
+AGREEMENT_WORKERS = None # None = one process per CPU
+
+# Profiling: this fraction of requests runs under PROFILER ('cprofile' or 'pyinstrument');
+# profiles of those taking over PROFILE_SLOW_SECONDS are written to PROFILE_DIR. 0 = off.
+# Latency / stage / byte metrics are always on, at /metrics.
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_SLOW_SECONDS = 1.0
+PROFILE_DIR = './profiles/'
+PROFILER = 'cprofile'
 
 app = Flask(__name__)
 app.secret_key = 'your_very_secret_key_here_CHANGE_ME'
-app.config['UPLOAD_FOLDER'] = IMAGES_BASE_DIR
+instrument_app(app, PROFILE_SAMPLE_RATE, PROFILE_SLOW_SECONDS, PROFILE_DIR, PROFILER)
+
+storage = StorageLayout([IMAGES_BASE_DIR] + ORIGINAL_SOURCE_DIRS, ANNOTATIONS_DIR, STORAGE_SHARD_LEVELS)
+app.config['UPLOAD_FOLDER'] = storage.annotation_root
+state_store = StateStore(STATE_DB_FILE)
+file_servers = [FileServer(root, FILE_OFFLOAD_MODE,
+                           FILE_OFFLOAD_EXTRA_ACCEL_PREFIXES.get(root, FILE_OFFLOAD_ACCEL_PREFIX),
+                           VERSIONED_FILE_MAX_AGE_SECONDS)
+                for root in storage.roots]
+blob_file_server = FileServer(BLOB_STORE_DIR, FILE_OFFLOAD_MODE, BLOB_OFFLOAD_ACCEL_PREFIX,
+                              VERSIONED_FILE_MAX_AGE_SECONDS)
+revision_store = RevisionStore(state_store, BlobStore(BLOB_STORE_DIR), storage)
+derived_cache = DerivedImageCache(DERIVED_CACHE_DIR, DERIVED_CACHE_MEMORY_BYTES)
+render_guard = RenderGuard(RENDER_MAX_CONCURRENT, RENDER_MAX_WAITING,
+                           RENDER_WAIT_TIMEOUT_SECONDS, RENDER_RETRY_AFTER_SECONDS)
+near_duplicates = NearDuplicateIndex(NEAR_DUPLICATE_INDEX_FILE, storage,
+                                     NEAR_DUPLICATE_MAX_DISTANCE, NEAR_DUPLICATE_HASH_WORKERS)
+agreement_engine = AgreementEngine(state_store, storage, max_workers=AGREEMENT_WORKERS)
 
 # --- Helper Functions ---
 def allowed_file(filename, allowed_extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
-def get_image_files(directory):
-    images = []
-    valid_image_extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff'}
-    if not os.path.isdir(directory):
-        print(f"Error: Image directory '{directory}' not found.")
+def get_image_files():
+    # One scandir pass per (shard) directory: the entry type comes with the listing,
+    # so regular files are recognised without a stat() per file
+    try:
+        return [entry.name for entry in storage.iter_originals()]
+    except (FileNotFoundError, NotADirectoryError) as e:
+        print(f"Error: Image directory '{e.filename}' not found.")
         return []
-    for f in os.listdir(directory):
-        if os.path.isfile(os.path.join(directory, f)) and os.path.splitext(f)[1].lower() in valid_image_extensions:
-            # check if _mask is not in the filename
-            if '_mask' not in f and not f.startswith('.'):
-                images.append(f)
-    return images
+
+def file_server_for(path):
+    """The FileServer of the root path lies in (they differ in their x-accel prefix)."""
+    path = os.path.abspath(path)
+    for server in file_servers:
+        if path.startswith(os.path.join(os.path.abspath(server.root), '')):
+            return server
+    return file_servers[0]
 
 def assign_images():
-    if os.path.exists(ASSIGNMENTS_FILE):
-        try:
-            with open(ASSIGNMENTS_FILE, 'r') as f:
-                assignments = json.load(f)
-            print("Loaded existing image assignments.")
-            all_assigned_files = set()
-            for annotator_files in assignments.values(): # assignments keys are annotator names
-                all_assigned_files.update(annotator_files)
-            current_files = set(get_image_files(IMAGES_BASE_DIR))
-            if not all_assigned_files.issubset(current_files):
-                print("Warning: Some assigned files are missing or annotator list changed. Re-assigning...")
-                return create_new_assignments()
-            # Check if annotator keys match
-            if set(assignments.keys()) != set(ANNOTATOR_QUOTAS.keys()):
-                print("Warning: Annotator list in assignments.json differs from ANNOTATOR_QUOTAS. Re-assigning...")
-                return create_new_assignments()
-            return assignments
-        except (json.JSONDecodeError, IOError, KeyError) as e:
-            print(f"Error loading assignments file ({e}), creating new assignments.")
-            return create_new_assignments()
-    else:
+    migrated = state_store.migrate_from_json(ASSIGNMENTS_FILE, ANNOTATOR_QUOTAS)
+    assignments = state_store.load_assignments()
+    if not any(assignments.values()):
         return create_new_assignments()
-
-# --- Helper function to calculate stats (can be inside app.py or imported) ---
-def get_annotator_stats(annotator_name, assigned_images):
-    completed_count = 0
-    partial_xcf_count = 0 # Only XCF uploaded
-    partial_mask_count = 0 # Only Mask uploaded
-    pending_count = 0
-    total_assigned = len(assigned_images)
-
-    for filename in assigned_images:
-        base, _ = os.path.splitext(filename)
-        xcf_exists = os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], base + ".xcf"))
-        mask_file_path = find_mask_file_path(app.config['UPLOAD_FOLDER'], base) # Uses existing helper
-        mask_exists = mask_file_path is not None
-
-        if xcf_exists and mask_exists:
-            completed_count += 1
-        elif xcf_exists and not mask_exists:
-            partial_xcf_count += 1
-        elif not xcf_exists and mask_exists:
-            partial_mask_count += 1
-        else: # Neither exists
-            pending_count += 1
-    
-    return {
-        "total": total_assigned,
-        "completed": completed_count,
-        "partial_xcf": partial_xcf_count,
-        "partial_mask": partial_mask_count,
-        "pending": pending_count
-    }
+    if migrated:
+        # Moving to the state store must not change anyone's worklist: no rebalancing on this run
+        state_store.sync_images(get_image_files())
+        print("Loaded migrated image assignments unchanged; new images are placed at the next start.")
+        return assignments
+    print("Loaded existing image assignments.")
+    # Keep everything still valid and only redistribute the delta
+    # (removed/added files, annotator list or quota changes)
+    return rebalance_assignments(assignments)
+
+def rebalance_assignments(assignments, dry_run=False):
+    """Applies plan_rebalance() to the current image directory. With dry_run the
+    plan is only reported; returns the (would-be) assignments either way."""
+    current_files = get_image_files()
+    # Files already there at the last rebalance and still unassigned were left over for lack
+    # of capacity; they are only looked at again if capacity remains after the new ones
+    known_files = state_store.known_images()
+    if not dry_run:
+        state_store.sync_images(current_files)
+
+    def is_started(filename):
+        return any(status_index.status(os.path.splitext(filename)[0]))
+
+    # Only hashed when something actually needs placing
+    cluster_key = lazy_cluster_key(near_duplicates, current_files)
+
+    while True:
+        version = state_store.assignments_version()
+        new_assignments, report = plan_rebalance(assignments, current_files, ANNOTATOR_QUOTAS,
+                                                 is_started=is_started, cluster_key=cluster_key,
+                                                 previous_quotas=state_store.quotas(), known_files=known_files,
+                                                 max_cluster_overflow=NEAR_DUPLICATE_MAX_QUOTA_OVERFLOW)
+        if not report_changed(report) and list(state_store.quotas().items()) == list(ANNOTATOR_QUOTAS.items()):
+            return new_assignments
+        print("Rebalancing assignments:" + (" (dry run)" if dry_run else ""))
+        print(format_report(report))
+        if dry_run or save_assignments(new_assignments, expected_version=version):
+            return new_assignments
+        # Another worker process rebalanced first: plan again on top of its result
+        assignments = state_store.load_assignments()
+
+def save_assignments(assignments, expected_version=None):
+    if state_store.replace_assignments(assignments, ANNOTATOR_QUOTAS, expected_version):
+        print(f"Saved assignments to {STATE_DB_FILE}")
+        return True
+    return False
 
 def create_new_assignments():
     print("Creating new image assignments...")
-    all_images = get_image_files(IMAGES_BASE_DIR)
+    all_images = get_image_files()
     if not all_images:
         print("No images found to assign.")
         return {annotator_name: [] for annotator_name in ANNOTATOR_QUOTAS.keys()}
 
+    # Near-duplicates (re-scans of the same inscription) are shuffled as one unit
+    # and kept contiguous, so a whole cluster always lands on a single annotator
+    state_store.sync_images(all_images)
+    near_duplicates.update(all_images)
+    clusters = near_duplicates.clusters(sorted(all_images))
     random.seed(42)
-    random.shuffle(all_images)
+    random.shuffle(clusters)
+    all_images = [filename for cluster in clusters for filename in cluster]
+    cluster_of = {filename: i for i, cluster in enumerate(clusters) for filename in cluster}
+    if len(clusters) < len(all_images):
+        print(f"Found {len(all_images) - len(clusters)} near-duplicate images in {sum(len(c) > 1 for c in clusters)} clusters.")
+
     assignments = {}
     current_index = 0
     total_quota = sum(ANNOTATOR_QUOTAS.values())
@@ -119,6 +281,13 @@ def create_new_assignments():
 
     for annotator_name, quota in ANNOTATOR_QUOTAS.items():
         num_to_assign = min(quota, len(all_images) - current_index)
+        end = current_index + num_to_assign
+        # Don't split a cluster across annotators (may exceed the quota by a few images, but
+        # by no more than NEAR_DUPLICATE_MAX_QUOTA_OVERFLOW, so one huge cluster cannot take a whole round)
+        while 0 < end < len(all_images) and end - current_index < quota + NEAR_DUPLICATE_MAX_QUOTA_OVERFLOW \
+              and cluster_of[all_images[end]] == cluster_of[all_images[end - 1]]:
+            end += 1
+        num_to_assign = end - current_index
         assignments[annotator_name] = all_images[current_index : current_index + num_to_assign]
         current_index += num_to_assign
         if current_index >= len(all_images) and list(ANNOTATOR_QUOTAS.keys()).index(annotator_name) < len(ANNOTATOR_QUOTAS) -1:
@@ -126,22 +295,100 @@ def create_new_assignments():
                 assignments[remaining_annotator_id] = []
 
 
-    try:
-        with open(ASSIGNMENTS_FILE, 'w') as f:
-            json.dump(assignments, f, indent=4)
-        print(f"Saved new assignments to {ASSIGNMENTS_FILE}")
-    except IOError as e:
-        print(f"Error saving assignments: {e}")
+    save_assignments(assignments)
     return assignments
 
-IMAGE_ASSIGNMENTS = assign_images()
-
-def find_mask_file_path(base_dir, original_filename_base):
+status_index = AnnotationStatusIndex(storage, ALLOWED_MASK_EXTENSIONS, store=state_store)
+chunked_uploads = ChunkedUploadManager(storage.annotation_root, CHUNKED_UPLOAD_EXPIRY_SECONDS)
+
+# --- Start-up warm-up ---
+# Scanning the image directories (slow on the NAS) runs in a background thread, so the
+# server accepts connections right away. Until it is done, requests are answered
+# from the assignments the state store kept from the previous run; /ready tells
+# load balancers and scripts when the warm-up has finished.
+startup = {"started": time.time(), "finished": None, "ready": False, "error": None, "steps": {}}
+startup_done = threading.Event()
+
+def validate_image_dir():
+    for directory in storage.roots:
+        if not os.path.isdir(directory):
+            raise RuntimeError(f"Image directory '{directory}' not found.")
+
+def warm_up():
+    # The status index comes before assignments so rebalancing can tell which
+    # images are already being worked on
+    steps = (('validate_image_dir', validate_image_dir),
+             ('status_index', status_index.rebuild),
+             ('assignments', assign_images),
+             ('chunked_uploads', chunked_uploads.purge_expired))
+    try:
+        for name, step in steps:
+            start = time.time()
+            step()
+            startup['steps'][name] = round(time.time() - start, 3)
+        status_index.start_reconciler(STATUS_RECONCILE_SECONDS)
+        startup['ready'] = True
+        print(f"Warm-up finished in {time.time() - startup['started']:.2f}s: {startup['steps']}")
+    except Exception as e:
+        startup['error'] = str(e)
+        print(f"Warm-up failed: {e}")
+    finally:
+        startup['finished'] = time.time()
+        startup_done.set()
+
+threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+replicator = None
+if REPLICATION_MIRROR_DIR:
+    replicator = Replicator(state_store, storage.annotation_root, REPLICATION_MIRROR_DIR,
+                            max_attempts=REPLICATION_MAX_ATTEMPTS, retry_seconds=REPLICATION_RETRY_SECONDS)
+    replicator.start()
+
+def record_upload(annotator_name, filename, kind, size, mode, seconds=None):
+    """Logs a saved upload in the state store and its size and rate in the metrics.
+    seconds defaults to the time the current request has taken (body receipt included)."""
+    state_store.record_upload(annotator_name, filename, kind, size, mode)
+    if seconds is None:
+        seconds = time.perf_counter() - g.metrics_start
+    metrics.observe_upload(kind, mode, size, seconds)
+
+def replicate_upload(savename):
+    if replicator is not None:
+        replicator.enqueue(storage.relative_path(savename))
+
+postprocessing = PostProcessingPipeline(POSTPROCESS_WORKERS, POSTPROCESS_MAX_QUEUED, POSTPROCESS_MAX_RETRIES)
+
+def queue_mask_postprocessing(original_filename, mask_savename):
+    """Hands the heavy OpenCV work for a freshly saved mask to the process pool."""
+    original_path = storage.original_path(original_filename)
+    mask_path = storage.annotation_path(mask_savename)
+    base = os.path.splitext(original_filename)[0]
+    upload = state_store.latest_revision(mask_savename)
+
+    def on_success(qc):
+        state_store.save_mask_qc(base, mask_savename, qc)
+        if qc.get('canonicalized'):
+            _, error_msg = revision_store.adopt(mask_savename, 'mask', 'canonical',
+                                                source_sha256=upload['sha256'] if upload else None)
+            if error_msg:
+                print(f"Warning: canonical {mask_savename} not recorded as a revision: {error_msg}")
+            status_index.refresh(mask_savename)
+            replicate_upload(mask_savename) # The upload was mirrored already; replace it with the small file
+
+    queued = postprocessing.submit(original_filename, precompute_mask_outputs,
+                                   DERIVED_CACHE_DIR, original_path, mask_path,
+                                   POSTPROCESS_PREVIEW_FORMATS, PREVIEW_MIN_DIM,
+                                   CANONICAL_MASKS, MASK_ARCHIVE_DIR, PREVIEW_TOP_DIM, on_success=on_success)
+    if not queued:
+        print(f"Post-processing queue full, '{mask_savename}' will be rendered on first view.")
+    return queued
+
+def find_mask_file_path(original_filename_base):
     """Finds an existing mask file for the given original image base name."""
     for ext in ALLOWED_MASK_EXTENSIONS:
         mask_filename = f"{original_filename_base}_mask.{ext}"
         # print(mask_filename) 
-        mask_path = os.path.join(base_dir, mask_filename)
+        mask_path = storage.annotation_path(mask_filename)
         if os.path.exists(mask_path):
             return mask_path
     return None
@@ -155,69 +402,347 @@ def serve_pil_image(pil_img, image_format='PNG'):
 
 def serve_cv_image(cv_image, image_format_ext='.png'):
     """Serves an OpenCV image (NumPy array) as a Flask response."""
-    is_success, buffer = cv2.imencode(image_format_ext, cv_image)
-    if is_success:
-        return Response(io.BytesIO(buffer).getvalue(), mimetype=f'image/{image_format_ext.strip(".")}')
+    data = encode_cv_image(cv_image, image_format_ext)
+    if data is not None:
+        return Response(data, mimetype=f'image/{image_format_ext.strip(".")}')
     else:
         flash("Error encoding image for display.", "error")
         return "Error encoding image", 500
 
+def serve_cached_image(kind, source_paths, render, mimetype='image/png', params=None, guarded=True,
+                       etag_suffix=''):
+    """Serves a derived image through the derived cache with ETag/Last-Modified validators.
+
+    render() is only called on a cache miss and must return (image_bytes, error_msg).
+    With guarded=False it runs without taking a render_guard slot (cheap renders only).
+    etag_suffix tells apart representations of the same cached bytes (e.g. '-gz').
+    """
+    with stage('cache_lookup'):
+        key, last_modified = derived_cache.make_key(kind, source_paths, params)
+        etag = key + etag_suffix
+        if etag in request.if_none_match:
+            return revalidatable_response(Response(status=304), etag, last_modified)
+        data = derived_cache.get(key)
+    if data is None:
+        if not guarded:
+            data, error_msg = derived_cache.get_or_create(key, render)
+        else:
+            try:
+                data, error_msg = render_guard.run(key, lambda: derived_cache.get_or_create(key, render))
+            except ServerBusy as e:
+                return server_busy_response(e)
+        if data is None:
+            return error_msg, 500
+    return revalidatable_response(Response(data, mimetype=mimetype), etag, last_modified)
+
+def revalidatable_response(response, etag, last_modified):
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Let the browser keep the image but revalidate it, so a new upload shows up immediately
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def server_busy_response(error):
+    response = Response("Server is busy rendering images, please retry shortly.", status=503, mimetype='text/plain')
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def wants_full_resolution():
+    return request.args.get('full', '').lower() in ('1', 'true', 'yes')
+
+def serve_preview(kind, source_paths, load, lossless=False, thumbnail_source=None):
+    """Serves a downscaled preview from the image's pyramid.
+
+    Query parameters: max_dim (longest side the client will display, default
+    DEFAULT_PREVIEW_MAX_DIM) or level (pyramid level, 0 = at most PREVIEW_TOP_DIM). The
+    format is WebP when the browser accepts it, otherwise JPEG (PNG if lossless).
+    load() -> (cv_image, error_msg) is only called when the pyramid is not cached.
+    With thumbnail_source, a max_dim up to THUMBNAIL_MAX_DIM is rendered from a
+    reduced decode of that file instead of building the pyramid; that only skips
+    the render_guard for JPEGs, the one format whose reduced decode is cheap.
+    """
+    try:
+        level = request.args.get('level', type=int)
+        max_dim = int(request.args.get('max_dim', DEFAULT_PREVIEW_MAX_DIM))
+    except ValueError:
+        return "Invalid max_dim or level.", 400
+    if max_dim <= 0:
+        return "max_dim must be positive.", 400
+
+    fmt = negotiate_format(request.accept_mimetypes, lossless=lossless)
+    if thumbnail_source is not None and level is None and max_dim <= THUMBNAIL_MAX_DIM:
+        response = serve_cached_image(kind + ':thumbnail', source_paths,
+                                      lambda: render_thumbnail(thumbnail_source, max_dim, fmt),
+                                      preview_mimetype(fmt), params={'fmt': fmt, 'max_dim': max_dim},
+                                      guarded=not has_cheap_reduced_decode(thumbnail_source))
+        if isinstance(response, Response):
+            response.vary.add('Accept')
+        return response
+    with stage('cache_lookup'):
+        data, key, last_modified, mimetype = lookup_pyramid_level(
+            derived_cache, kind, source_paths, fmt, max_dim=max_dim, level=level)
+    if data is None:
+        # Build the whole pyramid once, however many requests for it arrive together
+        manifest_key, _ = pyramid_key(derived_cache, kind, source_paths, fmt)
+        try:
+            built = render_guard.run(manifest_key, lambda: get_pyramid_level(
+                derived_cache, kind, source_paths, fmt, load, level=0, min_dim=PREVIEW_MIN_DIM,
+                top_dim=PREVIEW_TOP_DIM))
+        except ServerBusy as e:
+            return server_busy_response(e)
+        if built[0] is None:
+            return built[4], 500
+        data, key, last_modified, mimetype = lookup_pyramid_level(
+            derived_cache, kind, source_paths, fmt, max_dim=max_dim, level=level)
+        if data is None:
+            return "Preview not available.", 500
+    response = revalidatable_response(Response(data, mimetype=mimetype), key, last_modified)
+    response.vary.add('Accept')
+    return response
+
+
+def build_progress_report():
+    """Progress counters per annotator plus throughput (completions/hour over the rate
+    window, measured from the first completion in it) and the ETA that rate implies."""
+    now = time.time()
+    rates = state_store.completion_rates(now - PROGRESS_RATE_WINDOW_SECONDS)
+
+    def with_rate(stats, completions, first_completion):
+        hours = max(1.0, (now - first_completion) / 3600) if completions else None
+        per_hour = completions / hours if completions else 0.0
+        remaining = stats['total'] - stats['completed']
+        if remaining == 0:
+            eta_seconds = 0
+        else:
+            eta_seconds = remaining / per_hour * 3600 if per_hour else None
+        return dict(stats, completions_per_hour=round(per_hour, 2), eta_seconds=eta_seconds,
+                    eta=now + eta_seconds if eta_seconds is not None else None)
+
+    annotators = []
+    overall = dict.fromkeys(("total", "completed", "partial_xcf", "partial_mask", "pending"), 0)
+    overall_completions, overall_first = 0, None
+    for annotator_name, stats in state_store.progress().items():
+        completions, first_completion = rates.get(annotator_name, (0, None))
+        annotators.append(dict(with_rate(stats, completions, first_completion), name=annotator_name))
+        for key in overall:
+            overall[key] += stats[key]
+        overall_completions += completions
+        if first_completion is not None:
+            overall_first = min(overall_first or first_completion, first_completion)
+    return {
+        "version": state_store.progress_version(),
+        "generated_at": now,
+        "annotators": annotators,
+        "overall": with_rate(overall, overall_completions, overall_first),
+    }
+
 
 # --- Main Routes ---
+@app.before_request
+def wait_for_first_warm_up():
+    """On the very first start there are no assignments to serve yet: answer 503
+    until the warm-up has created them."""
+    if startup_done.is_set() or request.endpoint in ('ready', 'metrics_endpoint', 'static') or state_store.annotators():
+        return None
+    response = jsonify({"error": "Server is starting up, try again shortly."})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint: route latency, image stage timings, bytes served, uploads."""
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/ready')
+def ready():
+    """200 once the start-up scan has finished, 503 while it runs (or if it failed)."""
+    payload = dict(startup, steps=dict(startup['steps']))
+    payload['elapsed'] = (startup['finished'] or time.time()) - startup['started']
+    return jsonify(payload), 200 if startup['ready'] else 503
+
 @app.route('/')
 def index():
-    annotator_info_list = []
-    for annotator_name, assigned_images in IMAGE_ASSIGNMENTS.items():
-        stats = get_annotator_stats(annotator_name, assigned_images)
-        annotator_info_list.append({
-            "name": annotator_name,
-            "stats": stats
+    report = build_progress_report()
+    annotator_info_list = [{"name": stats["name"], "stats": stats} for stats in report["annotators"]]
+    return render_template('index.html', annotators_info=annotator_info_list, overall=report["overall"])
+
+@app.route('/progress')
+def progress():
+    return jsonify(build_progress_report())
+
+@app.route('/progress/stream')
+def progress_stream():
+    """Server-sent events: a 'progress' event with the /progress payload whenever the
+    counters change (any worker process), and a keep-alive comment otherwise."""
+    def events():
+        yield "retry: 3000\n\n"
+        started = last_sent = time.time()
+        last_version = None
+        while time.time() - started < PROGRESS_STREAM_MAX_SECONDS:
+            version = state_store.progress_version()
+            if version != last_version:
+                last_version = version
+                last_sent = time.time()
+                yield f"id: {version}\nevent: progress\ndata: {json.dumps(build_progress_report())}\n\n"
+            elif time.time() - last_sent > 15:
+                last_sent = time.time()
+                yield ": keep-alive\n\n"
+            time.sleep(PROGRESS_STREAM_POLL_SECONDS)
+
+    response = Response(events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Don't let nginx hold events back
+    return response
+
+def annotator_page_args():
+    """(status, page, per_page) from the query string, or raises ValueError."""
+    status = request.args.get('status') or None
+    if status is not None and status not in STATUS_FILTERS:
+        raise ValueError(f"status must be one of {', '.join(STATUS_FILTERS)}")
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', ANNOTATOR_PAGE_SIZE, type=int)
+    if page < 1 or not 0 < per_page <= ANNOTATOR_MAX_PAGE_SIZE:
+        raise ValueError(f"page must be >= 1 and per_page between 1 and {ANNOTATOR_MAX_PAGE_SIZE}")
+    return status, page, per_page
+
+def image_status_page(annotator_name, status, page, per_page):
+    """One page of an annotator's images with their annotation status, plus paging info."""
+    offset = (page - 1) * per_page
+    rows = []
+    for filename, base, annotation in state_store.assigned_with_status(annotator_name, status, offset, per_page):
+        mask = annotation['mask']
+        rows.append({
+            "original": filename,
+            "xcf_exists": annotation['xcf'] is not None,
+            "mask_exists": mask is not None,
+            # ?v= for links to the files themselves, so browsers can cache them for good
+            "original_version": file_servers[0].version(storage.original_path(filename)),
+            "mask_version": file_version(mask[1], mask[2]) if mask else None,
+            "base_filename": base, # For constructing view URLs
+            "job": postprocessing.status(filename)
         })
-    return render_template('index.html', annotators_info=annotator_info_list)
+    total = state_store.count_assigned(annotator_name, status)
+    return {
+        "annotator": annotator_name,
+        "status": status,
+        "page": page,
+        "per_page": per_page,
+        "offset": offset,
+        "total": total,
+        "next_page": page + 1 if offset + len(rows) < total else None,
+        "rows": rows,
+    }
 
 @app.route('/annotator/<annotator_name>') # Changed from annotator_id to annotator_name
 def annotator_page(annotator_name):
-    if annotator_name not in IMAGE_ASSIGNMENTS:
+    """One page of rows (?page=, ?per_page=, ?status=pending|partial|complete); the page
+    fetches the following ones from annotator_images_api as the user scrolls."""
+    if not state_store.has_annotator(annotator_name):
         flash(f"Annotator '{annotator_name}' not found.", "error")
         return redirect(url_for('index'))
+    try:
+        status, page, per_page = annotator_page_args()
+    except ValueError as e:
+        flash(str(e), "error")
+        return redirect(url_for('annotator_page', annotator_name=annotator_name))
 
-    assigned_images_filenames = IMAGE_ASSIGNMENTS.get(annotator_name, [])
-    annotated_status = []
-
-    for filename in assigned_images_filenames:
-        base, orig_ext = os.path.splitext(filename)
-        xcf_exists = os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], base + ".xcf"))
-        mask_file_path = find_mask_file_path(app.config['UPLOAD_FOLDER'], base)
-        mask_exists = mask_file_path is not None
-
-        annotated_status.append({
-            "original": filename,
-            "xcf_exists": xcf_exists,
-            "mask_exists": mask_exists,
-            "base_filename": base # For constructing view URLs
-        })
-
+    listing = image_status_page(annotator_name, status, page, per_page)
+    counts = {key: state_store.count_assigned(annotator_name, key) for key in (None,) + tuple(STATUS_FILTERS)}
     return render_template('annotator_view.html',
                            annotator_name=annotator_name,
-                           images_status=annotated_status)
+                           images_status=listing['rows'],
+                           listing=listing,
+                           status_counts=counts,
+                           thumbnail_max_dim=THUMBNAIL_MAX_DIM,
+                           render_retry_seconds=RENDER_RETRY_AFTER_SECONDS,
+                           # Defaults of the client-side overlay controls: the server overlay's look
+                           overlay_color='#%02x%02x%02x' % OVERLAY_COLOR_BGR[::-1],
+                           overlay_opacity=round(OVERLAY_ALPHA * 100))
+
+@app.route('/api/annotator/<annotator_name>/images')
+def annotator_images_api(annotator_name):
+    """JSON page of an annotator's images and status. The rendered table rows are
+    included as 'html' for the annotator page's infinite scroll."""
+    if not state_store.has_annotator(annotator_name):
+        return jsonify({"error": f"Annotator '{annotator_name}' not found."}), 404
+    try:
+        status, page, per_page = annotator_page_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    listing = image_status_page(annotator_name, status, page, per_page)
+    listing['html'] = render_template('_image_rows.html', annotator_name=annotator_name,
+                                      images_status=listing['rows'], row_offset=listing['offset'],
+                                      thumbnail_max_dim=THUMBNAIL_MAX_DIM)
+    if listing['next_page']:
+        listing['next_url'] = url_for('annotator_images_api', annotator_name=annotator_name, status=status,
+                                      page=listing['next_page'], per_page=per_page)
+    return jsonify(listing)
 
 @app.route('/download/<annotator_name>/<filename>')
 def download_file(annotator_name, filename):
-    if annotator_name not in IMAGE_ASSIGNMENTS or \
-       filename not in IMAGE_ASSIGNMENTS[annotator_name]:
+    if not state_store.is_assigned(annotator_name, filename):
         flash("Error: You are not authorized to download this file or file not found.", "error")
         return redirect(url_for('annotator_page', annotator_name=annotator_name))
-    try:
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=True)
-    except FileNotFoundError:
+    path = storage.original_path(filename)
+    response = file_server_for(path).send(request, path, as_attachment=True)
+    if response is None:
         flash(f"Error: File '{filename}' not found on server.", "error")
         return redirect(url_for('annotator_page', annotator_name=annotator_name))
+    return response
+
+@app.route('/download_batch/<annotator_name>')
+def download_batch(annotator_name):
+    """Streams a ZIP of an annotator's assigned originals.
+
+    Query parameters:
+      include=xcf,mask   also add the existing annotation files
+      status=pending     only images that do not yet have both xcf and mask
+      since=<unix time>  only images with a file modified after that time
+    """
+    if not state_store.has_annotator(annotator_name):
+        flash(f"Annotator '{annotator_name}' not found.", "error")
+        return redirect(url_for('index'))
+
+    include = set(filter(None, request.args.get('include', '').split(',')))
+    only_pending = request.args.get('status') == 'pending'
+    try:
+        since = float(request.args['since']) if request.args.get('since') else None
+    except ValueError:
+        flash("Invalid 'since' timestamp.", "error")
+        return redirect(url_for('annotator_page', annotator_name=annotator_name))
+
+    assigned_images = state_store.assigned_with_status(annotator_name)
+
+    def entries():
+        for filename, base, annotation in assigned_images:
+            if only_pending and annotation['xcf'] and annotation['mask']:
+                continue
+            files = [(filename, None)]
+            if 'xcf' in include and annotation['xcf']:
+                files.append((base + ".xcf", annotation['xcf'][0]))
+            if 'mask' in include and annotation['mask']:
+                files.append((annotation['mask'][0], annotation['mask'][1]))
+            if since is not None:
+                mtimes = [mtime for _, mtime in files if mtime is not None]
+                try:
+                    mtimes.append(os.path.getmtime(storage.original_path(filename)))
+                except OSError:
+                    pass
+                if not any(mtime > since for mtime in mtimes):
+                    continue
+            for name, _ in files:
+                yield name, storage.path(name)
+
+    response = Response(stream_zip(entries()), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{annotator_name}_images.zip"'
+    return response
 
 @app.route('/upload/<annotator_name>/<original_filename>', methods=['POST'])
 def upload_files(annotator_name, original_filename):
     if request.method == 'POST':
-        if annotator_name not in IMAGE_ASSIGNMENTS or \
-           original_filename not in IMAGE_ASSIGNMENTS[annotator_name]:
+        if not state_store.is_assigned(annotator_name, original_filename):
             flash("Error: Invalid upload target.", "error")
             return redirect(url_for('annotator_page', annotator_name=annotator_name))
 
@@ -233,11 +758,19 @@ def upload_files(annotator_name, original_filename):
                 # xcf_savename = secure_filename(base_filename + ".xcf")
                 xcf_savename = base_filename + ".xcf"
                 print(f"Saving XCF as: {xcf_savename}") # Debug print
-                xcf_savepath = os.path.join(app.config['UPLOAD_FOLDER'], xcf_savename)
                 try:
-                    xcf_file.save(xcf_savepath)
-                    flash(f"XCF file '{xcf_savename}' uploaded successfully.", "success")
-                    uploaded_xcf = True
+                    revision, error_msg = revision_store.save_stream(xcf_savename, 'xcf', xcf_file.stream,
+                                                                     annotator_name, 'form')
+                    if error_msg:
+                        flash(f"Error saving XCF file: {error_msg}", "error")
+                    elif revision is None:
+                        flash(f"XCF file '{xcf_savename}' is identical to the current version, nothing changed.", "info")
+                    else:
+                        status_index.refresh(xcf_savename)
+                        record_upload(annotator_name, xcf_savename, 'xcf', revision['size'], 'form')
+                        replicate_upload(xcf_savename)
+                        flash(f"XCF file '{xcf_savename}' uploaded successfully.", "success")
+                        uploaded_xcf = True
                 except Exception as e:
                     flash(f"Error saving XCF file: {e}", "error")
             else:
@@ -254,12 +787,20 @@ def upload_files(annotator_name, original_filename):
                 # mask_savename = secure_filename(base_filename + "_mask." + mask_extension)
                 mask_savename = base_filename + "_mask." + mask_extension
                 print(f"Saving mask as: {mask_savename}") # Debug print
-                mask_savepath = os.path.join(app.config['UPLOAD_FOLDER'], mask_savename)
-                print(f"Mask save path: {mask_savepath}") # Debug print
                 try:
-                    mask_file.save(mask_savepath)
-                    flash(f"Mask file '{mask_savename}' uploaded successfully.", "success")
-                    uploaded_mask = True
+                    revision, error_msg = revision_store.save_stream(mask_savename, 'mask', mask_file.stream,
+                                                                     annotator_name, 'form')
+                    if error_msg:
+                        flash(f"Error saving MASK file: {error_msg}", "error")
+                    elif revision is None:
+                        flash(f"Mask file '{mask_savename}' is identical to the current version, nothing changed.", "info")
+                    else:
+                        status_index.refresh(mask_savename)
+                        record_upload(annotator_name, mask_savename, 'mask', revision['size'], 'form')
+                        replicate_upload(mask_savename)
+                        queue_mask_postprocessing(original_filename, mask_savename)
+                        flash(f"Mask file '{mask_savename}' uploaded successfully.", "success")
+                        uploaded_mask = True
                 except Exception as e:
                     flash(f"Error saving MASK file: {e}", "error")
             else:
@@ -279,19 +820,330 @@ def upload_files(annotator_name, original_filename):
         return redirect(url_for('annotator_page', annotator_name=annotator_name))
     return redirect(url_for('annotator_page', annotator_name=annotator_name))
 
+def run_bulk_upload(annotator_name, stream):
+    """Stores the annotation files of the archive read from stream for an annotator's
+    images and returns the per-file report."""
+    originals = {base: filename for filename, base, _ in state_store.assigned_with_status(annotator_name)}
+
+    def save(target, kind, fileobj):
+        return revision_store.save_stream(target, kind, fileobj, annotator_name, 'bulk')
+
+    start = time.perf_counter()
+    report, error_msg = ingest_archive(stream, originals, save, ALLOWED_XCF_EXTENSIONS, ALLOWED_MASK_EXTENSIONS,
+                                       BULK_UPLOAD_WORKERS, BULK_UPLOAD_MAX_PENDING, BULK_UPLOAD_SPOOL_BYTES,
+                                       BULK_UPLOAD_MAX_MEMBER_BYTES)
+    for entry in report:
+        if entry['status'] != ACCEPTED:
+            continue
+        status_index.refresh(entry['target'])
+        record_upload(annotator_name, entry['target'], entry['kind'], entry['size'], 'bulk', seconds=entry['seconds'])
+        replicate_upload(entry['target'])
+        if entry['kind'] == 'mask' and not queue_mask_postprocessing(entry['original'], entry['target']):
+            entry['message'] = "Previews will be rendered on first view."
+    counts = {status: 0 for status in MEMBER_STATUSES}
+    for entry in report:
+        counts[entry['status']] += 1
+    print(f"Bulk upload by {annotator_name}: {counts} in {time.perf_counter() - start:.2f}s")
+    return {"annotator": annotator_name, "files": report, "counts": counts, "error": error_msg}
+
+@app.route('/upload/<annotator_name>/bulk', methods=['POST'])
+def bulk_upload(annotator_name):
+    if not state_store.has_annotator(annotator_name):
+        flash(f"Annotator '{annotator_name}' not found.", "error")
+        return redirect(url_for('index'))
+    archive = request.files.get('archive')
+    if archive is None or archive.filename == '':
+        flash("No archive selected for upload.", "info")
+        return redirect(url_for('annotator_page', annotator_name=annotator_name))
+    result = run_bulk_upload(annotator_name, archive.stream)
+    if result['error'] and not result['files']:
+        flash(f"Error reading '{archive.filename}': {result['error']}", "error")
+        return redirect(url_for('annotator_page', annotator_name=annotator_name))
+    return render_template('bulk_upload.html', archive_name=archive.filename, **result)
+
+@app.route('/api/upload/<annotator_name>/bulk', methods=['POST'])
+def bulk_upload_api(annotator_name):
+    """The archive as the multipart field 'archive', or as the raw request body."""
+    if not state_store.has_annotator(annotator_name):
+        return jsonify({"error": f"Annotator '{annotator_name}' not found."}), 404
+    archive = request.files.get('archive')
+    result = run_bulk_upload(annotator_name, archive.stream if archive is not None else request.stream)
+    return jsonify(result), 400 if result['error'] and not result['files'] else 200
+
+
+@app.route('/jobs')
+@app.route('/jobs/<annotator_name>')
+def postprocessing_jobs(annotator_name=None):
+    """Status of background post-processing jobs, keyed by original filename."""
+    jobs = postprocessing.all_statuses()
+    if annotator_name is not None:
+        assigned = set(state_store.assigned_images(annotator_name))
+        jobs = {name: job for name, job in jobs.items() if name in assigned}
+    return jsonify(jobs)
+
+
+@app.route('/replication')
+def replication_status():
+    """Backlog of the copy-to-mirror journal (pending / done / failed counts)."""
+    summary = state_store.replication_summary()
+    summary['enabled'] = replicator is not None
+    summary['mirror'] = REPLICATION_MIRROR_DIR
+    return jsonify(summary)
+
+
+def qc_report_args():
+    """(sort, descending, flag, annotator, page) from the query string, or raises ValueError."""
+    sort = request.args.get('sort', 'flag_count')
+    if sort not in QC_SORT_COLUMNS:
+        raise ValueError(f"sort must be one of {', '.join(QC_SORT_COLUMNS)}")
+    order = request.args.get('order', 'desc')
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be asc or desc")
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        raise ValueError("page must be >= 1")
+    return sort, order == 'desc', request.args.get('flag') or None, request.args.get('annotator') or None, page
+
+def qc_report_page(sort, descending, flag, annotator_name, page):
+    offset = (page - 1) * QC_REPORT_PAGE_SIZE
+    rows, total = state_store.mask_qc_report(sort, descending, flag, annotator_name,
+                                             limit=QC_REPORT_PAGE_SIZE, offset=offset)
+    return {
+        "sort": sort,
+        "order": 'desc' if descending else 'asc',
+        "flag": flag,
+        "annotator": annotator_name,
+        "page": page,
+        "total": total,
+        "next_page": page + 1 if offset + len(rows) < total else None,
+        "rows": rows,
+    }
+
+@app.route('/qc')
+def qc_report():
+    """Masks with their QC numbers and flags, sortable by any column (?sort=&order=)
+    and filterable by ?flag= and ?annotator=."""
+    try:
+        args = qc_report_args()
+    except ValueError as e:
+        flash(str(e), "error")
+        return redirect(url_for('qc_report'))
+    return render_template('qc_report.html', report=qc_report_page(*args),
+                           annotators=state_store.annotators(), qc_flags=QC_FLAGS)
+
+@app.route('/api/qc')
+def qc_report_api():
+    try:
+        args = qc_report_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(qc_report_page(*args))
+
+
+def near_duplicate_clusters():
+    images = get_image_files()
+    near_duplicates.update(images)
+    return [cluster for cluster in near_duplicates.clusters(sorted(images)) if len(cluster) > 1]
+
+def agreement_payload():
+    return {
+        "refreshing": agreement_engine.refreshing,
+        "last_refresh": agreement_engine.last_refresh,
+        "pairs": state_store.agreement_report(),
+    }
+
+@app.route('/agreement')
+def agreement_report():
+    """IoU / Dice / boundary F-score for every pair of masks on overlapping images."""
+    return render_template('agreement.html', **agreement_payload())
+
+@app.route('/api/agreement')
+def agreement_report_api():
+    return jsonify(agreement_payload())
+
+@app.route('/agreement/refresh', methods=['POST'])
+def refresh_agreement():
+    """Recomputes pairs with changed masks in the background."""
+    if agreement_engine.refresh_in_background(near_duplicate_clusters):
+        flash("Agreement refresh started; only pairs with changed masks are recomputed.", "info")
+    else:
+        flash("An agreement refresh is already running.", "info")
+    return redirect(url_for('agreement_report'))
+
+
+# --- Chunked (resumable) Upload Routes ---
+# 1. POST   /upload/<annotator>/<original>/chunked  {"kind": "xcf"|"mask", "size": N, "sha256": optional}
+# 2. PUT    /upload/chunked/<upload_id>?offset=N    raw bytes, optional X-Chunk-SHA256 header
+#    GET    /upload/chunked/<upload_id>             -> current server offset, to resume after a failure
+# 3. POST   /upload/chunked/<upload_id>/complete    -> atomic rename into UPLOAD_FOLDER
+def chunked_session_response(session, error_msg=None, status=200):
+    body = {"error": error_msg} if error_msg else {}
+    if session:
+        body.update({"upload_id": session['upload_id'], "offset": session['offset'],
+                     "size": session['size'], "target": session['target']})
+    return jsonify(body), status
+
+@app.route('/upload/<annotator_name>/<original_filename>/chunked', methods=['POST'])
+def start_chunked_upload(annotator_name, original_filename):
+    if not state_store.is_assigned(annotator_name, original_filename):
+        return chunked_session_response(None, "Invalid upload target.", 403)
+
+    params = request.get_json(silent=True) or {}
+    kind = params.get('kind')
+    try:
+        size = int(params.get('size'))
+    except (TypeError, ValueError):
+        return chunked_session_response(None, "A numeric 'size' is required.", 400)
+    if size < 0:
+        return chunked_session_response(None, "'size' must not be negative.", 400)
+
+    base_filename, _ = os.path.splitext(original_filename)
+    if kind == 'xcf':
+        target = base_filename + ".xcf"
+    elif kind == 'mask':
+        target = base_filename + "_mask.png"
+    else:
+        return chunked_session_response(None, "'kind' must be 'xcf' or 'mask'.", 400)
+
+    session = chunked_uploads.create(target, size, params.get('sha256'),
+                                     annotator=annotator_name, original=original_filename, kind=kind)
+    print(f"Started chunked upload {session['upload_id']} for {target} ({size} bytes)")
+    return chunked_session_response(session, status=201)
+
+@app.route('/upload/chunked/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    session = chunked_uploads.get(upload_id)
+    if session is None:
+        return chunked_session_response(None, "Unknown upload session.", 404)
+    return chunked_session_response(session)
+
+@app.route('/upload/chunked/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return chunked_session_response(chunked_uploads.get(upload_id), "An integer 'offset' is required.", 400)
+    session, error_msg, status = chunked_uploads.write_chunk(
+        upload_id, offset, request.stream, request.headers.get('X-Chunk-SHA256'))
+    if not error_msg:
+        metrics.observe_upload(session['kind'], 'chunk', session['offset'] - offset,
+                               time.perf_counter() - g.metrics_start)
+    return chunked_session_response(session, error_msg, status)
+
+@app.route('/upload/chunked/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    saved = {}
+
+    def deliver(session, part_path, sha256):
+        revision, error_msg = revision_store.save_file(session['target'], session['kind'], part_path,
+                                                       session['annotator'], 'chunked', sha256)
+        saved['revision'] = revision
+        return error_msg
+
+    session, error_msg, status = chunked_uploads.complete(upload_id, deliver)
+    if error_msg:
+        return chunked_session_response(session, error_msg, status)
+    label = "XCF" if session['kind'] == 'xcf' else "Mask"
+    if saved['revision'] is None:
+        flash(f"{label} file '{session['target']}' is identical to the current version, nothing changed.", "info")
+        return chunked_session_response(session)
+    status_index.refresh(session['target'])
+    record_upload(session['annotator'], session['target'], session['kind'], session['size'], 'chunked',
+                  seconds=time.time() - session['created'])
+    replicate_upload(session['target'])
+    if session['kind'] == 'mask':
+        queue_mask_postprocessing(session['original'], session['target'])
+    flash(f"{label} file '{session['target']}' uploaded successfully.", "success")
+    return chunked_session_response(session)
+
+@app.route('/upload/chunked/<upload_id>', methods=['DELETE'])
+def abort_chunked_upload(upload_id):
+    chunked_uploads.abort(upload_id)
+    return '', 204
+
+
+# --- Revision History ---
+def annotation_filenames(original_filename):
+    base_filename, _ = os.path.splitext(original_filename)
+    return [base_filename + ".xcf"] + [f"{base_filename}_mask.{ext}" for ext in sorted(ALLOWED_MASK_EXTENSIONS)]
+
+def revision_history_payload(annotator_name, original_filename):
+    """{annotation filename: [revisions, newest (current) first]} with download URLs."""
+    history = {}
+    for filename in annotation_filenames(original_filename):
+        revisions = revision_store.history(filename)
+        for i, revision in enumerate(revisions):
+            revision['current'] = i == 0
+            blob_path = revision_store.blobs.path(revision['sha256'])
+            revision['download_url'] = url_for('download_revision', annotator_name=annotator_name,
+                                               original_filename=original_filename, revision_id=revision['id'],
+                                               v=blob_file_server.version(blob_path))
+        history[filename] = revisions
+    return history
+
+@app.route('/revisions/<annotator_name>/<original_filename>')
+def revision_history(annotator_name, original_filename):
+    if not state_store.is_assigned(annotator_name, original_filename):
+        flash("Error: Invalid revision history target.", "error")
+        return redirect(url_for('annotator_page', annotator_name=annotator_name))
+    return render_template('revisions.html', annotator_name=annotator_name, original_filename=original_filename,
+                           history=revision_history_payload(annotator_name, original_filename))
+
+@app.route('/api/revisions/<annotator_name>/<original_filename>')
+def revision_history_api(annotator_name, original_filename):
+    if not state_store.is_assigned(annotator_name, original_filename):
+        return jsonify({"error": "Invalid revision history target."}), 404
+    return jsonify(revision_history_payload(annotator_name, original_filename))
+
+@app.route('/revisions/<annotator_name>/<original_filename>/<int:revision_id>')
+def download_revision(annotator_name, original_filename, revision_id):
+    """One stored version of an XCF / mask. Blobs never change, so ?v= URLs are cached for good."""
+    revision = state_store.get_revision(revision_id)
+    if not state_store.is_assigned(annotator_name, original_filename) or revision is None or \
+       revision['filename'] not in annotation_filenames(original_filename):
+        return "Revision not found.", 404
+    name, ext = os.path.splitext(revision['filename'])
+    response = blob_file_server.send(request, revision_store.blobs.path(revision['sha256']), as_attachment=True,
+                                     download_name=f"{name}.r{revision['id']}{ext}")
+    if response is None:
+        return "The stored file of this revision is missing.", 404
+    return response
+
+@app.route('/revisions/<annotator_name>/<original_filename>/<int:revision_id>/restore', methods=['POST'])
+def restore_revision(annotator_name, original_filename, revision_id):
+    """Makes an earlier revision current again; it is post-processed and replicated like an upload."""
+    revision = state_store.get_revision(revision_id)
+    if not state_store.is_assigned(annotator_name, original_filename) or revision is None or \
+       revision['filename'] not in annotation_filenames(original_filename):
+        flash("Error: Revision not found.", "error")
+        return redirect(url_for('annotator_page', annotator_name=annotator_name))
+
+    filename = revision['filename']
+    restored, error_msg = revision_store.restore(filename, revision_id, annotator_name)
+    if error_msg:
+        flash(f"Error restoring '{filename}': {error_msg}", "error")
+    elif restored is None:
+        flash(f"'{filename}' already has the content of revision {revision_id}.", "info")
+    else:
+        status_index.refresh(filename)
+        record_upload(annotator_name, filename, restored['kind'], restored['size'], 'restore')
+        replicate_upload(filename)
+        if restored['kind'] == 'mask':
+            queue_mask_postprocessing(original_filename, filename)
+        flash(f"Restored revision {revision_id} of '{filename}'.", "success")
+    return redirect(url_for('revision_history', annotator_name=annotator_name, original_filename=original_filename))
+
 
 # --- Image Viewing Routes ---
 def get_paths_for_view(annotator_name, original_filename_with_ext):
-    if annotator_name not in IMAGE_ASSIGNMENTS or \
-       original_filename_with_ext not in IMAGE_ASSIGNMENTS[annotator_name]:
+    if not state_store.is_assigned(annotator_name, original_filename_with_ext):
         return None, None, "Authorization error or file not assigned."
 
-    original_img_path = os.path.join(app.config['UPLOAD_FOLDER'], original_filename_with_ext)
+    original_img_path = storage.original_path(original_filename_with_ext)
     if not os.path.exists(original_img_path):
         return None, None, "Original image not found."
 
     original_filename_base, _ = os.path.splitext(original_filename_with_ext)
-    mask_img_path = find_mask_file_path(app.config['UPLOAD_FOLDER'], original_filename_base)
+    mask_img_path = find_mask_file_path(original_filename_base)
 
     return original_img_path, mask_img_path, None
 
@@ -303,10 +1155,13 @@ def view_original_image(annotator_name, original_filename_with_ext):
         flash(error_msg, "error")
         return error_msg, 404 # Or redirect, or a placeholder image
 
-    try:
-        return send_from_directory(app.config['UPLOAD_FOLDER'], original_filename_with_ext)
-    except FileNotFoundError:
+    if not wants_full_resolution():
+        return serve_preview('original', [original_img_path], lambda: load_image(original_img_path),
+                             thumbnail_source=original_img_path)
+    response = file_server_for(original_img_path).send(request, original_img_path)
+    if response is None:
         return "Original image file not found on server.", 404
+    return response
 
 @app.route('/view/mask/<annotator_name>/<original_filename_with_ext>')
 def view_mask_image(annotator_name, original_filename_with_ext):
@@ -317,10 +1172,12 @@ def view_mask_image(annotator_name, original_filename_with_ext):
     if not mask_img_path:
         return "Mask image not found.", 404
 
-    try:
-        return send_from_directory(os.path.dirname(mask_img_path), os.path.basename(mask_img_path))
-    except FileNotFoundError:
+    if not wants_full_resolution():
+        return serve_preview('mask', [mask_img_path], lambda: load_image(mask_img_path), lossless=True)
+    response = file_server_for(mask_img_path).send(request, mask_img_path)
+    if response is None:
         return "Mask image file not found on server.", 404
+    return response
 
 
 @app.route('/view/binary_mask/<annotator_name>/<original_filename_with_ext>')
@@ -332,18 +1189,11 @@ def view_binary_mask_image(annotator_name, original_filename_with_ext):
     if not mask_img_path:
         return "Mask image not found to create binary version.", 404
 
-    try:
-        img = cv2.imread(mask_img_path)
-        if img is None:
-            return "Could not read mask image.", 500
-        
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        _, binary = cv2.threshold(gray, 30, 255, cv2.THRESH_BINARY)
-        return serve_cv_image(binary)
-
-    except Exception as e:
-        print(f"Error processing binary mask: {e}")
-        return f"Error generating binary mask: {e}", 500
+    if not wants_full_resolution():
+        return serve_preview('binary_mask', [mask_img_path],
+                             lambda: load_binary_mask(mask_img_path), lossless=True)
+    return serve_cached_image('binary_mask', [mask_img_path],
+                              lambda: render_png(load_binary_mask(mask_img_path)))
 
 @app.route('/view/overlay/<annotator_name>/<original_filename_with_ext>')
 def view_overlay_image(annotator_name, original_filename_with_ext):
@@ -356,54 +1206,46 @@ def view_overlay_image(annotator_name, original_filename_with_ext):
     if not original_img_path: # Should be caught by get_paths_for_view already
         return "Original image not found for overlay.", 404
 
-    try:
-        og_img = cv2.imread(original_img_path)
-        mask_img_cv = cv2.imread(mask_img_path)
-
-        if og_img is None: return "Could not read original image for overlay.", 500
-        if mask_img_cv is None: return "Could not read mask image for overlay.", 500
-
-        og_img = cv2.cvtColor(og_img, cv2.COLOR_BGR2RGB) # To RGB for consistency with snippet
-
-        # Binarize the mask
-        gray_mask = cv2.cvtColor(mask_img_cv, cv2.COLOR_BGR2GRAY)
-        _, binary_mask_cv = cv2.threshold(gray_mask, 30, 255, cv2.THRESH_BINARY)
-
-        # Create a colored mask (blue)
-        # Ensure og_img and color_mask are same size
-        if og_img.shape[:2] != binary_mask_cv.shape[:2]:
-             # Resize binary_mask_cv to match og_img, or vice-versa.
-             # Sane default: resize mask to original image.
-             binary_mask_cv = cv2.resize(binary_mask_cv, (og_img.shape[1], og_img.shape[0]), interpolation=cv2.INTER_NEAREST)
-
+    if not wants_full_resolution():
+        return serve_preview('overlay', [original_img_path, mask_img_path],
+                             lambda: load_overlay(original_img_path, mask_img_path))
+    return serve_cached_image('overlay', [original_img_path, mask_img_path],
+                              lambda: render_png(load_overlay(original_img_path, mask_img_path)))
 
-        color_mask = cv2.cvtColor(binary_mask_cv, cv2.COLOR_GRAY2RGB)
-        color_mask[np.where((color_mask == [255, 255, 255]).all(axis=2))] = [0, 0, 255] # Blue
+@app.route('/view/packed_mask/<annotator_name>/<original_filename_with_ext>')
+def view_packed_mask(annotator_name, original_filename_with_ext):
+    """The binarized mask at one bit per pixel (see mask_kernels.pack_binary_mask), gzip-encoded.
 
-        # Ensure og_img and color_mask are same size before addWeighted
-        if og_img.shape != color_mask.shape:
-            # This case might happen if original is color and mask was processed to different depth
-            # For simplicity, if depths differ but H,W are same, proceed.
-            # A more robust solution might involve resizing or erroring.
-            # For now, let's assume cv2.addWeighted handles minor type differences or we ensure types match
-            print(f"Warning: Shape mismatch for overlay. Original: {og_img.shape}, Color Mask: {color_mask.shape}")
-            # Attempt to make them compatible if just channel depth differs
-            if og_img.shape[:2] == color_mask.shape[:2] and og_img.ndim != color_mask.ndim:
-                 if og_img.ndim == 2 and color_mask.ndim == 3: # og_img is grayscale
-                     og_img = cv2.cvtColor(og_img, cv2.COLOR_GRAY2RGB)
-                 # Add other conversion cases if necessary
-            if og_img.shape != color_mask.shape: # If still not matching
-                return "Image and mask dimensions are incompatible for overlay after processing.", 500
-
-
-        overlay = cv2.addWeighted(og_img, 0.7, color_mask, 0.3, 0) # Adjusted weights for better visibility
-        overlay_bgr = cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR) # Convert back to BGR for cv2.imencode
-
-        return serve_cv_image(overlay_bgr)
-
-    except Exception as e:
-        print(f"Error processing overlay: {e}")
-        return f"Error generating overlay: {e}", 500
+    The annotator page draws the binary mask and the overlay from this on a canvas, over the
+    original preview it already has, so toggling them costs a few KB and no server rendering.
+    Sized like the previews (max_dim, default DEFAULT_PREVIEW_MAX_DIM; full=1 for full size).
+    """
+    _, mask_img_path, error_msg = get_paths_for_view(annotator_name, original_filename_with_ext)
+    if error_msg:
+        return error_msg, 404
+    if not mask_img_path:
+        return "Mask image not found.", 404
+    max_dim = None
+    if not wants_full_resolution():
+        max_dim = request.args.get('max_dim', DEFAULT_PREVIEW_MAX_DIM, type=int)
+        if max_dim <= 0:
+            return "max_dim must be positive.", 400
+
+    use_gzip = 'gzip' in request.accept_encodings
+    # The gzip and identity bodies differ, so they must not share a strong ETag
+    response = serve_cached_image('packed_mask', [mask_img_path],
+                                  lambda: render_packed_mask(mask_img_path, max_dim),
+                                  mimetype='application/octet-stream', params={'max_dim': max_dim},
+                                  etag_suffix='-gz' if use_gzip else '')
+    if not isinstance(response, Response):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code == 200:
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response.set_data(gzip.decompress(response.get_data()))
+    return response
 
 
 if __name__ == '__main__':
@@ -415,15 +1257,20 @@ if __name__ == '__main__':
             for i in range(10):
                 # Create dummy JPG files for testing view routes
                 dummy_img = np.zeros((100, 100, 3), dtype=np.uint8)
-                cv2.imwrite(os.path.join(IMAGES_BASE_DIR, f'test_image_{i+1}.jpg'), dummy_img)
-            IMAGE_ASSIGNMENTS = assign_images() # Re-assign after creating files
+                dummy_path = storage.original_path(f'test_image_{i+1}.jpg')
+                os.makedirs(os.path.dirname(dummy_path), exist_ok=True)
+                cv2.imwrite(dummy_path, dummy_img)
+            startup_done.wait()
+            assign_images() # Re-assign after creating files
         else:
             print("Please create it and add images, or update the 'IMAGES_BASE_DIR' variable in app.py.")
             # exit(1) # Consider exiting if critical
 
-    print(f"Serving images from: {os.path.abspath(IMAGES_BASE_DIR)}")
+    print(f"Serving images from: {', '.join(os.path.abspath(root) for root in storage.original_roots)}")
+    if storage.annotation_root not in storage.original_roots:
+        print(f"Annotations stored in: {os.path.abspath(storage.annotation_root)}")
     print("Annotator assignments:")
-    for ann, imgs in IMAGE_ASSIGNMENTS.items():
+    for ann, imgs in state_store.load_assignments().items():
         print(f"  {ann}: {len(imgs)} images")
 
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,253 @@
+"""Incremental assignment rebalancing.
+
+Instead of reshuffling everyone's work when the image set or annotator list
+changes, plan_rebalance() keeps every existing assignment that is still valid
+and only redistributes the delta. Run directly for a dry-run report:
+
+    python assignment_engine.py --images-dir ./images_train/ --db annotation_state.db \\
+        --quotas '{"Pratyush": 130, "Vaibhav": 50}'          # add --apply to save
+
+Pass the same --annotations-dir / --source-dir / --shard-levels as app_v1's
+storage settings, or the originals are not found and every assignment is dropped.
+"""
+import os
+import json
+import random
+import argparse
+
+from storage_layout import add_layout_arguments, layout_from_args
+
+
+def plan_rebalance(assignments, current_files, quotas, is_started=None, cluster_key=None, seed=42,
+                   previous_quotas=None, known_files=None, max_cluster_overflow=5):
+    """Returns (new_assignments, report) for the current files and quotas.
+
+    - Files that no longer exist are dropped from their annotator.
+    - Annotators no longer in quotas release their files; new annotators start empty.
+    - An annotator whose quota was reduced (below previous_quotas, the quotas the
+      assignments were last saved with) releases not-yet-started files
+      (is_started(filename) -> bool), at most as many as the quota dropped by;
+      started work is never taken away. Being over an unchanged quota releases nothing.
+    - Released files and files new since known_files (the image set of the last
+      rebalance; None = every unassigned file is new) fill the remaining capacity
+      in quota order. Unassigned files seen before are only drawn on for capacity
+      still left after that. A file whose cluster_key(filename) matches a file an
+      annotator already holds goes to that annotator, keeping near-duplicates together,
+      unless that would put them more than max_cluster_overflow files over quota.
+
+    Only the changed files are examined after the initial set difference, and
+    nothing is placed (nor cluster_key called) while every annotator is full.
+    """
+    is_started = is_started or (lambda filename: False)
+    current_files = set(current_files)
+    report = {
+        "removed_files": [],
+        "released_files": [],
+        "removed_annotators": [],
+        "new_annotators": [],
+        "placed": {},
+        "unassigned": [],
+        "counts": {},
+    }
+
+    new_assignments = {}
+    assigned = set()
+    pool = []
+    for annotator_name, files in assignments.items():
+        if annotator_name not in quotas:
+            report["removed_annotators"].append(annotator_name)
+            released = [f for f in files if f in current_files]
+            report["removed_files"].extend(f for f in files if f not in current_files)
+            report["released_files"].extend(released)
+            pool.extend(released)
+            continue
+        kept = []
+        for filename in files:
+            if filename not in current_files:
+                report["removed_files"].append(filename)
+            elif filename in assigned:
+                # Same file listed twice (e.g. a hand-edited assignments.json): keep the first
+                continue
+            else:
+                kept.append(filename)
+                assigned.add(filename)
+        new_assignments[annotator_name] = kept
+
+    for annotator_name, quota in quotas.items():
+        if annotator_name not in new_assignments:
+            report["new_annotators"].append(annotator_name)
+            new_assignments[annotator_name] = []
+            continue
+        files = new_assignments[annotator_name]
+        previous_quota = (previous_quotas or {}).get(annotator_name, quota)
+        excess = min(len(files) - quota, previous_quota - quota)
+        if excess > 0:
+            # Release from the end of the list, skipping anything already being worked on
+            keep = []
+            for filename in reversed(files):
+                if excess > 0 and not is_started(filename):
+                    excess -= 1
+                    pool.append(filename)
+                    report["released_files"].append(filename)
+                    assigned.discard(filename)
+                else:
+                    keep.append(filename)
+            new_assignments[annotator_name] = keep[::-1]
+
+    def has_room():
+        return any(len(new_assignments[name]) < quota for name, quota in quotas.items())
+
+    unassigned = current_files - assigned - set(pool)
+    added = unassigned if known_files is None else unassigned - set(known_files)
+    pool = sorted(set(pool)) + sorted(added)
+    rng = random.Random(seed)
+    rng.shuffle(pool)
+
+    owner_of_cluster = {}
+    clusters_indexed = False
+
+    def cluster_owner(filename):
+        # The existing assignments are only keyed (which may hash them) once something is placed
+        nonlocal clusters_indexed
+        if cluster_key is None:
+            return None
+        if not clusters_indexed:
+            clusters_indexed = True
+            for annotator_name, files in new_assignments.items():
+                for assigned_file in files:
+                    owner_of_cluster.setdefault(cluster_key(assigned_file), annotator_name)
+        return owner_of_cluster.get(cluster_key(filename))
+
+    def place(annotator_name, filename):
+        new_assignments[annotator_name].append(filename)
+        report["placed"].setdefault(annotator_name, []).append(filename)
+        if cluster_key is not None:
+            owner_of_cluster.setdefault(cluster_key(filename), annotator_name)
+
+    def fill(files, report_unassigned=True):
+        for filename in files:
+            if not has_room():
+                if report_unassigned:
+                    report["unassigned"].append(filename)
+                continue
+            owner = cluster_owner(filename)
+            if owner is not None and len(new_assignments[owner]) < quotas[owner] + max_cluster_overflow:
+                place(owner, filename)
+                continue
+            for annotator_name, quota in quotas.items():
+                if len(new_assignments[annotator_name]) < quota:
+                    place(annotator_name, filename)
+                    break
+
+    fill(pool)
+    if has_room() and len(added) < len(unassigned):
+        # Capacity left over (e.g. a raised quota): draw on the files left unassigned before,
+        # which stay unassigned, and unreported, if it runs out
+        backlog = sorted(unassigned - added)
+        rng.shuffle(backlog)
+        fill(backlog, report_unassigned=False)
+
+    for annotator_name, quota in quotas.items():
+        report["counts"][annotator_name] = {
+            "before": len(assignments.get(annotator_name, [])),
+            "after": len(new_assignments[annotator_name]),
+            "quota": quota,
+        }
+    return {name: new_assignments[name] for name in quotas}, report
+
+
+def lazy_cluster_key(near_duplicates, filenames):
+    """A cluster_key for plan_rebalance() from a NearDuplicateIndex. filenames are only
+    hashed and clustered the first time a key is asked for, i.e. when something needs placing."""
+    cluster_ids = {}
+
+    def cluster_key(filename):
+        if not cluster_ids:
+            near_duplicates.update(filenames)
+            for i, cluster in enumerate(near_duplicates.clusters(sorted(filenames))):
+                for name in cluster:
+                    cluster_ids[name] = i
+        return cluster_ids.get(filename, filename)
+    return cluster_key
+
+
+def report_changed(report):
+    return bool(report["removed_files"] or report["released_files"] or report["removed_annotators"]
+                or report["new_annotators"] or report["placed"])
+
+
+def format_report(report):
+    lines = [
+        f"Removed files: {len(report['removed_files'])}, released: {len(report['released_files'])}, "
+        f"newly placed: {sum(len(v) for v in report['placed'].values())}, "
+        f"left unassigned (no capacity): {len(report['unassigned'])}",
+    ]
+    if report["removed_annotators"]:
+        lines.append(f"Removed annotators: {', '.join(report['removed_annotators'])}")
+    if report["new_annotators"]:
+        lines.append(f"New annotators: {', '.join(report['new_annotators'])}")
+    for annotator_name, counts in report["counts"].items():
+        placed = len(report["placed"].get(annotator_name, []))
+        lines.append(f"  {annotator_name}: {counts['before']} -> {counts['after']} "
+                     f"(quota {counts['quota']}, +{placed} placed)")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_layout_arguments(parser)
+    parser.add_argument('--db', default='annotation_state.db', help='State database used by app_v1')
+    parser.add_argument('--assignments', help='Read/write a legacy assignments.json instead of --db')
+    parser.add_argument('--quotas', help='JSON object of annotator -> quota (default: the current quotas)')
+    parser.add_argument('--index-file', default='image_hashes.json', help='Near-duplicate index used by app_v1')
+    parser.add_argument('--max-distance', type=int, default=10, help='Near-duplicate max differing bits out of 64')
+    parser.add_argument('--max-quota-overflow', type=int, default=5,
+                        help='How far over quota a near-duplicate cluster may take an annotator')
+    parser.add_argument('--apply', action='store_true', help='Write the result back to the assignments file')
+    args = parser.parse_args()
+
+    store = None
+    known_files = None
+    if args.assignments:
+        with open(args.assignments, 'r') as f:
+            assignments = json.load(f)
+        current_quotas = {k: len(v) for k, v in assignments.items()}
+    else:
+        from state_store import StateStore
+        store = StateStore(args.db)
+        assignments = store.load_assignments()
+        current_quotas = store.quotas()
+        known_files = store.known_images()
+    quotas = json.loads(args.quotas) if args.quotas else current_quotas
+
+    layout = layout_from_args(args)
+    current_files = [entry.name for entry in layout.iter_originals()]
+    if not current_files:
+        # Almost certainly the wrong layout options; planning on this would drop every assignment
+        print(f"No originals found in {', '.join(layout.original_roots)} (check --shard-levels / --source-dir).")
+        return
+
+    def is_started(filename):
+        base = os.path.splitext(filename)[0]
+        return os.path.exists(layout.annotation_path(base + '.xcf')) \
+            or os.path.exists(layout.annotation_path(base + '_mask.png'))
+
+    from dedup_index import NearDuplicateIndex
+    cluster_key = lazy_cluster_key(NearDuplicateIndex(args.index_file, layout, args.max_distance), current_files)
+    new_assignments, report = plan_rebalance(assignments, current_files, quotas, is_started=is_started,
+                                             cluster_key=cluster_key, previous_quotas=current_quotas,
+                                             known_files=known_files, max_cluster_overflow=args.max_quota_overflow)
+    print(format_report(report))
+    if args.apply:
+        if store is not None:
+            store.replace_assignments(new_assignments, quotas)
+        else:
+            with open(args.assignments, 'w') as f:
+                json.dump(new_assignments, f, indent=4)
+        print(f"Saved rebalanced assignments to {args.assignments or args.db}")
+    else:
+        print("Dry run: nothing written (use --apply to save).")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""Micro-benchmark: mask_kernels vs. the original overlay/binarization code.
+
+Times the binary-mask and overlay kernels on synthetic 5/20/80 megapixel
+inputs and reports wall time (best of --repeat runs) and peak memory. Both
+paths start from the same 3-channel mask and include binarization; decoding
+is excluded unless --with-io is given, in which case the inputs are written
+as PNGs and both paths include reading them (where the kernels' decode
+straight to grayscale shows). Every case runs in its own process and its
+memory is the growth of peak RSS while it runs, so OpenCV's native buffers
+(invisible to tracemalloc) are counted.
+
+    python benchmarks/bench_overlay_kernels.py --sizes 5 20 --json kernels.json
+"""
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import tempfile
+import multiprocessing
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mask_kernels import (MASK_THRESHOLD, binarize_inplace, fit_mask_to, overlay_inplace,  # noqa: E402
+                          read_binary_mask, render_overlay)
+
+
+# --- Implementation before mask_kernels (view_binary_mask_image / view_overlay_image) ---
+def legacy_binarize(mask_bgr):
+    gray = cv2.cvtColor(mask_bgr, cv2.COLOR_BGR2GRAY)
+    _, binary = cv2.threshold(gray, MASK_THRESHOLD, 255, cv2.THRESH_BINARY)
+    return binary
+
+
+def legacy_overlay(og_bgr, mask_bgr):
+    og_img = cv2.cvtColor(og_bgr, cv2.COLOR_BGR2RGB)
+    gray_mask = cv2.cvtColor(mask_bgr, cv2.COLOR_BGR2GRAY)
+    _, binary_mask_cv = cv2.threshold(gray_mask, MASK_THRESHOLD, 255, cv2.THRESH_BINARY)
+    if og_img.shape[:2] != binary_mask_cv.shape[:2]:
+        binary_mask_cv = cv2.resize(binary_mask_cv, (og_img.shape[1], og_img.shape[0]), interpolation=cv2.INTER_NEAREST)
+    color_mask = cv2.cvtColor(binary_mask_cv, cv2.COLOR_GRAY2RGB)
+    color_mask[np.where((color_mask == [255, 255, 255]).all(axis=2))] = [0, 0, 255]
+    overlay = cv2.addWeighted(og_img, 0.7, color_mask, 0.3, 0)
+    return cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR)
+
+
+def make_inputs(megapixels, seed=0):
+    """A noisy 4:3 'scan' and an RGB mask with a few filled strokes, like a GIMP export."""
+    width = int(round((megapixels * 1e6 * 4 / 3) ** 0.5))
+    height = int(round(megapixels * 1e6 / width))
+    rng = np.random.default_rng(seed)
+    original = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    mask = np.zeros((height, width, 3), dtype=np.uint8)
+    for i in range(20):
+        y = (i * height) // 20
+        cv2.line(mask, (width // 10, y), (width - width // 10, y), (255, 255, 255), max(2, height // 200))
+    return original, mask
+
+
+def kernel_binarize(mask_bgr):
+    return binarize_inplace(cv2.cvtColor(mask_bgr, cv2.COLOR_BGR2GRAY))
+
+
+def kernel_overlay(og_bgr, mask_bgr):
+    return overlay_inplace(og_bgr, fit_mask_to(kernel_binarize(mask_bgr), og_bgr.shape))
+
+
+CASES = ('binarize/legacy', 'binarize/kernel', 'overlay/legacy', 'overlay/kernel')
+
+
+def rss_bytes():
+    """Current resident set size (Linux), or None."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def reset_peak_rss():
+    """Resets the peak RSS to the current RSS (Linux 4.0+). Returns False where it cannot."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_bytes():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def make_work(name, megapixels, paths):
+    """A callable doing one run of the case, with its inputs prepared (untimed)."""
+    if paths is not None:
+        og_path, mask_path = paths
+        return {
+            'binarize/legacy': lambda: legacy_binarize(cv2.imread(mask_path)),
+            'binarize/kernel': lambda: read_binary_mask(mask_path),
+            'overlay/legacy': lambda: legacy_overlay(cv2.imread(og_path), cv2.imread(mask_path)),
+            'overlay/kernel': lambda: render_overlay(og_path, mask_path),
+        }[name]
+    original, mask = make_inputs(megapixels)
+    return {
+        'binarize/legacy': lambda: legacy_binarize(mask),
+        'binarize/kernel': lambda: kernel_binarize(mask),
+        'overlay/legacy': lambda: legacy_overlay(original, mask),
+        # overlay_inplace writes into the original, as the app does with its freshly decoded copy
+        'overlay/kernel': lambda: kernel_overlay(original, mask),
+    }[name]
+
+
+def measure(name, megapixels, repeat, paths):
+    """Runs in a fresh process per case. Returns (best_seconds, peak_rss_growth_bytes); the
+    latter is the lifetime peak RSS (an upper bound) where it cannot be reset."""
+    best = float('inf')
+    peak = 0
+    for _ in range(repeat):
+        work = make_work(name, megapixels, paths)
+        baseline = rss_bytes() if reset_peak_rss() else 0
+        start = time.perf_counter()
+        work()
+        elapsed = time.perf_counter() - start
+        peak = max(peak, peak_rss_bytes() - (baseline or 0))
+        best = min(best, elapsed)
+        del work
+    return best, peak
+
+
+def run_case(megapixels, repeat, with_io, tmp_dir):
+    paths = None
+    if with_io:
+        original, mask = make_inputs(megapixels)
+        paths = (os.path.join(tmp_dir, f'og_{megapixels}.png'), os.path.join(tmp_dir, f'mask_{megapixels}.png'))
+        cv2.imwrite(paths[0], original)
+        cv2.imwrite(paths[1], mask)
+        del original, mask
+
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name in CASES:
+        with context.Pool(1) as pool:
+            seconds, peak = pool.apply(measure, (name, megapixels, repeat, paths))
+        results[name] = {'seconds': seconds, 'peak_bytes': peak}
+        print(f"{megapixels:>4} MP  {name:<16} {seconds * 1000:9.1f} ms  {peak / 2**20:9.1f} MiB peak")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=float, nargs='+', default=[5, 20, 80], help='Megapixel sizes to run')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--with-io', action='store_true', help='Include PNG decoding in both paths')
+    parser.add_argument('--json', help='Write results to this file')
+    args = parser.parse_args()
+
+    report = {'with_io': args.with_io, 'repeat': args.repeat, 'results': {}}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for megapixels in args.sizes:
+            report['results'][f'{megapixels:g}MP'] = run_case(megapixels, args.repeat, args.with_io, tmp_dir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f"Wrote {args.json}")
+
+
+if __name__ == '__main__':
+    main()
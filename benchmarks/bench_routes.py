@@ -0,0 +1,244 @@
+"""Route benchmark on a synthetic IMAGES_BASE_DIR.
+
+For every scale (number of images) a fresh subprocess generates a dataset of
+N originals of --image-size pixels, masks and XCF stubs for --annotated of
+them and --annotators annotators with equal quotas, imports app_v1 on top of
+it and drives each route with the Flask test client. p50/p99 latency,
+throughput and process RSS per route are written as JSON so runs from
+different commits can be compared.
+
+    python benchmarks/bench_routes.py --scales 1000 10000 --output routes.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import shutil
+import tempfile
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def rss_bytes():
+    """Current resident set size of this process (Linux), or peak RSS elsewhere."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(q / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def generate_dataset(root, num_images, image_size, annotated_fraction, seed=0):
+    """Writes originals, masks and XCF stubs under root/images_train. Returns the filenames."""
+    import cv2
+    import numpy as np
+
+    images_dir = os.path.join(root, 'images_train')
+    os.makedirs(images_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    # Every original is shared noise under its own coarse 8x9 block pattern, so their
+    # difference hashes differ and the near-duplicate index sees no clusters (identical
+    # bytes would put the whole dataset in one cluster, i.e. on one annotator)
+    noise = rng.integers(0, 128, (image_size, image_size, 3), dtype=np.uint8)
+    # Encode one mask and reuse the bytes
+    mask = np.zeros((image_size, image_size, 3), dtype=np.uint8)
+    mask[image_size // 4: image_size // 2, image_size // 8: image_size - image_size // 8] = 255
+    _, mask_png = cv2.imencode('.png', mask)
+    xcf_stub = b'gimp xcf v011\x00' + bytes(1024)
+
+    random.seed(seed)
+    filenames = []
+    for i in range(num_images):
+        base = f'synthetic_{i:06d}'
+        filenames.append(base + '.png')
+        blocks = cv2.resize(rng.integers(0, 128, (8, 9, 3), dtype=np.uint8), (image_size, image_size),
+                            interpolation=cv2.INTER_NEAREST)
+        _, original_png = cv2.imencode('.png', noise + blocks)
+        with open(os.path.join(images_dir, base + '.png'), 'wb') as f:
+            f.write(original_png.tobytes())
+        if random.random() < annotated_fraction:
+            with open(os.path.join(images_dir, base + '_mask.png'), 'wb') as f:
+                f.write(mask_png.tobytes())
+            with open(os.path.join(images_dir, base + '.xcf'), 'wb') as f:
+                f.write(xcf_stub)
+    return filenames, mask_png.tobytes(), xcf_stub
+
+
+def time_route(name, make_request, num_requests):
+    """Issues num_requests requests; the first (cold) one is reported separately."""
+    latencies = []
+    statuses = {}
+    start = time.perf_counter()
+    for i in range(num_requests):
+        t0 = time.perf_counter()
+        response = make_request(i)
+        _ = response.get_data()  # Drain streamed bodies (ZIPs, files)
+        latencies.append(time.perf_counter() - t0)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        response.close()
+    elapsed = time.perf_counter() - start
+    warm = sorted(latencies[1:]) or sorted(latencies)
+    result = {
+        'requests': num_requests,
+        'status_codes': {str(code): count for code, count in statuses.items()},
+        'first_ms': latencies[0] * 1000,
+        'p50_ms': percentile(warm, 50) * 1000,
+        'p99_ms': percentile(warm, 99) * 1000,
+        'throughput_rps': num_requests / elapsed if elapsed else None,
+        'rss_bytes': rss_bytes(),
+    }
+    print(f"  {name:<24} p50 {result['p50_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms  "
+          f"{result['throughput_rps']:8.1f} req/s  rss {result['rss_bytes'] / 2**20:7.1f} MiB  {statuses}")
+    return result
+
+
+def run_single_scale(num_images, args):
+    """Runs inside the per-scale subprocess."""
+    work_dir = tempfile.mkdtemp(prefix=f'bench_routes_{num_images}_')
+    os.chdir(work_dir)
+    t0 = time.perf_counter()
+    filenames, mask_png, xcf_stub = generate_dataset(work_dir, num_images, args.image_size, args.annotated)
+    generation_seconds = time.perf_counter() - t0
+
+    sys.path.insert(0, REPO_DIR)
+    rss_before_import = rss_bytes()
+    t0 = time.perf_counter()
+    import app_v1
+    import_seconds = time.perf_counter() - t0
+    app_v1.startup_done.wait()
+    ready_seconds = time.perf_counter() - t0
+
+    # Equal synthetic quotas; reassign through the app's own code path
+    annotators = [f'annotator_{i:02d}' for i in range(args.annotators)]
+    quota = -(-num_images // args.annotators)
+    app_v1.ANNOTATOR_QUOTAS = {name: quota for name in annotators}
+    app_v1.create_new_assignments()
+    app_v1.status_index.rebuild()
+
+    annotator = annotators[0]
+    assigned = app_v1.state_store.assigned_images(annotator)
+    annotated = [f for f in assigned if app_v1.status_index.status(os.path.splitext(f)[0])[1]]
+    pick = random.Random(1)
+
+    def client():
+        # No cookies: flashed messages would otherwise pile up in the session
+        return app_v1.app.test_client(use_cookies=False)
+
+    # Different bytes for every upload: an identical re-upload is only hashed and discarded
+    # as unchanged, which is not the path being measured. Encoded here, outside the timing.
+    import cv2
+    import numpy as np
+    mask = cv2.imdecode(np.frombuffer(mask_png, np.uint8), cv2.IMREAD_COLOR)
+    upload_masks = []
+    for i in range(args.requests):
+        varied = mask.copy()
+        varied[(i // mask.shape[1]) % mask.shape[0], i % mask.shape[1]] = 128
+        upload_masks.append(cv2.imencode('.png', varied)[1].tobytes())
+
+    def upload(i):
+        target = pick.choice(assigned)
+        return client().post(f'/upload/{annotator}/{target}', content_type='multipart/form-data', data={
+            'xcf_file': (io.BytesIO(xcf_stub + str(i).encode('ascii')), 'work.xcf'),
+            'mask_file': (io.BytesIO(upload_masks[i]), 'work.png'),
+        })
+
+    routes = {
+        'index': lambda i: client().get('/'),
+        'annotator_page': lambda i: client().get(f'/annotator/{annotator}'),
+        'download_file': lambda i: client().get(f'/download/{annotator}/{pick.choice(assigned)}'),
+        'upload_files': upload,
+    }
+    if annotated:
+        for view in ('original', 'mask', 'binary_mask', 'overlay'):
+            routes[f'view_{view}'] = (lambda v: lambda i: client().get(
+                f'/view/{v}/{annotator}/{annotated[i % len(annotated)]}?max_dim=512'))(view)
+            routes[f'view_{view}_full'] = (lambda v: lambda i: client().get(
+                f'/view/{v}/{annotator}/{annotated[i % len(annotated)]}?full=1'))(view)
+
+    print(f"{num_images} images ({args.image_size}px), {len(assigned)} assigned to {annotator}, "
+          f"import {import_seconds:.2f}s")
+    results = {name: time_route(name, make_request, args.requests)
+               for name, make_request in routes.items()}
+
+    # Let post-processing jobs queued by the uploads finish before removing their files
+    deadline = time.time() + 120
+    while time.time() < deadline and any(job['status'] in ('queued', 'running')
+                                         for job in app_v1.postprocessing.all_statuses().values()):
+        time.sleep(0.2)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        'num_images': num_images,
+        'generation_seconds': generation_seconds,
+        'import_seconds': import_seconds,
+        'ready_seconds': ready_seconds,
+        'rss_before_import_bytes': rss_before_import,
+        'routes': results,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--image-size', type=int, default=256, help='Side length of synthetic originals')
+    parser.add_argument('--annotated', type=float, default=0.5, help='Fraction of images with mask + XCF')
+    parser.add_argument('--annotators', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=50, help='Requests per route')
+    parser.add_argument('--output', default='bench_routes.json')
+    parser.add_argument('--single-scale', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--single-output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single_scale is not None:
+        result = run_single_scale(args.single_scale, args)
+        with open(args.single_output, 'w') as f:
+            json.dump(result, f)
+        return
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {k: v for k, v in vars(args).items() if not k.startswith('single')},
+        'scales': {},
+    }
+    for num_images in args.scales:
+        # A fresh process per scale: app_v1 scans its directory at start-up, and RSS stays comparable
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as tmp:
+            single_output = tmp.name
+        cmd = [sys.executable, os.path.abspath(__file__), '--single-scale', str(num_images),
+               '--single-output', single_output, '--image-size', str(args.image_size),
+               '--annotated', str(args.annotated), '--annotators', str(args.annotators),
+               '--requests', str(args.requests)]
+        subprocess.run(cmd, check=True)
+        with open(single_output) as f:
+            report['scales'][str(num_images)] = json.load(f)
+        os.remove(single_output)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
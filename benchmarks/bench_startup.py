@@ -0,0 +1,125 @@
+"""Start-up time benchmark on a synthetic IMAGES_BASE_DIR.
+
+For every scale a dataset of N originals (plus masks and XCF stubs, see
+bench_routes.py) is generated and app_v1 is imported in fresh processes:
+
+  import_seconds   until `import app_v1` returns, i.e. the server could accept connections
+  ready_seconds    until the background warm-up (scan, rebalance, status index) is done
+  cold / restart   first start on the directory (assignments and hashes created) and a
+                   start with the state from that run, as after a deploy
+
+It also times the pieces that used to run before the first request: importing
+OpenCV and NumPy, and listing the directory the old way (listdir + isfile per
+file) against get_image_files' single scandir pass.
+
+    python benchmarks/bench_startup.py --scales 1000 10000 --output startup.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+
+from bench_routes import REPO_DIR, generate_dataset, git_commit
+
+CHILD_SCRIPT = """
+import sys, time, json
+sys.path.insert(0, {repo!r})
+sys.path.insert(0, {benchmarks!r})
+t0 = time.perf_counter()
+import app_v1
+import_seconds = time.perf_counter() - t0
+heavy_loaded_at_import = {{name: name in sys.modules for name in ('cv2', 'numpy')}}
+app_v1.startup_done.wait()
+ready_seconds = time.perf_counter() - t0
+
+from bench_startup import best_of, listdir_isfile
+listing = {{'listdir_isfile': best_of(lambda: listdir_isfile(app_v1.IMAGES_BASE_DIR), {repeats}),
+            'scandir': best_of(lambda: app_v1.get_image_files(), {repeats})}}
+print(json.dumps({{'import_seconds': import_seconds, 'ready_seconds': ready_seconds,
+                  'heavy_modules_loaded_at_import': heavy_loaded_at_import,
+                  'warm_up_steps': app_v1.startup['steps'], 'error': app_v1.startup['error'],
+                  'listing_seconds': listing}}))
+"""
+
+HEAVY_IMPORT_SCRIPT = """
+import time
+t0 = time.perf_counter()
+import numpy, cv2
+print(time.perf_counter() - t0)
+"""
+
+
+def run_child(script, cwd):
+    output = subprocess.run([sys.executable, '-c', script], cwd=cwd, check=True,
+                            capture_output=True, text=True).stdout
+    return output.strip().splitlines()[-1]
+
+
+def listdir_isfile(directory):
+    """The directory listing as get_image_files did it before: a stat() per entry."""
+    valid_image_extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff'}
+    return [f for f in os.listdir(directory)
+            if os.path.isfile(os.path.join(directory, f)) and os.path.splitext(f)[1].lower() in valid_image_extensions
+            and '_mask' not in f and not f.startswith('.')]
+
+
+def best_of(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t0)
+    return min(timings)
+
+
+def run_scale(num_images, args):
+    work_dir = tempfile.mkdtemp(prefix=f'bench_startup_{num_images}_')
+    try:
+        generate_dataset(work_dir, num_images, args.image_size, args.annotated)
+
+        script = CHILD_SCRIPT.format(repo=REPO_DIR, benchmarks=os.path.dirname(os.path.abspath(__file__)),
+                                     repeats=args.repeats)
+        cold = json.loads(run_child(script, work_dir))
+        restart = min((json.loads(run_child(script, work_dir)) for _ in range(args.repeats)),
+                      key=lambda r: r['ready_seconds'])
+        listing = restart['listing_seconds']
+        print(f"{num_images} images: import {restart['import_seconds']:.3f}s, ready {restart['ready_seconds']:.3f}s "
+              f"(cold start ready {cold['ready_seconds']:.3f}s); listing {listing['listdir_isfile']:.4f}s "
+              f"with listdir+isfile vs {listing['scandir']:.4f}s with scandir")
+        return {'num_images': num_images, 'cold': cold, 'restart': restart}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--image-size', type=int, default=64, help='Side length of synthetic originals')
+    parser.add_argument('--annotated', type=float, default=0.5, help='Fraction of images with mask + XCF')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default='bench_startup.json')
+    args = parser.parse_args()
+
+    heavy_imports = [float(run_child(HEAVY_IMPORT_SCRIPT, REPO_DIR)) for _ in range(args.repeats)]
+    print(f"Importing numpy + cv2 (no longer on the start-up path): {min(heavy_imports):.3f}s")
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': vars(args),
+        'heavy_import_seconds': min(heavy_imports),
+        'scales': {str(n): run_scale(n, args) for n in args.scales},
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""Content-addressed storage and revision history for uploaded XCF and mask files.
+
+Every saved version of an annotation file is a blob named by its SHA-256
+(root/<first two hex digits>/<digest>), written once and made read-only, so
+identical content is stored once however often it is uploaded. The file in
+the annotation root (<base>.xcf, <base>_mask.png, see storage_layout.py)
+stays where every other part of the app expects it, as a hard link to the
+blob of its latest revision (a copy where the blob store is on another
+filesystem, or where another file already links to that blob); the
+revisions table in the state store lists which blob each version was.
+Linking sets the file's mtime to the time of the save, so everything keyed
+by mtime (status, QC, derived images, since= downloads) sees the change even
+when the content is an old blob.
+
+Uploads are hashed while they stream into the blob store; one that matches
+the current version is dropped without touching the annotation root, so it
+costs no write, post-processing or replication.
+"""
+import os
+import stat
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from storage_layout import as_layout
+
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class BlobStore:
+    """Immutable files named by the SHA-256 of their content."""
+
+    def __init__(self, root):
+        self.root = root
+        self._tmp_dir = os.path.join(root, '.tmp')
+        os.makedirs(self._tmp_dir, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def _commit(self, tmp_path, digest):
+        """Moves a fully written temp file into place unless the blob exists already."""
+        blob_path = self.path(digest)
+        if os.path.exists(blob_path):
+            os.remove(tmp_path)
+            return False
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH) # Also guards the hard links against in-place writes
+        os.replace(tmp_path, blob_path)
+        return True
+
+    def put_stream(self, stream):
+        """Stores what stream yields, hashing it on the way. Returns (digest, size, stored)
+        where stored is False if the blob existed already."""
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        digest, size = hashlib.sha256(), 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in iter(lambda: stream.read(COPY_BLOCK_SIZE), b''):
+                    digest.update(block)
+                    f.write(block)
+                    size += len(block)
+            return digest.hexdigest(), size, self._commit(tmp_path, digest.hexdigest())
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def put_file(self, path, digest=None, move=False):
+        """Stores the file at path (moved if move, else hard-linked or copied). digest may
+        be given if already known, e.g. from a chunked upload. Returns (digest, size, stored)."""
+        if digest is None:
+            digest = file_sha256(path)
+        size = os.path.getsize(path)
+        if self.exists(digest):
+            if move:
+                os.remove(path)
+            return digest, size, False
+        tmp_path = os.path.join(self._tmp_dir, f"{digest}.{os.getpid()}.{threading.get_ident()}")
+        if move:
+            shutil.move(path, tmp_path)
+        else:
+            try:
+                os.link(path, tmp_path)
+            except OSError:
+                shutil.copy2(path, tmp_path)
+        return digest, size, self._commit(tmp_path, digest)
+
+    def link(self, digest, dest_path):
+        """Atomically points dest_path at the blob, with the current time as its mtime.
+
+        A hard link, unless another file already links to the blob (the shared
+        inode would make touching one touch both) or it is on another
+        filesystem; then a copy. A dest_path that is the blob already is left as is.
+        """
+        blob_path = self.path(digest)
+        try:
+            if os.path.samefile(dest_path, blob_path):
+                return
+        except OSError:
+            pass
+        dest_dir = os.path.dirname(dest_path)
+        os.makedirs(dest_dir, exist_ok=True)
+        tmp_path = os.path.join(dest_dir, f".{os.path.basename(dest_path)}.{os.getpid()}.{threading.get_ident()}.link")
+        try:
+            try:
+                if os.stat(blob_path).st_nlink > 1:
+                    raise OSError("blob is linked by another file")
+                os.link(blob_path, tmp_path)
+            except OSError:
+                shutil.copyfile(blob_path, tmp_path)
+            os.utime(tmp_path)
+            os.replace(tmp_path, dest_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def points_at(self, path, digest):
+        """True if path is (a link to, or an unmodified copy of) the blob. Copies are hashed."""
+        try:
+            if os.path.samefile(path, self.path(digest)):
+                return True
+            if os.path.getsize(path) != os.path.getsize(self.path(digest)):
+                return False
+            return file_sha256(path) == digest
+        except OSError:
+            return False
+
+
+def file_sha256(path):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+class RevisionStore:
+    """Revision history of the annotation files of a storage layout, on top of a BlobStore.
+
+    All methods return (revision, error_msg); revision is the state store's
+    revision dict, or None when nothing changed (an identical upload).
+    """
+
+    def __init__(self, store, blobs, layout):
+        self.store = store
+        self.blobs = blobs
+        self.layout = as_layout(layout)
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def _lock_for(self, filename):
+        with self._locks_guard:
+            return self._locks.setdefault(filename, threading.Lock())
+
+    def _current_path(self, filename):
+        return self.layout.annotation_path(filename)
+
+    def _import_existing(self, filename, kind):
+        """Files saved before the blob store existed become their first revision."""
+        path = self._current_path(filename)
+        if self.store.latest_revision(filename) is not None or not os.path.exists(path):
+            return
+        digest, size, _ = self.blobs.put_file(path)
+        self.blobs.link(digest, path)
+        self.store.add_revision(filename, kind, digest, size, method='import', created_at=os.path.getmtime(path))
+
+    def is_current(self, filename, digest):
+        """True if the file currently is digest, or was derived from it (a canonicalized mask)."""
+        latest = self.store.latest_revision(filename)
+        return (latest is not None and digest in (latest['sha256'], latest['source_sha256'])
+                and self.blobs.points_at(self._current_path(filename), latest['sha256']))
+
+    def _save(self, filename, kind, digest, size, annotator, method, source_sha256=None, relink=True):
+        if self.is_current(filename, digest):
+            return None, None
+        if relink:
+            self.blobs.link(digest, self._current_path(filename))
+        return self.store.add_revision(filename, kind, digest, size, annotator, method, source_sha256), None
+
+    def save_stream(self, filename, kind, stream, annotator=None, method=None):
+        """Stores an upload streamed from stream and makes it the current version."""
+        with self._lock_for(filename):
+            try:
+                self._import_existing(filename, kind)
+                digest, size, _ = self.blobs.put_stream(stream)
+                return self._save(filename, kind, digest, size, annotator, method)
+            except OSError as e:
+                return None, f"Could not store {filename}: {e}"
+
+    def save_file(self, filename, kind, path, annotator=None, method=None, digest=None):
+        """Moves the finished file at path (e.g. a chunked upload) into the store as the current version."""
+        with self._lock_for(filename):
+            try:
+                self._import_existing(filename, kind)
+                digest, size, _ = self.blobs.put_file(path, digest, move=True)
+                return self._save(filename, kind, digest, size, annotator, method)
+            except OSError as e:
+                return None, f"Could not store {filename}: {e}"
+
+    def adopt(self, filename, kind, method, source_sha256=None):
+        """Records the file as it is now on disk (e.g. just rewritten by canonicalization).
+        The file itself is left alone, so its mtime stays the one QC was recorded with."""
+        with self._lock_for(filename):
+            try:
+                digest, size, _ = self.blobs.put_file(self._current_path(filename))
+                return self._save(filename, kind, digest, size, None, method, source_sha256, relink=False)
+            except OSError as e:
+                return None, f"Could not store {filename}: {e}"
+
+    def restore(self, filename, revision_id, annotator=None):
+        """Makes an earlier revision the current version again (recorded as a new revision)."""
+        revision = self.store.get_revision(revision_id)
+        if revision is None or revision['filename'] != filename:
+            return None, "Unknown revision."
+        if not self.blobs.exists(revision['sha256']):
+            return None, "The stored file of this revision is missing."
+        with self._lock_for(filename):
+            try:
+                return self._save(filename, revision['kind'], revision['sha256'], revision['size'], annotator,
+                                  'restore', revision['source_sha256'])
+            except OSError as e:
+                return None, f"Could not restore {filename}: {e}"
+
+    def history(self, filename):
+        return self.store.revisions(filename)
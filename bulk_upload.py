@@ -0,0 +1,208 @@
+"""Bulk upload of annotation files from a ZIP or tar archive.
+
+Every member named <base>.xcf or <base>_mask.png (in any folder of the
+archive) is matched to the annotator's assigned image <base>.<ext>. Tar
+archives (plain, gz, bz2 or xz) are read as a stream, member by member. A
+ZIP's index sits at its end, so a ZIP that does not arrive in a seekable
+file (form uploads do; werkzeug spools them) is first copied to a temporary
+file as it is. Nothing is extracted as a whole: each matched member is read
+into a spooled buffer (in memory up to spool_bytes) and handed to a thread
+pool that stores it while the next member is read, with at most max_pending
+members buffered at a time.
+"""
+import time
+import zlib
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import posixpath
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# Per-member outcome in the report
+ACCEPTED = 'accepted'   # Stored as the new current version
+UNCHANGED = 'unchanged' # Identical to the current version, nothing written
+REJECTED = 'rejected'   # Named like an annotation file of an assigned image, but not stored
+UNMATCHED = 'unmatched' # Not named after any of the annotator's images
+MEMBER_STATUSES = (ACCEPTED, UNCHANGED, REJECTED, UNMATCHED)
+
+ZIP_MAGICS = (b'PK\x03\x04', b'PK\x05\x06') # A ZIP with members, an empty ZIP
+ARCHIVE_ERRORS = (tarfile.TarError, zipfile.BadZipFile, zlib.error, EOFError, OSError, ValueError)
+# Reading one member can also fail on encryption or an unsupported compression method
+MEMBER_ERRORS = ARCHIVE_ERRORS + (RuntimeError, NotImplementedError)
+
+
+class _PrefixedStream:
+    """A non-seekable stream whose first bytes were already read to tell its format."""
+
+    def __init__(self, head, stream):
+        self._head = head
+        self._stream = stream
+
+    def read(self, size=-1):
+        if not self._head:
+            return self._stream.read(size)
+        if size is None or size < 0:
+            data, self._head = self._head + self._stream.read(), b''
+            return data
+        data, self._head = self._head[:size], self._head[size:]
+        if len(data) < size:
+            data += self._stream.read(size - len(data))
+        return data
+
+
+def _is_seekable(stream):
+    try:
+        return stream.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+
+def iter_archive(stream):
+    """Yields (member name, size, file object) for the regular files of the ZIP or tar
+    archive read from stream. Each file object is only valid until the next member is
+    requested. Raises ValueError if stream holds neither, and one of ARCHIVE_ERRORS if
+    the archive turns out to be damaged."""
+    seekable = _is_seekable(stream)
+    head = stream.read(4)
+    if seekable:
+        stream.seek(0)
+    else:
+        stream = _PrefixedStream(head, stream)
+
+    if head.startswith(ZIP_MAGICS):
+        spool = None
+        if not seekable:
+            spool = tempfile.TemporaryFile()
+            shutil.copyfileobj(stream, spool, COPY_BLOCK_SIZE)
+            spool.seek(0)
+        try:
+            with zipfile.ZipFile(spool or stream) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        continue
+                    with archive.open(info) as member:
+                        yield info.filename, info.file_size, member
+        finally:
+            if spool is not None:
+                spool.close()
+        return
+
+    try:
+        archive = tarfile.open(fileobj=stream, mode='r|*')
+    except tarfile.ReadError:
+        raise ValueError("Not a ZIP or tar archive.")
+    with archive:
+        for info in archive:
+            if info.isfile():
+                yield info.name, info.size, archive.extractfile(info)
+
+
+def match_member(name, xcf_extensions, mask_extensions):
+    """(base, kind, target filename, error_msg) for an archive member, from its file name
+    alone: <base>.xcf is the XCF and <base>_mask.<ext> the mask of image <base>. error_msg
+    is set for a mask of a type that cannot be stored; None for anything else."""
+    filename = posixpath.basename(name.replace('\\', '/'))
+    stem, dot, ext = filename.rpartition('.')
+    ext = ext.lower()
+    if not dot or not stem:
+        return None
+    if stem.endswith('_mask'):
+        base = stem[:-len('_mask')]
+        if ext not in mask_extensions:
+            return base, 'mask', None, f"Masks must be {', '.join(sorted(mask_extensions))} files."
+        return base, 'mask', f"{base}_mask.{ext}", None
+    if ext in xcf_extensions:
+        return stem, 'xcf', f"{stem}.{ext}", None
+    return None
+
+
+def _is_hidden(name):
+    """Archivers' metadata (__MACOSX/, ._foo, .DS_Store) rather than files the annotator made."""
+    return any(part.startswith('.') or part == '__MACOSX' for part in name.replace('\\', '/').split('/') if part)
+
+
+def _store_member(save, entry, spool, start):
+    try:
+        revision, error_msg = save(entry['target'], entry['kind'], spool)
+    except Exception as e:
+        revision, error_msg = None, str(e)
+    finally:
+        spool.close()
+    if error_msg:
+        entry.update(status=REJECTED, message=error_msg)
+    elif revision is None:
+        entry.update(status=UNCHANGED, message="Identical to the current version.")
+    else:
+        entry.update(status=ACCEPTED, size=revision['size'], revision=revision['id'])
+    entry['seconds'] = round(time.perf_counter() - start, 3)
+
+
+def ingest_archive(stream, originals, save, xcf_extensions, mask_extensions, max_workers=4, max_pending=8,
+                   spool_bytes=16 * 1024 * 1024, max_member_bytes=None):
+    """Matches the members of the archive in stream against originals ({base: original
+    filename}) and stores the matched ones through save(target, kind, fileobj), which
+    returns (revision, error_msg) like RevisionStore.save_stream.
+
+    Returns (report, error_msg): one dict per visible member, in archive order, with
+    member, status (one of MEMBER_STATUSES), original, target, kind and message; stored
+    members also carry size and revision. error_msg is set if the archive could not be
+    read (to the end); the members before that point are still reported and stored.
+    """
+    report, error_msg = [], None
+    targets = set()
+    pending = set()
+    members = iter_archive(stream)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bulk-upload') as pool:
+        while True:
+            try:
+                member = next(members, None)
+            except ARCHIVE_ERRORS as e:
+                error_msg = (str(e) if not report else
+                             f"The archive could not be read past member {len(report)}: {e}")
+                break
+            if member is None:
+                break
+            name, size, fileobj = member
+            if _is_hidden(name):
+                continue
+            entry = {"member": name, "status": UNMATCHED, "original": None, "target": None, "kind": None,
+                     "message": None}
+            report.append(entry)
+
+            match = match_member(name, xcf_extensions, mask_extensions)
+            if match is None:
+                entry['message'] = "Not named <image>.xcf or <image>_mask.png."
+                continue
+            base, kind, target, match_error = match
+            if base not in originals:
+                entry['message'] = f"No image named '{base}' is assigned to you."
+                continue
+            entry.update(original=originals[base], target=target, kind=kind, status=REJECTED)
+            if match_error:
+                entry['message'] = match_error
+                continue
+            if target in targets:
+                entry['message'] = f"Another member of the archive already provides '{target}'."
+                continue
+            if max_member_bytes is not None and size > max_member_bytes:
+                entry['message'] = f"Larger than the {max_member_bytes // (1024 * 1024)} MB limit."
+                continue
+            targets.add(target)
+
+            start = time.perf_counter()
+            spool = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+            try:
+                shutil.copyfileobj(fileobj, spool, COPY_BLOCK_SIZE)
+            except MEMBER_ERRORS as e:
+                spool.close()
+                entry['message'] = f"Could not read this member: {e}"
+                continue
+            spool.seek(0)
+            if len(pending) >= max_pending:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            pending.add(pool.submit(_store_member, save, entry, spool, start))
+        members.close()
+    return report, error_msg
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class ChunkedUploadManager:
+    """Resumable uploads written straight into a hidden temp file next to their destination.
+
+    Each session lives as two files in upload_dir: `.upload_<id>.part` with the
+    bytes received so far and `.upload_<id>.json` with its metadata, so a
+    session survives a server restart. The server owns the offset: a chunk is
+    only accepted at the current end of the part file. Completing a session
+    renames the part file onto the destination, which is atomic because both
+    live in the same directory.
+    """
+
+    def __init__(self, upload_dir, expiry_seconds=2 * 24 * 3600):
+        self.upload_dir = upload_dir
+        self.expiry_seconds = expiry_seconds
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        # upload_id -> (offset, sha256 object) for sessions hashed continuously by this process
+        self._running_hashes = {}
+
+    def _part_path(self, upload_id):
+        return os.path.join(self.upload_dir, f".upload_{upload_id}.part")
+
+    def _meta_path(self, upload_id):
+        return os.path.join(self.upload_dir, f".upload_{upload_id}.json")
+
+    def _lock_for(self, upload_id):
+        with self._locks_guard:
+            return self._locks.setdefault(upload_id, threading.Lock())
+
+    def _save_meta(self, session):
+        tmp_path = self._meta_path(session['upload_id']) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(session, f)
+        os.replace(tmp_path, self._meta_path(session['upload_id']))
+
+    def create(self, target_filename, total_size, sha256=None, **extra):
+        """Starts a session for target_filename (relative to upload_dir). Returns the session dict."""
+        upload_id = uuid.uuid4().hex
+        session = {
+            'upload_id': upload_id,
+            'target': target_filename,
+            'size': int(total_size),
+            'sha256': sha256.lower() if sha256 else None,
+            'offset': 0,
+            'created': time.time(),
+        }
+        session.update(extra)
+        open(self._part_path(upload_id), 'wb').close()
+        self._save_meta(session)
+        self._running_hashes[upload_id] = (0, hashlib.sha256())
+        return session
+
+    def get(self, upload_id):
+        """Returns the session dict, or None for unknown/invalid ids."""
+        if not upload_id.isalnum():
+            return None
+        try:
+            with open(self._meta_path(upload_id), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def write_chunk(self, upload_id, offset, stream, chunk_sha256=None):
+        """Appends the bytes read from stream at offset. Returns (session, error_msg, http_status).
+
+        The chunk is streamed into the part file block by block while its
+        SHA-256 is computed; on a checksum mismatch the part file is truncated
+        back to where the chunk started.
+        """
+        with self._lock_for(upload_id):
+            session = self.get(upload_id)
+            if session is None:
+                return None, "Unknown upload session.", 404
+            if offset != session['offset']:
+                return session, f"Offset mismatch: server has {session['offset']} bytes.", 409
+
+            chunk_hash = hashlib.sha256()
+            running = self._running_hashes.get(upload_id)
+            if running and running[0] != offset:
+                running = None
+            written = 0
+            with open(self._part_path(upload_id), 'r+b') as f:
+                f.seek(offset)
+                while True:
+                    block = stream.read(COPY_BLOCK_SIZE)
+                    if not block:
+                        break
+                    written += len(block)
+                    if offset + written > session['size']:
+                        f.truncate(offset)
+                        self._running_hashes.pop(upload_id, None)
+                        return session, "Chunk extends past the declared file size.", 413
+                    f.write(block)
+                    chunk_hash.update(block)
+                    if running:
+                        running[1].update(block)
+
+                if chunk_sha256 and chunk_hash.hexdigest() != chunk_sha256.lower():
+                    f.truncate(offset)
+                    self._running_hashes.pop(upload_id, None)
+                    return session, "Chunk checksum mismatch.", 400
+
+            session['offset'] = offset + written
+            self._save_meta(session)
+            if running:
+                self._running_hashes[upload_id] = (session['offset'], running[1])
+            return session, None, 200
+
+    def _file_sha256(self, upload_id):
+        running = self._running_hashes.get(upload_id)
+        session = self.get(upload_id)
+        if running and session and running[0] == session['offset']:
+            return running[1].hexdigest()
+        # The session was resumed in another process (or after a restart): hash the part file once
+        file_hash = hashlib.sha256()
+        with open(self._part_path(upload_id), 'rb') as f:
+            for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+                file_hash.update(block)
+        return file_hash.hexdigest()
+
+    def complete(self, upload_id, deliver=None):
+        """Moves a fully received upload onto its target. Returns (session, error_msg, http_status).
+
+        deliver(session, part_path, sha256), if given, takes the finished file over
+        instead of the rename and returns an error message or None; on an error the
+        session is kept, so completing can be retried.
+        """
+        with self._lock_for(upload_id):
+            session = self.get(upload_id)
+            if session is None:
+                return None, "Unknown upload session.", 404
+            if session['offset'] != session['size']:
+                return session, f"Upload incomplete: {session['offset']} of {session['size']} bytes received.", 409
+            sha256 = self._file_sha256(upload_id) if session['sha256'] or deliver else None
+            if session['sha256'] and sha256 != session['sha256']:
+                return session, "File checksum mismatch.", 400
+            if deliver is not None:
+                error_msg = deliver(session, self._part_path(upload_id), sha256)
+                if error_msg:
+                    return session, error_msg, 500
+            else:
+                os.replace(self._part_path(upload_id), os.path.join(self.upload_dir, session['target']))
+            os.remove(self._meta_path(upload_id))
+            self._running_hashes.pop(upload_id, None)
+            return session, None, 200
+
+    def abort(self, upload_id):
+        with self._lock_for(upload_id):
+            for path in (self._part_path(upload_id), self._meta_path(upload_id)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._running_hashes.pop(upload_id, None)
+
+    def purge_expired(self):
+        """Removes sessions that have not been completed within expiry_seconds."""
+        now = time.time()
+        try:
+            names = os.listdir(self.upload_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.startswith('.upload_') and name.endswith('.json'):
+                upload_id = name[len('.upload_'):-len('.json')]
+                session = self.get(upload_id)
+                if session and now - session.get('created', now) > self.expiry_seconds:
+                    print(f"Removing expired upload session {upload_id} for {session['target']}")
+                    self.abort(upload_id)
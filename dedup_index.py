@@ -0,0 +1,180 @@
+"""Perceptual-hash index for spotting near-duplicate images (re-scans, re-exports).
+
+Run directly to hash new/changed images and print the clusters found:
+
+    python dedup_index.py ./images_train/ --max-distance 10
+"""
+import os
+import json
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from lazy_imports import cv2, np
+from storage_layout import as_layout, add_layout_arguments, layout_from_args
+
+
+def dhash_file(path):
+    """64-bit difference hash of an image file as an int, or None if it cannot be read.
+
+    The image is shrunk to 9x8 grayscale and each bit says whether a pixel is
+    brighter than its right-hand neighbour, which is stable under rescaling,
+    recompression and mild contrast changes.
+    """
+    img = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if img is None:
+        return None
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def _hash_job(args):
+    filename, path = args
+    return filename, dhash_file(path)
+
+
+def _popcount64(values):
+    """Number of set bits per element of a uint64 array."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    # NumPy < 2: per-byte table lookup, one byte per byte of input rather than one per bit
+    table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return table[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def hamming_pairs(hashes, max_distance, block_size=256, chunk_size=8192):
+    """Yields (i, j) index pairs (i < j) whose 64-bit hashes differ in at most max_distance bits.
+
+    Compares a block of rows against a chunk of the later hashes at a time with
+    XOR and popcount, so memory stays at block_size * chunk_size words however
+    many hashes there are.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n = len(hashes)
+    for start in range(0, n, block_size):
+        block = hashes[start:start + block_size]
+        for col_start in range(start, n, chunk_size):
+            distances = _popcount64(block[:, None] ^ hashes[None, col_start:col_start + chunk_size])
+            rows, cols = np.nonzero(distances <= max_distance)
+            for r, c in zip(rows.tolist(), cols.tolist()):
+                i, j = start + r, col_start + c
+                if j > i:
+                    yield i, j
+
+
+class NearDuplicateIndex:
+    """dHash per image, persisted to a JSON file and refreshed incrementally.
+
+    Entries remember the file's mtime and size; update() only re-hashes files
+    that are new or changed since the last run, using a process pool.
+    """
+
+    def __init__(self, index_file, layout, max_distance=10, max_workers=None):
+        self.index_file = index_file
+        self.layout = as_layout(layout)
+        self.max_distance = max_distance
+        self.max_workers = max_workers
+        self._entries = {}  # filename -> {"mtime": ..., "size": ..., "dhash": hex string or None}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            self._entries = {}
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Error loading near-duplicate index ({e}), rebuilding it.")
+            self._entries = {}
+
+    def _save(self):
+        tmp_path = self.index_file + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.index_file)
+        except IOError as e:
+            print(f"Error saving near-duplicate index: {e}")
+
+    def update(self, filenames):
+        """Hashes new or changed files among filenames and drops entries for the rest."""
+        with self._lock:
+            wanted = set(filenames)
+            stale = [name for name in self._entries if name not in wanted]
+            for name in stale:
+                del self._entries[name]
+
+            todo = []
+            stats = {}
+            for name in filenames:
+                try:
+                    path = self.layout.original_path(name)
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stats[name] = (st.st_mtime, st.st_size)
+                entry = self._entries.get(name)
+                if entry is None or (entry['mtime'], entry['size']) != stats[name]:
+                    todo.append((name, path))
+
+            if todo:
+                print(f"Hashing {len(todo)} new or changed images for near-duplicate detection...")
+                with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                    for name, value in pool.map(_hash_job, todo, chunksize=16):
+                        self._entries[name] = {
+                            "mtime": stats[name][0],
+                            "size": stats[name][1],
+                            "dhash": f"{value:016x}" if value is not None else None,
+                        }
+            if todo or stale:
+                self._save()
+            return len(todo)
+
+    def clusters(self, filenames):
+        """Groups filenames into near-duplicate clusters (connected components of
+        pairs within max_distance). Unhashed files form singleton clusters."""
+        with self._lock:
+            hashed = [name for name in filenames
+                      if self._entries.get(name, {}).get('dhash') is not None]
+            values = [int(self._entries[name]['dhash'], 16) for name in hashed]
+
+        parent = {name: name for name in filenames}
+
+        def find(name):
+            while parent[name] != name:
+                parent[name] = parent[parent[name]]
+                name = parent[name]
+            return name
+
+        for i, j in hamming_pairs(values, self.max_distance):
+            root_i, root_j = find(hashed[i]), find(hashed[j])
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+        groups = {}
+        for name in filenames:
+            groups.setdefault(find(name), []).append(name)
+        return sorted((sorted(group) for group in groups.values()), key=lambda group: group[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_layout_arguments(parser, positional=True)
+    parser.add_argument('--index-file', default='image_hashes.json')
+    parser.add_argument('--max-distance', type=int, default=10, help='Max differing bits out of 64')
+    args = parser.parse_args()
+
+    layout = layout_from_args(args)
+    filenames = sorted(entry.name for entry in layout.iter_originals())
+    index = NearDuplicateIndex(args.index_file, layout, args.max_distance)
+    index.update(filenames)
+    duplicates = [group for group in index.clusters(filenames) if len(group) > 1]
+    print(f"{len(duplicates)} near-duplicate clusters among {len(filenames)} images:")
+    for group in duplicates:
+        print("  - " + "\n    ".join(group))
+
+
+if __name__ == '__main__':
+    main()
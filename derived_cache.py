@@ -0,0 +1,92 @@
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class DerivedImageCache:
+    """Two-level cache for rendered images: a bounded in-memory LRU in front of a disk directory.
+
+    Entries are keyed on the kind of rendering, any extra parameters, and the
+    path, mtime and size of every source file, so a re-uploaded mask or original
+    produces a new key and stale renderings are simply never looked up again.
+    """
+
+    def __init__(self, cache_dir, max_memory_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def make_key(self, kind, source_paths, params=None):
+        """Returns (key, last_modified_timestamp) for a rendering of the given source files."""
+        parts = [kind]
+        last_modified = 0
+        for path in source_paths:
+            st = os.stat(path)
+            parts.append(f"{os.path.abspath(path)}:{st.st_mtime_ns}:{st.st_size}")
+            last_modified = max(last_modified, st.st_mtime)
+        if params:
+            parts.extend(f"{k}={params[k]}" for k in sorted(params))
+        key = hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+        return key, last_modified
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _remember(self, key, data):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            if len(data) > self.max_memory_bytes:
+                return
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        self._remember(key, data)
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file and rename so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Warning: could not write derived cache entry {key}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def get_or_create(self, key, render):
+        """Returns (data, error_msg); calls render() -> (data, error_msg) on a miss."""
+        data = self.get(key)
+        if data is not None:
+            return data, None
+        data, error_msg = render()
+        if data is not None:
+            self.put(key, data)
+        return data, error_msg
@@ -0,0 +1,83 @@
+import os
+import mimetypes
+from urllib.parse import quote
+
+from flask import Response, send_file
+
+OFFLOAD_MODES = (None, 'x-sendfile', 'x-accel')
+
+
+def file_version(mtime, size):
+    """Short version tag for a file from its mtime and size, used as the strong
+    ETag and as the ?v= parameter of versioned URLs."""
+    return f"{int(mtime * 1e6):x}-{size:x}"
+
+
+class FileServer:
+    """Serves original images and masks from disk.
+
+    Every response carries a strong ETag (file_version) and Last-Modified, so
+    browsers revalidate with If-None-Match and get 304s. Range and If-Range
+    requests let interrupted downloads resume. A URL whose ?v= matches the
+    file's current version names one exact content and is cached for
+    versioned_max_age with `immutable`; anything else must revalidate.
+
+    With offload_mode 'x-sendfile' (Apache/lighttpd) or 'x-accel' (nginx) the
+    response carries only headers, and the front-end server streams the file
+    (and handles Range) itself. In 'x-accel' mode, root is mapped onto
+    accel_prefix, which must be an `internal` nginx location aliasing root.
+    """
+
+    def __init__(self, root, offload_mode=None, accel_prefix='/protected/', versioned_max_age=365 * 24 * 3600):
+        if offload_mode not in OFFLOAD_MODES:
+            raise ValueError(f"offload_mode must be one of {OFFLOAD_MODES}, got {offload_mode!r}")
+        self.root = root
+        self.offload_mode = offload_mode
+        self.accel_prefix = accel_prefix.rstrip('/') + '/'
+        self.versioned_max_age = versioned_max_age
+
+    def version(self, path):
+        """file_version of path, or None if it does not exist."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return file_version(st.st_mtime, st.st_size)
+
+    def send(self, request, path, as_attachment=False, download_name=None):
+        """Returns the response for path, or None if the file does not exist."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        etag = file_version(st.st_mtime, st.st_size)
+        versioned = request.args.get('v') == etag
+        download_name = download_name or os.path.basename(path)
+
+        if self.offload_mode is None:
+            response = send_file(os.path.abspath(path), as_attachment=as_attachment, download_name=download_name,
+                                 conditional=True, etag=etag, last_modified=st.st_mtime)
+        else:
+            mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+            response = Response(mimetype=mimetype)
+            if as_attachment:
+                response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+            if self.offload_mode == 'x-sendfile':
+                response.headers['X-Sendfile'] = os.path.abspath(path)
+            else:
+                relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+                response.headers['X-Accel-Redirect'] = self.accel_prefix + quote(relative.replace(os.sep, '/'))
+            response.set_etag(etag)
+            response.last_modified = st.st_mtime
+            # Only 304s are answered here; ranges are left to the front-end server
+            response = response.make_conditional(request)
+
+        if versioned:
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = self.versioned_max_age
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.max_age = None
+            response.cache_control.no_cache = True
+        return response
@@ -0,0 +1,62 @@
+import gzip
+
+from lazy_imports import cv2
+from metrics import stage
+
+from mask_kernels import MASK_THRESHOLD, pack_binary_mask, read_binary_mask, read_image, render_overlay
+
+
+def encode_cv_image(cv_image, image_format_ext='.png'):
+    """Encodes an OpenCV image (NumPy array) to bytes, or returns None on failure."""
+    with stage('encode'):
+        is_success, buffer = cv2.imencode(image_format_ext, cv_image)
+    if is_success:
+        return buffer.tobytes()
+    return None
+
+def load_image(img_path):
+    """Reads an image from disk. Returns (cv_image, error_msg)."""
+    img = read_image(img_path)
+    if img is None:
+        return None, "Could not read image."
+    return img, None
+
+def load_binary_mask(mask_img_path):
+    """Thresholds a mask into a black/white image. Returns (cv_image, error_msg)."""
+    try:
+        binary = read_binary_mask(mask_img_path)
+        if binary is None:
+            return None, "Could not read mask image."
+        return binary, None
+
+    except Exception as e:
+        print(f"Error processing binary mask: {e}")
+        return None, f"Error generating binary mask: {e}"
+
+def load_overlay(original_img_path, mask_img_path):
+    """Blends the binarized mask (blue) over the original. Returns (cv_image, error_msg)."""
+    try:
+        return render_overlay(original_img_path, mask_img_path)
+
+    except Exception as e:
+        print(f"Error processing overlay: {e}")
+        return None, f"Error generating overlay: {e}"
+
+def render_png(loaded):
+    """Encodes the (cv_image, error_msg) result of a load_* helper. Returns (png_bytes, error_msg)."""
+    img, error_msg = loaded
+    if img is None:
+        return None, error_msg
+    data = encode_cv_image(img)
+    if data is None:
+        return None, "Error encoding image"
+    return data, None
+
+def render_packed_mask(mask_img_path, max_dim=None):
+    """Binarized mask as gzip-compressed pack_binary_mask() bytes. Returns (data, error_msg)."""
+    binary, error_msg = load_binary_mask(mask_img_path)
+    if binary is None:
+        return None, error_msg
+    with stage('encode'):
+        # mtime=0 keeps the output identical for identical masks
+        return gzip.compress(pack_binary_mask(binary, max_dim), compresslevel=6, mtime=0), None
@@ -0,0 +1,174 @@
+import os
+import json
+
+from lazy_imports import cv2
+from metrics import stage
+from mask_kernels import read_image
+
+# format name -> (extension for cv2.imencode, mimetype, (cv2 encode flag name, value)).
+# Flags are looked up by name so importing this module does not load OpenCV.
+PREVIEW_FORMATS = {
+    'webp': ('.webp', 'image/webp', ('IMWRITE_WEBP_QUALITY', 80)),
+    'jpeg': ('.jpg', 'image/jpeg', ('IMWRITE_JPEG_QUALITY', 85)),
+    'png': ('.png', 'image/png', ('IMWRITE_PNG_COMPRESSION', 3)),
+}
+
+
+def negotiate_format(accept_mimetypes, lossless=False):
+    """Picks a preview format from the request's Accept header.
+
+    WebP is preferred whenever the browser advertises it (lossless WebP for
+    binary images); otherwise JPEG, or PNG when lossless output is needed.
+    """
+    if accept_mimetypes.quality('image/webp') > 0 and 'image/webp' in accept_mimetypes.values():
+        return 'webp_lossless' if lossless else 'webp'
+    return 'png' if lossless else 'jpeg'
+
+
+def _format_spec(fmt):
+    if fmt == 'webp_lossless':
+        # A WebP quality above 100 selects lossless mode
+        return '.webp', 'image/webp', [cv2.IMWRITE_WEBP_QUALITY, 101]
+    ext, mimetype, (flag, value) = PREVIEW_FORMATS[fmt]
+    return ext, mimetype, [getattr(cv2, flag), value]
+
+
+# Only these decode at reduced scale without a full decode first (OpenCV scales the JPEG DCT);
+# every other format is decoded at full size and then shrunk
+REDUCED_DECODE_EXTENSIONS = {'.jpg', '.jpeg'}
+
+
+def has_cheap_reduced_decode(path):
+    return os.path.splitext(path)[1].lower() in REDUCED_DECODE_EXTENSIONS
+
+
+def preview_mimetype(fmt):
+    return _format_spec(fmt)[1]
+
+
+def render_thumbnail(path, max_dim, fmt):
+    """A preview no larger than max_dim from a reduced decode. Returns (data, error_msg).
+
+    The image is decoded at 1/8 scale. For a JPEG only that much of the DCT data
+    is decoded, a small fraction of a full decode; other formats (see
+    has_cheap_reduced_decode) pay for a full decode. Images too small for 1/8
+    scale to cover max_dim are decoded fully, which is cheap for them.
+    """
+    img = read_image(path, cv2.IMREAD_REDUCED_COLOR_8)
+    if img is not None and max(img.shape[:2]) < max_dim:
+        img = read_image(path)
+    if img is None:
+        return None, "Could not read image."
+    height, width = img.shape[:2]
+    if max(width, height) > max_dim:
+        scale = max_dim / float(max(width, height))
+        with stage('resize'):
+            img = cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                             interpolation=cv2.INTER_AREA)
+    ext, _, encode_params = _format_spec(fmt)
+    with stage('encode'):
+        is_success, buffer = cv2.imencode(ext, img, encode_params)
+    if not is_success:
+        return None, "Error encoding thumbnail"
+    return buffer.tobytes(), None
+
+
+def build_pyramid(img, min_dim=256, top_dim=2048):
+    """Returns [level0, level1, ...]; each level halves the previous one until the
+    longest side is at most min_dim. Level 0 is the image shrunk to fit top_dim
+    (the image itself if it fits): full size is served as is (?full=1), never
+    re-encoded as a preview."""
+    height, width = img.shape[:2]
+    if max(width, height) > top_dim:
+        scale = top_dim / float(max(width, height))
+        img = cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                         interpolation=cv2.INTER_AREA)
+    levels = [img]
+    while max(levels[-1].shape[:2]) > min_dim:
+        h, w = levels[-1].shape[:2]
+        levels.append(cv2.resize(levels[-1], (max(1, w // 2), max(1, h // 2)), interpolation=cv2.INTER_AREA))
+    return levels
+
+
+def choose_level(level_sizes, max_dim=None, level=None):
+    """Maps a request onto a pyramid level index.
+
+    level selects a level directly (clamped to the pyramid). max_dim is the
+    longest side the client will display; the smallest level that still covers
+    it is chosen, so the browser only ever scales down.
+    """
+    if level is not None:
+        return min(max(level, 0), len(level_sizes) - 1)
+    chosen = 0
+    for i, (w, h) in enumerate(level_sizes):
+        if max(w, h) >= max_dim:
+            chosen = i
+    return chosen
+
+
+def pyramid_key(cache, kind, source_paths, fmt):
+    """Returns (manifest_key, last_modified) identifying one pyramid in the cache."""
+    return cache.make_key(kind + ':pyramid', source_paths, {'fmt': fmt})
+
+
+def _level_key(cache, kind, source_paths, fmt, i):
+    return cache.make_key(kind + ':pyramid', source_paths, {'fmt': fmt, 'level': i})[0]
+
+
+def lookup_pyramid_level(cache, kind, source_paths, fmt, max_dim=None, level=None):
+    """Cache-only lookup. Returns (data, key, last_modified, mimetype); data is None on a miss."""
+    _, mimetype, _ = _format_spec(fmt)
+    manifest_key, last_modified = pyramid_key(cache, kind, source_paths, fmt)
+    manifest = cache.get(manifest_key)
+    if manifest is None:
+        return None, None, last_modified, mimetype
+    chosen = choose_level(json.loads(manifest), max_dim, level)
+    key = _level_key(cache, kind, source_paths, fmt, chosen)
+    return cache.get(key), key, last_modified, mimetype
+
+
+def encode_pyramid(img, fmt, min_dim=256, top_dim=2048):
+    """Encodes every level of build_pyramid(img) in fmt. Returns (level_sizes, encoded, error_msg)."""
+    ext, _, encode_params = _format_spec(fmt)
+    with stage('resize'):
+        levels = build_pyramid(img, min_dim, top_dim)
+    encoded = []
+    for lvl in levels:
+        with stage('encode'):
+            is_success, buffer = cv2.imencode(ext, lvl, encode_params)
+        if not is_success:
+            return None, None, "Error encoding preview image"
+        encoded.append(buffer.tobytes())
+    return [(lvl.shape[1], lvl.shape[0]) for lvl in levels], encoded, None
+
+
+def store_pyramid(cache, kind, source_paths, fmt, level_sizes, encoded):
+    """Puts the levels from encode_pyramid() in the cache, then the manifest that makes them visible."""
+    for i, data in enumerate(encoded):
+        cache.put(_level_key(cache, kind, source_paths, fmt, i), data)
+    manifest_key, _ = pyramid_key(cache, kind, source_paths, fmt)
+    cache.put(manifest_key, json.dumps(level_sizes).encode('utf-8'))
+
+
+def get_pyramid_level(cache, kind, source_paths, fmt, load_image, max_dim=None, level=None, min_dim=256,
+                      top_dim=2048):
+    """Returns (data, key, last_modified, mimetype, error_msg) for one preview level.
+
+    The whole pyramid for (kind, sources, fmt) is built and stored in the derived
+    cache the first time any level is requested; afterwards every level is a
+    cache lookup. load_image() -> (cv_image, error_msg) decodes the full-size image.
+    """
+    data, key, last_modified, mimetype = lookup_pyramid_level(cache, kind, source_paths, fmt, max_dim, level)
+    if data is not None:
+        return data, key, last_modified, mimetype, None
+
+    img, error_msg = load_image()
+    if img is None:
+        return None, None, last_modified, mimetype, error_msg
+
+    level_sizes, encoded, error_msg = encode_pyramid(img, fmt, min_dim, top_dim)
+    if error_msg:
+        return None, None, last_modified, mimetype, error_msg
+    store_pyramid(cache, kind, source_paths, fmt, level_sizes, encoded)
+    chosen = choose_level(level_sizes, max_dim, level)
+    return encoded[chosen], _level_key(cache, kind, source_paths, fmt, chosen), last_modified, mimetype, None
@@ -0,0 +1,37 @@
+"""Deferred imports of the heavy numerical modules.
+
+Importing OpenCV and NumPy takes a large share of app start-up, yet only
+the image processing routes and workers need them. Modules do
+
+    from lazy_imports import cv2, np
+
+and use them as usual; the real import happens on the first attribute
+access (e.g. the first cv2.imread), so importing app_v1 stays cheap.
+"""
+import importlib
+
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        # Only called for attributes not found on the proxy itself
+        if self._module is None:
+            # importlib serialises concurrent first imports with its module locks
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r} ({'loaded' if self.loaded else 'not loaded'})>"
+
+
+cv2 = LazyModule('cv2')
+np = LazyModule('numpy')
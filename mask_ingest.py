@@ -0,0 +1,183 @@
+"""Canonical storage for uploaded masks.
+
+Annotators export masks as full 3-channel PNGs, of which only "brighter than
+MASK_THRESHOLD" matters. After QC has looked at the upload as it is, the
+post-processing worker replaces it with a canonical mask: 1-bit grayscale
+PNG, thresholded, at the original's dimensions. The upload itself is kept
+in the archive directory as <mask name>.<upload time><ext>. Later reads
+decode one bit per pixel instead of three channels, and the files (and
+their NAS mirror) shrink accordingly.
+
+Run directly to convert the masks already in the image directory, in
+parallel; QC is computed from the raw files on the way, so it is not lost:
+
+    python mask_ingest.py --images-dir ./images_train/ --archive-dir ./mask_archive/ --db annotation_state.db
+"""
+import os
+import time
+import shutil
+import struct
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from lazy_imports import cv2
+from metrics import stage
+from mask_kernels import binarize_inplace, fit_mask_to, read_image
+from mask_qc import compute_mask_qc
+from storage_layout import as_layout, add_layout_arguments, layout_from_args
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def png_header(path):
+    """(width, height, bit depth, color type) from a PNG's IHDR chunk, or None if it is not a PNG."""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(26)
+    except OSError:
+        return None
+    if len(head) < 26 or head[:8] != PNG_SIGNATURE or head[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>IIBB', head[16:26])
+
+
+def is_canonical(path, shape=None):
+    """True if path is a 1-bit grayscale PNG (of shape (height, width), if given). Reads 26 bytes."""
+    header = png_header(path)
+    if header is None:
+        return False
+    width, height, bit_depth, color_type = header
+    return bit_depth == 1 and color_type == 0 and (shape is None or (height, width) == tuple(shape[:2]))
+
+
+def archive_path(archive_dir, mask_path, raw_st):
+    name, ext = os.path.splitext(os.path.basename(mask_path))
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(raw_st.st_mtime))
+    return os.path.join(archive_dir, f"{name}.{stamp}{ext}")
+
+
+def _archive(mask_path, target):
+    """Keeps the file at mask_path under target as well: a hard link where possible, else a copy."""
+    if os.path.exists(target):
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(mask_path, target)
+    except OSError:
+        shutil.copy2(mask_path, target)
+
+
+def store_canonical(mask_path, binary, original_shape, raw_st, archive_dir=None):
+    """Replaces the mask file with the canonical encoding of binary (a 0/255 mask
+    thresholded from it), fitted to original_shape.
+
+    raw_st is the os.stat() of the file binary was decoded from; if the file has
+    changed since (a newer upload) it is left alone. The replaced file is kept
+    in archive_dir unless that is None. Returns (fitted_binary, new_stat, error_msg).
+    """
+    binary = fit_mask_to(binary, original_shape)
+    with stage('encode'):
+        is_success, buffer = cv2.imencode('.png', binary, [cv2.IMWRITE_PNG_BILEVEL, 1,
+                                                           cv2.IMWRITE_PNG_COMPRESSION, 9])
+    if not is_success:
+        return None, None, "Error encoding canonical mask"
+
+    tmp_path = os.path.join(os.path.dirname(mask_path), f".canonical_{os.getpid()}_{os.path.basename(mask_path)}")
+    try:
+        buffer.tofile(tmp_path)
+        st = os.stat(mask_path)
+        if (st.st_mtime_ns, st.st_size) != (raw_st.st_mtime_ns, raw_st.st_size):
+            return None, None, "Mask changed while it was being converted"
+        if archive_dir is not None:
+            _archive(mask_path, archive_path(archive_dir, mask_path, raw_st))
+        os.replace(tmp_path, mask_path)
+    except OSError as e:
+        return None, None, f"Could not store canonical mask: {e}"
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return binary, os.stat(mask_path), None
+
+
+def ingest_mask_file(original_path, mask_path, archive_dir=None):
+    """QC on the raw mask, then store_canonical(). Returns (qc, raw_size, error_msg);
+    qc is None for a mask that is already canonical."""
+    if is_canonical(mask_path):
+        return None, None, None
+    try:
+        raw_st = os.stat(mask_path)
+    except OSError as e:
+        return None, None, str(e)
+    mask_img = read_image(mask_path)
+    if mask_img is None:
+        return None, None, "Could not read mask image."
+    original = read_image(original_path, cv2.IMREAD_UNCHANGED)
+    if original is None:
+        return None, None, "Could not read original image."
+    binary = binarize_inplace(cv2.cvtColor(mask_img, cv2.COLOR_BGR2GRAY))
+    qc = compute_mask_qc(mask_img, binary, original.shape)
+    _, st, error_msg = store_canonical(mask_path, binary, original.shape, raw_st, archive_dir)
+    if error_msg:
+        return None, None, error_msg
+    qc.update(mask_mtime=st.st_mtime, mask_size=st.st_size)
+    return qc, raw_st.st_size, None
+
+
+def _migrate_job(args):
+    base, original_path, mask_path, archive_dir = args
+    qc, raw_size, error_msg = ingest_mask_file(original_path, mask_path, archive_dir)
+    return base, os.path.basename(mask_path), qc, raw_size, error_msg
+
+
+def find_masks_with_originals(layout):
+    """[(base, original filename, mask filename)] for the *_mask.png files that have an original."""
+    layout = as_layout(layout)
+    originals = {os.path.splitext(entry.name)[0]: entry.name for entry in layout.iter_originals()}
+    masks = {entry.name[:-len('_mask.png')]: entry.name for entry in layout.iter_annotations()
+             if entry.name.endswith('_mask.png')}
+    return sorted((base, originals[base], mask) for base, mask in masks.items() if base in originals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_layout_arguments(parser)
+    parser.add_argument('--archive-dir', default='./mask_archive/')
+    parser.add_argument('--no-archive', action='store_true', help='Do not keep the raw masks')
+    parser.add_argument('--db', default='annotation_state.db', help='Where to store the QC of converted masks')
+    parser.add_argument('--replicate', action='store_true',
+                        help="Journal converted masks for the app's replicator (REPLICATION_MIRROR_DIR)")
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    from state_store import StateStore
+    store = StateStore(args.db)
+    archive_dir = None if args.no_archive else args.archive_dir
+    layout = layout_from_args(args)
+    todo = [(base, layout.original_path(original), layout.annotation_path(mask), archive_dir)
+            for base, original, mask in find_masks_with_originals(layout)]
+    print(f"Checking {len(todo)} masks...")
+    converted = skipped = failed = 0
+    bytes_before = bytes_after = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for base, mask_filename, qc, raw_size, error_msg in pool.map(_migrate_job, todo, chunksize=4):
+            if error_msg:
+                failed += 1
+                print(f"  {mask_filename}: {error_msg}")
+                continue
+            if qc is None:
+                skipped += 1
+                continue
+            converted += 1
+            bytes_before += raw_size
+            bytes_after += qc['mask_size']
+            store.save_mask_qc(base, mask_filename, qc)
+            if args.replicate:
+                store.journal_replication(layout.relative_path(mask_filename))
+    print(f"Done: {converted} converted ({bytes_before / 1e6:.1f} MB -> {bytes_after / 1e6:.1f} MB), "
+          f"{skipped} already canonical, {failed} failed.")
+    if converted:
+        print("The running app picks up the new sizes at its next status reconcile (or restart).")
+
+
+if __name__ == '__main__':
+    main()
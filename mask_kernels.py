@@ -0,0 +1,98 @@
+from lazy_imports import cv2, np
+from metrics import stage
+
+# Mask pixels brighter than this (in grayscale) count as annotated foreground
+MASK_THRESHOLD = 30
+
+# Overlay look: 30% blue over a 70% original, as the viewer has always shown it
+OVERLAY_ALPHA = 0.3
+OVERLAY_COLOR_BGR = (255, 0, 0)
+
+# Packed masks (/view/packed_mask): magic, then little-endian uint32 width and height, then the
+# foreground bits row by row, most significant bit first (np.packbits of the flattened mask)
+PACKED_MASK_MAGIC = b'PMSK'
+
+
+def binarize_inplace(gray, threshold=MASK_THRESHOLD):
+    """Thresholds a single-channel uint8 mask to 0/255 in place and returns it."""
+    cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY, dst=gray)
+    return gray
+
+
+def read_image(path, flags=None):
+    """cv2.imread (IMREAD_COLOR by default) as two timed stages: reading the file
+    (NAS I/O) and decoding it. Returns None if the file cannot be read or decoded."""
+    with stage('read'):
+        try:
+            data = np.fromfile(path, dtype=np.uint8)
+        except OSError:
+            return None
+    if data.size == 0:
+        return None
+    with stage('decode'):
+        return cv2.imdecode(data, cv2.IMREAD_COLOR if flags is None else flags)
+
+
+def read_binary_mask(mask_path, threshold=MASK_THRESHOLD):
+    """Decodes a mask straight to one channel and binarizes it in the same buffer.
+
+    Returns the 0/255 uint8 mask, or None if the file cannot be read. Decoding
+    with IMREAD_GRAYSCALE avoids materialising the 3-channel image at all.
+    """
+    gray = read_image(mask_path, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None
+    with stage('process'):
+        return binarize_inplace(gray, threshold)
+
+
+def fit_mask_to(binary_mask, shape):
+    """Nearest-neighbour resizes the mask to an image's (height, width) if they differ."""
+    height, width = shape[:2]
+    if binary_mask.shape[:2] == (height, width):
+        return binary_mask
+    return cv2.resize(binary_mask, (width, height), interpolation=cv2.INTER_NEAREST)
+
+
+def overlay_inplace(image_bgr, binary_mask, color_bgr=OVERLAY_COLOR_BGR, alpha=OVERLAY_ALPHA):
+    """Blends color_bgr over the masked pixels of image_bgr, in place, and returns it.
+
+    Equivalent to addWeighted(image, 1 - alpha, color_layer, alpha) where the
+    color layer is color_bgr on the mask and black elsewhere: every pixel is
+    scaled by (1 - alpha), then alpha * color is added only where the mask is
+    set. No full-size temporaries are allocated; image_bgr must be a
+    contiguous 3-channel uint8 array in BGR order.
+    """
+    cv2.convertScaleAbs(image_bgr, dst=image_bgr, alpha=1.0 - alpha)
+    tint = tuple(round(alpha * c) for c in color_bgr) + (0,)
+    cv2.add(image_bgr, tint, dst=image_bgr, mask=binary_mask)
+    return image_bgr
+
+
+def render_overlay(original_path, mask_path, threshold=MASK_THRESHOLD):
+    """Reads an original and its mask and returns (overlay_bgr, error_msg)."""
+    image = read_image(original_path)
+    if image is None:
+        return None, "Could not read original image for overlay."
+    binary = read_binary_mask(mask_path, threshold)
+    if binary is None:
+        return None, "Could not read mask image for overlay."
+    with stage('process'):
+        return overlay_inplace(image, fit_mask_to(binary, image.shape)), None
+
+
+def pack_binary_mask(binary_mask, max_dim=None):
+    """Returns a 0/255 mask as PACKED_MASK_MAGIC + width + height + packed bits.
+
+    With max_dim the mask is first downsampled (area average, then majority
+    threshold) so its longest side is at most max_dim. One bit per pixel: a
+    1024 px preview is at most 128 KiB before compression.
+    """
+    height, width = binary_mask.shape[:2]
+    if max_dim and max(width, height) > max_dim:
+        scale = max_dim / float(max(width, height))
+        width, height = max(1, round(width * scale)), max(1, round(height * scale))
+        binary_mask = cv2.resize(binary_mask, (width, height), interpolation=cv2.INTER_AREA)
+        binarize_inplace(binary_mask, 127)
+    header = PACKED_MASK_MAGIC + np.array([width, height], dtype='<u4').tobytes()
+    return header + np.packbits(binary_mask > 0).tobytes()
@@ -0,0 +1,150 @@
+"""Quality checks for uploaded masks.
+
+compute_mask_qc() runs once per mask upload inside the post-processing
+worker; the results are stored in the state store and listed by the /qc
+report. Run directly to backfill masks that have no (or outdated) QC:
+
+    python mask_qc.py --images-dir ./images_train/ --db annotation_state.db
+"""
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from lazy_imports import cv2, np
+from mask_kernels import MASK_THRESHOLD, binarize_inplace
+from storage_layout import add_layout_arguments, layout_from_args
+
+# Connected-component areas (pixels) are counted in these buckets: [1, 10), [10, 100), ...
+COMPONENT_SIZE_BINS = (1, 10, 100, 1000, 10000, 100000, float("inf"))
+
+# A foreground pixel is "colored" if its channels differ by more than this (masks are white on black)
+COLOR_SPREAD_THRESHOLD = 30
+# Foreground pixels at or below this gray level are "soft" (anti-aliased or wrong-color strokes)
+SOFT_GRAY_LEVEL = 200
+
+# Flag thresholds
+INVERTED_COVERAGE = 0.5
+COLORED_FRACTION = 0.01
+SOFT_FRACTION = 0.25
+ASPECT_TOLERANCE = 0.01
+MAX_COMPONENTS = 2000
+SPECKLE_FRACTION = 0.5 # Share of components under 10 pixels
+
+FLAGS = ('dimension_mismatch', 'aspect_mismatch', 'empty', 'inverted', 'colored', 'soft', 'speckle')
+
+
+def compute_mask_qc(mask_bgr, binary, original_shape=None):
+    """QC numbers and flags for a decoded mask.
+
+    mask_bgr is the mask as uploaded (3-channel), binary the same mask
+    thresholded at MASK_THRESHOLD (0/255, one channel) and original_shape the
+    (height, width) of the image it annotates. Everything is computed with
+    whole-array OpenCV/NumPy operations.
+    """
+    height, width = binary.shape[:2]
+    foreground = int(cv2.countNonZero(binary))
+    coverage = foreground / float(width * height) if width and height else 0.0
+
+    num_labels, _, cc_stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    areas = cc_stats[1:, cv2.CC_STAT_AREA]
+    histogram, _ = np.histogram(areas, bins=COMPONENT_SIZE_BINS)
+    components = int(num_labels - 1)
+
+    # Channel spread (max - min over B, G, R) on the foreground, and soft gray levels
+    b, g, r = cv2.split(mask_bgr)
+    spread = cv2.subtract(cv2.max(cv2.max(b, g), r), cv2.min(cv2.min(b, g), r))
+    colored = int(cv2.countNonZero(cv2.bitwise_and(
+        cv2.threshold(spread, COLOR_SPREAD_THRESHOLD, 255, cv2.THRESH_BINARY)[1], binary)))
+    gray = cv2.cvtColor(mask_bgr, cv2.COLOR_BGR2GRAY)
+    soft = int(cv2.countNonZero(cv2.bitwise_and(cv2.inRange(gray, MASK_THRESHOLD + 1, SOFT_GRAY_LEVEL), binary)))
+    mean_color = [round(c, 1) for c in cv2.mean(mask_bgr, mask=binary)[:3]] if foreground else None
+
+    qc = {
+        "width": width,
+        "height": height,
+        "threshold": MASK_THRESHOLD,
+        "foreground_pixels": foreground,
+        "coverage": coverage,
+        "components": components,
+        "component_size_histogram": [int(n) for n in histogram],
+        "largest_component_fraction": float(areas.max()) / foreground if foreground else 0.0,
+        "colored_fraction": colored / foreground if foreground else 0.0,
+        "soft_fraction": soft / foreground if foreground else 0.0,
+        "mean_foreground_bgr": mean_color,
+        "dimension_mismatch": False,
+    }
+
+    flags = []
+    if original_shape is not None:
+        orig_height, orig_width = original_shape[:2]
+        qc["original_width"] = orig_width
+        qc["original_height"] = orig_height
+        if (height, width) != (orig_height, orig_width):
+            qc["dimension_mismatch"] = True
+            flags.append('dimension_mismatch')
+            if abs(width / float(height) - orig_width / float(orig_height)) > ASPECT_TOLERANCE * orig_width / float(orig_height):
+                flags.append('aspect_mismatch')
+    if foreground == 0:
+        flags.append('empty')
+    elif coverage > INVERTED_COVERAGE:
+        flags.append('inverted')
+    if qc["colored_fraction"] > COLORED_FRACTION:
+        flags.append('colored')
+    if qc["soft_fraction"] > SOFT_FRACTION:
+        flags.append('soft')
+    if components > MAX_COMPONENTS or (components and histogram[0] / float(components) > SPECKLE_FRACTION):
+        flags.append('speckle')
+    qc["flags"] = flags
+    return qc
+
+
+def qc_mask_files(original_path, mask_path):
+    """Decodes a mask (and reads the original's dimensions) and returns (qc, error_msg)."""
+    try:
+        mask_st = os.stat(mask_path)
+    except OSError as e:
+        return None, str(e)
+    mask_bgr = cv2.imread(mask_path, cv2.IMREAD_COLOR)
+    if mask_bgr is None:
+        return None, "Could not read mask image."
+    binary = binarize_inplace(cv2.cvtColor(mask_bgr, cv2.COLOR_BGR2GRAY))
+    original = cv2.imread(original_path, cv2.IMREAD_UNCHANGED)
+    if original is None:
+        return None, "Could not read original image."
+    qc = compute_mask_qc(mask_bgr, binary, original.shape)
+    qc.update(mask_mtime=mask_st.st_mtime, mask_size=mask_st.st_size)
+    return qc, None
+
+
+def _backfill_job(args):
+    base, original_path, mask_path = args
+    qc, error_msg = qc_mask_files(original_path, mask_path)
+    return base, os.path.basename(mask_path), qc, error_msg
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_layout_arguments(parser)
+    parser.add_argument('--db', default='annotation_state.db')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    from state_store import StateStore
+    store = StateStore(args.db)
+    layout = layout_from_args(args)
+    todo = [(base, layout.original_path(original), layout.annotation_path(mask))
+            for base, original, mask in store.masks_needing_qc()]
+    print(f"Running QC on {len(todo)} masks...")
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for base, mask_filename, qc, error_msg in pool.map(_backfill_job, todo, chunksize=4):
+            if qc is None:
+                failed += 1
+                print(f"  {mask_filename}: {error_msg}")
+                continue
+            store.save_mask_qc(base, mask_filename, qc)
+    print(f"Done: {len(todo) - failed} stored, {failed} failed.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""In-process metrics in the Prometheus text format.
+
+Counters and histograms are kept per process (each gunicorn worker exposes
+its own; scrape them per worker or put them behind a single-worker
+deployment). request_metrics.py records the per-route numbers; the image
+code wraps its read / decode / process / encode steps in stage(), which
+attributes the time to the route currently being served by the thread.
+"""
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Seconds; covers cached hits (sub-millisecond) up to cold full-resolution renders
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Bytes: 1 KiB .. 1 GiB in factors of 4
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+# Bytes per second: 64 KiB/s .. 1 GiB/s in factors of 4
+RATE_BUCKETS = tuple(64 * 1024 * 4 ** i for i in range(8))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels.get(name, '') for name in self.labelnames), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {} # label values -> [per-bucket counts (non-cumulative, +Inf last), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels):
+        series = self._series.get(tuple(labels.get(name, '') for name in self.labelnames))
+        return series[2] if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, (list(s[0]), s[1], s[2])) for key, s in self._series.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """The whole registry in the Prometheus text exposition format (version 0.0.4)."""
+        return '\n'.join(line for metric in self._metrics for line in metric.render()) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'annotation_request_duration_seconds', 'Time to produce a response (streamed bodies excluded).',
+    ('route', 'method', 'status')))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'annotation_stage_duration_seconds', 'Time spent in one image-processing stage of a request.',
+    ('route', 'stage')))
+RESPONSE_BYTES = REGISTRY.register(Counter(
+    'annotation_response_bytes_total', 'Response body bytes sent.', ('route',)))
+UPLOAD_BYTES = REGISTRY.register(Histogram(
+    'annotation_upload_size_bytes', 'Size of saved uploads (form uploads and chunked uploads / chunks).',
+    ('kind', 'mode'), buckets=SIZE_BUCKETS))
+UPLOAD_RATE = REGISTRY.register(Histogram(
+    'annotation_upload_rate_bytes_per_second', 'Upload throughput as seen by the request handler.',
+    ('kind', 'mode'), buckets=RATE_BUCKETS))
+PROFILES_WRITTEN = REGISTRY.register(Counter(
+    'annotation_profiles_written_total', 'Slow-request profiles dumped by the sampling profiler.', ('route',)))
+
+_context = threading.local()
+
+
+def set_route(route):
+    """Names the route the calling thread is serving (None when done)."""
+    _context.route = route
+
+
+def current_route():
+    return getattr(_context, 'route', None) or 'background'
+
+
+@contextmanager
+def stage(name):
+    """Times the enclosed block as stage `name` of the current route."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, route=current_route(), stage=name)
+
+
+def observe_upload(kind, mode, size, seconds):
+    UPLOAD_BYTES.observe(size, kind=kind, mode=mode)
+    if seconds > 0:
+        UPLOAD_RATE.observe(size / seconds, kind=kind, mode=mode)
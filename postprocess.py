@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from derived_cache import DerivedImageCache
+from image_pyramid import encode_pyramid, store_pyramid
+from image_processing import load_image, encode_cv_image
+from lazy_imports import cv2
+from mask_kernels import binarize_inplace, fit_mask_to, overlay_inplace
+from mask_qc import compute_mask_qc
+from mask_ingest import is_canonical, store_canonical
+
+# Lossy preview format -> the lossless format used for binary images in the same negotiation
+LOSSLESS_COUNTERPART = {'webp': 'webp_lossless', 'jpeg': 'png'}
+
+
+def _render_outputs(original_path, mask_path, binary, mask_img, overlay, preview_formats, min_dim, top_dim):
+    """Encodes everything the /view routes serve for a mask, in memory.
+
+    Returns (images, pyramids): (kind, sources, data) for the full-resolution
+    renderings and (kind, sources, fmt, level_sizes, encoded) for the previews.
+    Raises RuntimeError if anything fails to encode.
+    """
+    # Full-resolution renderings (?full=1)
+    images = []
+    for kind, sources, img in (('binary_mask', [mask_path], binary),
+                               ('overlay', [original_path, mask_path], overlay)):
+        data = encode_cv_image(img)
+        if data is None:
+            raise RuntimeError(f"Error encoding {kind}")
+        images.append((kind, sources, data))
+
+    # Preview pyramids for every format the negotiation can pick
+    pyramids = []
+    renderings = (('binary_mask', [mask_path], True, binary),
+                  ('overlay', [original_path, mask_path], False, overlay),
+                  ('mask', [mask_path], True, mask_img))
+    for fmt in preview_formats:
+        for kind, sources, lossless, img in renderings:
+            fmt_used = LOSSLESS_COUNTERPART[fmt] if lossless else fmt
+            level_sizes, encoded, error_msg = encode_pyramid(img, fmt_used, min_dim, top_dim)
+            if error_msg:
+                raise RuntimeError(f"{kind} ({fmt_used}): {error_msg}")
+            pyramids.append((kind, sources, fmt_used, level_sizes, encoded))
+    return images, pyramids
+
+
+def precompute_mask_outputs(cache_dir, original_path, mask_path, preview_formats, min_dim,
+                            canonical=False, archive_dir=None, top_dim=2048):
+    """Worker entry point: renders everything the /view routes serve for a mask.
+
+    Runs in a pool process, so it only takes plain arguments and writes its
+    results into the on-disk derived cache under the same keys the request
+    handlers compute. QC is computed from the mask as uploaded. With canonical,
+    the upload is then replaced by its canonical form (see
+    mask_ingest.store_canonical), but only once every rendering has been
+    encoded: a job that fails leaves the upload in place for its retry.
+    Returns the mask QC (see mask_qc.compute_mask_qc), with 'canonicalized'
+    set if the mask file was replaced.
+    """
+    cache = DerivedImageCache(cache_dir, max_memory_bytes=0)
+    mask_st = os.stat(mask_path)
+
+    # Decode each source once; the binary mask and overlay are derived in place
+    mask_img, error_msg = load_image(mask_path)
+    if mask_img is None:
+        raise RuntimeError(error_msg)
+    original, error_msg = load_image(original_path)
+    if original is None:
+        raise RuntimeError(error_msg)
+    binary = binarize_inplace(cv2.cvtColor(mask_img, cv2.COLOR_BGR2GRAY))
+    original_shape = original.shape
+    # Before the overlay: it is drawn into the original's buffer
+    qc = compute_mask_qc(mask_img, binary, original_shape)
+    qc['canonicalized'] = False
+    fitted = fit_mask_to(binary, original_shape)
+    overlay = overlay_inplace(original, fitted)
+
+    def render(binary, mask_img):
+        return _render_outputs(original_path, mask_path, binary, mask_img, overlay, preview_formats, min_dim, top_dim)
+
+    if canonical and not is_canonical(mask_path, original_shape):
+        # Rendered from what the canonical file will hold, and keyed by it once it is written
+        outputs = render(fitted, fitted)
+        _, canonical_st, error_msg = store_canonical(mask_path, fitted, original_shape, mask_st, archive_dir)
+        if error_msg:
+            print(f"Keeping {os.path.basename(mask_path)} as uploaded: {error_msg}")
+            outputs = render(binary, mask_img)
+        else:
+            mask_st = canonical_st
+            qc['canonicalized'] = True
+    else:
+        outputs = render(binary, mask_img)
+    qc.update(mask_mtime=mask_st.st_mtime, mask_size=mask_st.st_size)
+
+    # The renderings only save the /view routes work; failing to store them must not fail
+    # the job, whose QC and canonical file the app still has to record
+    images, pyramids = outputs
+    try:
+        for kind, sources, data in images:
+            cache.put(cache.make_key(kind, sources)[0], data)
+        for kind, sources, fmt, level_sizes, encoded in pyramids:
+            store_pyramid(cache, kind, sources, fmt, level_sizes, encoded)
+        stats_key, _ = cache.make_key('mask_stats', [mask_path])
+        cache.put(stats_key, json.dumps(qc).encode('utf-8'))
+    except OSError as e:
+        print(f"Renderings of {os.path.basename(mask_path)} not cached, they will be rendered on first view: {e}")
+    return qc
+
+
+class PostProcessingPipeline:
+    """Runs CPU-heavy jobs in a process pool, off the request threads.
+
+    At most max_queued jobs are pending or running at once; further submissions
+    are refused (the /view routes still render lazily on demand). Failed jobs
+    are retried up to max_retries times. Job state is kept per job id for the UI.
+    """
+
+    def __init__(self, max_workers=None, max_queued=64, max_retries=2):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_retries = max_retries
+        self._executor = None
+        self._jobs = {}
+        self._futures = {}
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def submit(self, job_id, fn, *args, on_success=None):
+        """Queues fn(*args) under job_id. Returns False if the queue is full.
+
+        on_success(result) is called in this process once the job has finished.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            future = self._futures.get(job_id)
+            if job and job['status'] == 'queued' and future and not future.running():
+                # Not started yet: it will read the newest files when it runs
+                job['on_success'] = on_success
+                return True
+            if self._active >= self.max_queued:
+                self._jobs[job_id] = {"status": "skipped", "attempts": 0, "error": "queue full",
+                                      "updated": time.time(), "result": None}
+                return False
+            self._active += 1
+            job = {"status": "queued", "attempts": 0, "error": None,
+                   "updated": time.time(), "result": None, "on_success": on_success}
+            self._jobs[job_id] = job
+        self._start_attempt(job_id, job, fn, args)
+        return True
+
+    def _start_attempt(self, job_id, job, fn, args):
+        # job is passed along (not looked up by id) so a resubmission under the
+        # same id while this one runs does not get its state overwritten
+        with self._lock:
+            job['attempts'] += 1
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except (BrokenProcessPool, RuntimeError) as e:
+            # A crashed worker breaks the whole pool; start a fresh one
+            print(f"Post-processing pool unavailable ({e}), restarting it.")
+            self._executor = None
+            future = self._get_executor().submit(fn, *args)
+        with self._lock:
+            job['status'] = 'queued'
+            self._futures[job_id] = future
+        future.add_done_callback(lambda f: self._on_done(job_id, job, fn, args, f))
+
+    def _on_done(self, job_id, job, fn, args, future):
+        error = future.exception()
+        with self._lock:
+            job['updated'] = time.time()
+            if error is None:
+                job.update(status='done', error=None, result=future.result())
+                self._active -= 1
+                on_success = job.pop('on_success', None)
+            else:
+                job['error'] = str(error)
+                retry = job['attempts'] <= self.max_retries
+                if not retry:
+                    job['status'] = 'failed'
+                    self._active -= 1
+        if error is None:
+            if on_success is not None:
+                try:
+                    on_success(job['result'])
+                except Exception as e:
+                    print(f"Post-processing job {job_id} done, but handling its result failed: {e}")
+        elif retry:
+            print(f"Post-processing job {job_id} failed ({error}), retrying.")
+            self._start_attempt(job_id, job, fn, args)
+        else:
+            print(f"Post-processing job {job_id} failed after {job['attempts']} attempts: {error}")
+
+    def _snapshot(self, job_id):
+        job = dict(self._jobs[job_id])
+        job.pop('on_success', None)
+        future = self._futures.get(job_id)
+        if job['status'] == 'queued' and future is not None and future.running():
+            job['status'] = 'running'
+        return job
+
+    def status(self, job_id):
+        with self._lock:
+            return self._snapshot(job_id) if job_id in self._jobs else None
+
+    def all_statuses(self):
+        with self._lock:
+            return {job_id: self._snapshot(job_id) for job_id in self._jobs}
@@ -0,0 +1,83 @@
+import threading
+from contextlib import contextmanager
+
+
+class ServerBusy(Exception):
+    """Raised when the render queue is full; the route answers 503 with Retry-After."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Render queue full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RenderGuard:
+    """Coalesces identical renders and bounds how many run at once.
+
+    run(key, fn) makes concurrent callers with the same key share a single
+    fn() call (single flight). Distinct renders take one of max_concurrent
+    slots; up to max_waiting further renders queue for a slot, and anything
+    beyond that (or a wait longer than wait_timeout) raises ServerBusy instead
+    of piling more full-size decodes into memory.
+    """
+
+    def __init__(self, max_concurrent=2, max_waiting=8, wait_timeout=60, retry_after=5):
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._waiting = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _slot(self):
+        acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                if self._waiting >= self.max_waiting:
+                    raise ServerBusy(self.retry_after)
+                self._waiting += 1
+            try:
+                acquired = self._slots.acquire(timeout=self.wait_timeout)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+            if not acquired:
+                raise ServerBusy(self.retry_after)
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def run(self, key, fn):
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._inflight[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            with self._slot():
+                call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.done.set()
@@ -0,0 +1,164 @@
+"""Copies saved uploads to a mirror directory (the NAS) as they happen.
+
+Upload handlers call Replicator.enqueue(filename) after a successful save; the
+entry is journaled in the state store and a background thread copies just that
+file. Entries survive restarts, so anything not yet copied is picked up on the
+next start. Run directly to drain the journal once (e.g. from cron or after an
+outage):
+
+    python replication.py ./images_train/ /nas/.../images_train/ --db annotation_state.db
+"""
+import os
+import stat
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+def copy_with_checksum(src_path, dest_path):
+    """Copies src_path to dest_path atomically and returns (sha256, error_msg).
+
+    The data goes to a temporary file next to dest_path while its SHA-256 is
+    computed; the temporary file is fsynced, read back and checked against
+    that digest, and only then renamed over dest_path. Readers of the mirror
+    therefore never see a partial file. The source mode and mtime are
+    preserved (as rsync -a does), so rsync --update treats replicated files
+    as up to date.
+    """
+    dest_dir = os.path.dirname(dest_path)
+    try:
+        os.makedirs(dest_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(dest_path) + '.', suffix='.replicating',
+                                        dir=dest_dir)
+    except OSError as e:
+        return None, str(e)
+    try:
+        source_hash = hashlib.sha256()
+        with open(src_path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            st = os.fstat(src.fileno())
+            while True:
+                block = src.read(COPY_BLOCK_SIZE)
+                if not block:
+                    break
+                source_hash.update(block)
+                dst.write(block)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        copy_hash = hashlib.sha256()
+        with open(tmp_path, 'rb') as f:
+            for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+                copy_hash.update(block)
+        if copy_hash.hexdigest() != source_hash.hexdigest():
+            os.remove(tmp_path)
+            return None, "Checksum mismatch after copy."
+
+        os.chmod(tmp_path, stat.S_IMODE(st.st_mode)) # mkstemp creates it 0600
+        os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp_path, dest_path)
+        return source_hash.hexdigest(), None
+    except OSError as e:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return None, str(e)
+
+
+class Replicator:
+    """Background worker draining the state store's replication journal.
+
+    Claims are leased, so several app processes can run a Replicator against
+    the same store without copying a file twice; a process that dies mid-copy
+    simply lets its lease expire. Failed copies are retried every
+    retry_seconds, up to max_attempts times.
+    """
+
+    def __init__(self, store, source_dir, mirror_dir, batch_size=16, lease_seconds=600,
+                 max_attempts=5, retry_seconds=30, poll_seconds=5):
+        self.store = store
+        self.source_dir = source_dir
+        self.mirror_dir = mirror_dir
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.poll_seconds = poll_seconds
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def enqueue(self, filename):
+        self.store.journal_replication(filename)
+        self._wake.set()
+
+    def replicate(self, filename):
+        """Copies one file from source_dir to mirror_dir. Returns (sha256, error_msg);
+        a source that no longer exists counts as done (nothing to copy)."""
+        src_path = os.path.join(self.source_dir, filename)
+        if not os.path.exists(src_path):
+            return None, None
+        return copy_with_checksum(src_path, os.path.join(self.mirror_dir, filename))
+
+    def run_once(self):
+        """Copies every currently claimable file. Returns the number of files handled."""
+        handled = 0
+        while not self._stop.is_set():
+            claimed = self.store.claim_replication(self.batch_size, self.lease_seconds)
+            if not claimed:
+                break
+            for filename, entry_ids in claimed.items():
+                start = time.time()
+                sha256, error_msg = self.replicate(filename)
+                if error_msg:
+                    print(f"Replication of {filename} failed: {error_msg}")
+                    self.store.finish_replication(entry_ids, error=error_msg, retry_after=self.retry_seconds,
+                                                  max_attempts=self.max_attempts)
+                else:
+                    print(f"Replicated {filename} to mirror in {time.time() - start:.2f}s")
+                    self.store.finish_replication(entry_ids, sha256=sha256)
+                handled += 1
+        return handled
+
+    def start(self):
+        """Starts the worker thread; it first catches up on entries left from earlier runs."""
+        if self._thread is not None:
+            return
+
+        def loop():
+            while not self._stop.is_set():
+                try:
+                    self.run_once()
+                except Exception as e: # Keep replicating after e.g. a locked database
+                    print(f"Replication worker error: {e}")
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+
+        self._thread = threading.Thread(target=loop, name='replicator', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source_dir')
+    parser.add_argument('mirror_dir')
+    parser.add_argument('--db', default='annotation_state.db')
+    args = parser.parse_args()
+
+    from state_store import StateStore
+    replicator = Replicator(StateStore(args.db), args.source_dir, args.mirror_dir)
+    handled = replicator.run_once()
+    summary = replicator.store.replication_summary()
+    print(f"Replicated {handled} files; {summary['pending']} pending, {summary['failed']} failed.")
+
+
+if __name__ == '__main__':
+    main()
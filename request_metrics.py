@@ -0,0 +1,121 @@
+"""Per-request instrumentation for the Flask app: route latency histograms,
+bytes served, and an opt-in sampling profiler for slow requests.
+
+With profile_sample_rate > 0 that fraction of requests runs under a
+profiler (cProfile, or pyinstrument when installed and selected); profiles
+of requests slower than profile_slow_seconds are written to profile_dir as
+<time>_<pid>-<n>_<milliseconds>ms_<route>.prof (open with `python -m pstats` or
+snakeviz), or .html with pyinstrument.
+"""
+import os
+import time
+import random
+import cProfile
+import itertools
+
+from flask import g, request
+
+import metrics
+
+PROFILERS = ('cprofile', 'pyinstrument')
+
+_profile_ids = itertools.count(1)
+
+
+class _CountingBody:
+    """Wraps a streamed response body and counts the bytes as they are sent."""
+
+    def __init__(self, body, route):
+        self._body = body
+        self._route = route
+
+    def __iter__(self):
+        for chunk in self._body:
+            metrics.RESPONSE_BYTES.inc(len(chunk), route=self._route)
+            yield chunk
+
+    def close(self):
+        if hasattr(self._body, 'close'):
+            self._body.close()
+
+
+def _start_profiler(profiler):
+    if profiler == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            profiler = 'cprofile'
+        else:
+            session = Profiler()
+            session.start()
+            return profiler, session
+    session = cProfile.Profile()
+    try:
+        session.enable()
+    except ValueError: # Another profiler is already active in this process
+        return None, None
+    return profiler, session
+
+
+def _stop_profiler(profiler, session, path_base):
+    """Stops the profiler; writes the profile if path_base is given."""
+    if profiler == 'pyinstrument':
+        session.stop()
+        if path_base:
+            with open(path_base + '.html', 'w') as f:
+                f.write(session.output_html())
+        return
+    session.disable()
+    if path_base:
+        session.dump_stats(path_base + '.prof')
+
+
+def instrument_app(app, profile_sample_rate=0.0, profile_slow_seconds=1.0, profile_dir='./profiles/',
+                   profiler='cprofile'):
+    """Registers the request hooks on app. Call before any other before_request hook,
+    so requests answered early by those are still measured."""
+    if profiler not in PROFILERS:
+        raise ValueError(f"profiler must be one of {PROFILERS}, got {profiler!r}")
+
+    @app.before_request
+    def start_request_metrics():
+        route = request.endpoint or 'unmatched'
+        metrics.set_route(route)
+        g.metrics_route = route
+        g.metrics_start = time.perf_counter()
+        g.profile = (None, None)
+        if profile_sample_rate > 0 and random.random() < profile_sample_rate:
+            g.profile = _start_profiler(profiler)
+
+    @app.after_request
+    def record_request_metrics(response):
+        route = g.get('metrics_route', 'unmatched')
+        elapsed = time.perf_counter() - g.get('metrics_start', time.perf_counter())
+        metrics.REQUEST_SECONDS.observe(elapsed, route=route, method=request.method,
+                                        status=str(response.status_code))
+        if response.content_length is not None:
+            # Includes files (and ranges of them); the body is left alone so sendfile still applies
+            metrics.RESPONSE_BYTES.inc(response.content_length, route=route)
+        elif response.is_streamed:
+            # Generated bodies (ZIPs, event streams): count what actually goes out
+            response.response = _CountingBody(response.response, route)
+
+        profiler, session = g.get('profile', (None, None))
+        if session is not None:
+            g.profile = (None, None)
+            path_base = None
+            if elapsed >= profile_slow_seconds:
+                os.makedirs(profile_dir, exist_ok=True)
+                name = f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}-{next(_profile_ids)}_{int(elapsed * 1000)}ms_{route}"
+                path_base = os.path.join(profile_dir, name)
+                metrics.PROFILES_WRITTEN.inc(route=route)
+                print(f"Slow request {request.path} ({elapsed:.2f}s), profile written to {path_base}")
+            _stop_profiler(profiler, session, path_base)
+        return response
+
+    @app.teardown_request
+    def clear_request_metrics(error=None):
+        profiler, session = g.get('profile', (None, None))
+        if session is not None: # after_request did not run (unhandled error)
+            _stop_profiler(profiler, session, None)
+        metrics.set_route(None)
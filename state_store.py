@@ -0,0 +1,683 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    filename TEXT PRIMARY KEY,
+    base TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_images_base ON images(base);
+CREATE TABLE IF NOT EXISTS annotators (
+    name TEXT PRIMARY KEY,
+    quota INTEGER NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS assignments (
+    filename TEXT PRIMARY KEY,
+    annotator TEXT NOT NULL,
+    position INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_assignments_annotator ON assignments(annotator, position);
+CREATE TABLE IF NOT EXISTS annotation_status (
+    base TEXT PRIMARY KEY,
+    xcf_mtime REAL,
+    xcf_size INTEGER,
+    mask_filename TEXT,
+    mask_mtime REAL,
+    mask_size INTEGER
+);
+CREATE TABLE IF NOT EXISTS upload_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    annotator TEXT,
+    filename TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    size INTEGER,
+    method TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_upload_events_annotator ON upload_events(annotator, created_at);
+CREATE INDEX IF NOT EXISTS idx_upload_events_filename ON upload_events(filename, created_at);
+CREATE TABLE IF NOT EXISTS replication_journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claimed_until REAL,
+    sha256 TEXT,
+    error TEXT,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_replication_journal_state ON replication_journal(state, id);
+CREATE TABLE IF NOT EXISTS progress_counters (
+    annotator TEXT PRIMARY KEY,
+    total INTEGER NOT NULL,
+    completed INTEGER NOT NULL,
+    partial_xcf INTEGER NOT NULL,
+    partial_mask INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS completion_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    annotator TEXT NOT NULL,
+    base TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_completion_events_annotator ON completion_events(annotator, created_at);
+CREATE TABLE IF NOT EXISTS mask_qc (
+    base TEXT PRIMARY KEY,
+    mask_filename TEXT NOT NULL,
+    mask_mtime REAL,
+    mask_size INTEGER,
+    computed_at REAL NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    original_width INTEGER,
+    original_height INTEGER,
+    dimension_mismatch INTEGER NOT NULL,
+    coverage REAL,
+    components INTEGER,
+    largest_component_fraction REAL,
+    colored_fraction REAL,
+    soft_fraction REAL,
+    flags TEXT NOT NULL,
+    flag_count INTEGER NOT NULL,
+    details TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mask_agreement (
+    mask_a TEXT NOT NULL,
+    mask_b TEXT NOT NULL,
+    base_a TEXT NOT NULL,
+    base_b TEXT NOT NULL,
+    mtime_a REAL NOT NULL,
+    size_a INTEGER NOT NULL,
+    mtime_b REAL NOT NULL,
+    size_b INTEGER NOT NULL,
+    max_dim INTEGER NOT NULL,
+    tolerance INTEGER NOT NULL,
+    iou REAL,
+    dice REAL,
+    boundary_precision REAL,
+    boundary_recall REAL,
+    boundary_f REAL,
+    error TEXT,
+    computed_at REAL NOT NULL,
+    PRIMARY KEY (mask_a, mask_b)
+);
+CREATE TABLE IF NOT EXISTS revisions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    annotator TEXT,
+    method TEXT,
+    source_sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_revisions_filename ON revisions(filename, id);
+"""
+
+
+def _status_row(entry):
+    xcf, mask = entry.get('xcf'), entry.get('mask')
+    return (xcf[0] if xcf else None, xcf[1] if xcf else None,
+            mask[0] if mask else None, mask[1] if mask else None, mask[2] if mask else None)
+
+
+# SQL conditions on annotation_status (aliased s) for assigned_with_status(status=...)
+STATUS_FILTERS = {
+    'pending': "s.xcf_mtime IS NULL AND s.mask_filename IS NULL",
+    'partial': "(s.xcf_mtime IS NULL) != (s.mask_filename IS NULL)",
+    'complete': "s.xcf_mtime IS NOT NULL AND s.mask_filename IS NOT NULL",
+}
+
+
+# Columns the QC report can be sorted by (whitelisted: they are formatted into the SQL)
+QC_SORT_COLUMNS = ('flag_count', 'coverage', 'components', 'largest_component_fraction', 'colored_fraction',
+                   'soft_fraction', 'dimension_mismatch', 'computed_at', 'base', 'annotator')
+QC_COLUMNS = ('base', 'mask_filename', 'mask_mtime', 'mask_size', 'computed_at', 'width', 'height',
+              'original_width', 'original_height', 'dimension_mismatch', 'coverage', 'components',
+              'largest_component_fraction', 'colored_fraction', 'soft_fraction', 'flags', 'flag_count', 'details')
+REVISION_COLUMNS = ('id', 'filename', 'kind', 'sha256', 'size', 'created_at', 'annotator', 'method', 'source_sha256')
+
+
+def _category(row):
+    """Progress bucket of an annotation_status row (without base), or of None = no files."""
+    has_xcf = row is not None and row[0] is not None
+    has_mask = row is not None and row[2] is not None
+    if has_xcf and has_mask:
+        return 'completed'
+    if has_xcf:
+        return 'partial_xcf'
+    if has_mask:
+        return 'partial_mask'
+    return 'pending'
+
+
+def _status_entry(row):
+    """(xcf_mtime, xcf_size, mask_filename, mask_mtime, mask_size) -> status_index style dict."""
+    xcf_mtime, xcf_size, mask_filename, mask_mtime, mask_size = row
+    return {
+        'xcf': (xcf_mtime, xcf_size) if xcf_mtime is not None else None,
+        'mask': (mask_filename, mask_mtime, mask_size) if mask_filename is not None else None,
+    }
+
+
+class StateStore:
+    """Assignments, annotation status and the upload log in one SQLite file.
+
+    The database runs in WAL mode so any number of WSGI worker processes can
+    read while one writes. Each thread (and each forked process) gets its own
+    connection; transaction() nests, and only the outermost level commits.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        if not self._query("SELECT 1 FROM meta WHERE key = 'progress_version'"):
+            self.recount_progress()
+
+    def _conn(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            # Never reuse a connection inherited across fork()
+            local.conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None,
+                                         check_same_thread=False)
+            local.conn.execute("PRAGMA synchronous=NORMAL")
+            local.pid = os.getpid()
+            local.depth = 0
+        return local.conn
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE ... COMMIT, or ROLLBACK on error. Reentrant."""
+        conn = self._conn()
+        local = self._local
+        if local.depth:
+            local.depth += 1
+            try:
+                yield conn
+            finally:
+                local.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            local.depth = 0
+            conn.execute("ROLLBACK")
+            raise
+        local.depth = 0
+        conn.execute("COMMIT")
+
+    def _query(self, sql, params=()):
+        return self._conn().execute(sql, params).fetchall()
+
+    # --- Migration ---
+    def migrate_from_json(self, assignments_file, quotas):
+        """Imports assignments.json once, if the store has no assignments yet.
+
+        The stored quotas are the configured ones: they are what later rebalances
+        compare against to detect a reduced quota, so legacy lists that are over
+        quota stay as they are. Returns True if it migrated.
+        """
+        if self._query("SELECT 1 FROM meta WHERE key = 'migrated_from'") or \
+           self._query("SELECT 1 FROM annotators LIMIT 1") or not os.path.exists(assignments_file):
+            return False
+        try:
+            with open(assignments_file, 'r') as f:
+                assignments = json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Error reading {assignments_file} for migration ({e}), skipping it.")
+            return False
+        with self.transaction() as conn:
+            # Keep quotas for annotators that are no longer configured so the rebalancer sees them
+            all_quotas = dict(quotas)
+            for annotator_name, files in assignments.items():
+                all_quotas.setdefault(annotator_name, len(files))
+            self.replace_assignments(assignments, all_quotas)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from', ?)",
+                         (os.path.abspath(assignments_file),))
+        print(f"Migrated {sum(len(v) for v in assignments.values())} assignments from {assignments_file}.")
+        return True
+
+    # --- Images and assignments ---
+    def known_images(self):
+        """The image set as of the last sync_images()."""
+        return {filename for (filename,) in self._query("SELECT filename FROM images")}
+
+    def sync_images(self, filenames):
+        """Makes the images table match filenames, touching only the difference."""
+        wanted = set(filenames)
+        with self.transaction() as conn:
+            existing = {row[0] for row in conn.execute("SELECT filename FROM images")}
+            removed = existing - wanted
+            added = wanted - existing
+            conn.executemany("DELETE FROM images WHERE filename = ?", ((f,) for f in removed))
+            conn.executemany("INSERT INTO images (filename, base) VALUES (?, ?)",
+                             ((f, os.path.splitext(f)[0]) for f in added))
+            if added or removed:
+                self.recount_progress()
+        return len(added), len(removed)
+
+    def assignments_version(self):
+        rows = self._query("SELECT value FROM meta WHERE key = 'assignments_version'")
+        return int(rows[0][0]) if rows else 0
+
+    def load_assignments(self):
+        """Returns {annotator: [filenames in order]} for every annotator, in quota order."""
+        assignments = {name: [] for (name,) in self._query("SELECT name FROM annotators ORDER BY position")}
+        for filename, annotator_name in self._query(
+                "SELECT filename, annotator FROM assignments ORDER BY annotator, position"):
+            assignments.setdefault(annotator_name, []).append(filename)
+        return assignments
+
+    def replace_assignments(self, assignments, quotas, expected_version=None):
+        """Stores assignments and the annotator list, writing only rows that changed.
+
+        With expected_version, nothing is written (returns False) if another
+        process saved assignments since that version was read.
+        """
+        with self.transaction() as conn:
+            version = self.assignments_version()
+            if expected_version is not None and version != expected_version:
+                return False
+            desired = {}
+            for annotator_name, files in assignments.items():
+                for position, filename in enumerate(files):
+                    desired[filename] = (annotator_name, position)
+            current = {filename: (annotator_name, position) for filename, annotator_name, position
+                       in conn.execute("SELECT filename, annotator, position FROM assignments")}
+            conn.executemany("DELETE FROM assignments WHERE filename = ?",
+                             ((f,) for f in current.keys() - desired.keys()))
+            conn.executemany("INSERT OR REPLACE INTO assignments (filename, annotator, position) VALUES (?, ?, ?)",
+                             ((f, a, p) for f, (a, p) in desired.items() if current.get(f) != (a, p)))
+            conn.execute("DELETE FROM annotators")
+            conn.executemany("INSERT INTO annotators (name, quota, position) VALUES (?, ?, ?)",
+                             ((name, quota, i) for i, (name, quota) in enumerate(quotas.items())))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('assignments_version', ?)",
+                         (str(version + 1),))
+            self.recount_progress()
+        return True
+
+    def annotators(self):
+        return [name for (name,) in self._query("SELECT name FROM annotators ORDER BY position")]
+
+    def quotas(self):
+        return dict(self._query("SELECT name, quota FROM annotators ORDER BY position"))
+
+    def has_annotator(self, annotator_name):
+        return bool(self._query("SELECT 1 FROM annotators WHERE name = ?", (annotator_name,)))
+
+    def is_assigned(self, annotator_name, filename):
+        return bool(self._query("SELECT 1 FROM assignments WHERE filename = ? AND annotator = ?",
+                                (filename, annotator_name)))
+
+    def assigned_images(self, annotator_name):
+        return [f for (f,) in self._query(
+            "SELECT filename FROM assignments WHERE annotator = ? ORDER BY position", (annotator_name,))]
+
+    def assigned_with_status(self, annotator_name, status=None, offset=0, limit=None):
+        """[(filename, base, status dict)] for an annotator's images, in one indexed query.
+
+        status filters to 'pending' (no files), 'partial' (XCF or mask only) or
+        'complete' (both); offset/limit select a page in assignment order.
+        """
+        sql = ("SELECT a.filename, s.xcf_mtime, s.xcf_size, s.mask_filename, s.mask_mtime, s.mask_size "
+               "FROM assignments a LEFT JOIN images i ON i.filename = a.filename "
+               "LEFT JOIN annotation_status s ON s.base = i.base WHERE a.annotator = ?")
+        if status is not None:
+            sql += " AND " + STATUS_FILTERS[status]
+        sql += " ORDER BY a.position"
+        params = [annotator_name]
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            params += [-1 if limit is None else limit, offset]
+        rows = self._query(sql, params)
+        return [(row[0], os.path.splitext(row[0])[0], _status_entry(row[1:])) for row in rows]
+
+    def count_assigned(self, annotator_name, status=None):
+        """Number of an annotator's images with the given status filter, from the progress counters."""
+        stats = self.progress().get(annotator_name)
+        if stats is None:
+            return 0
+        if status is None:
+            return stats['total']
+        if status == 'partial':
+            return stats['partial_xcf'] + stats['partial_mask']
+        return stats['completed' if status == 'complete' else 'pending']
+
+    def progress(self):
+        """{annotator: {total, completed, partial_xcf, partial_mask, pending}} in annotator order,
+        read from the running counters."""
+        stats = {name: {"total": 0, "completed": 0, "partial_xcf": 0, "partial_mask": 0, "pending": 0}
+                 for name in self.annotators()}
+        for annotator_name, total, completed, partial_xcf, partial_mask in self._query(
+                "SELECT annotator, total, completed, partial_xcf, partial_mask FROM progress_counters"):
+            if annotator_name in stats:
+                stats[annotator_name] = {
+                    "total": total,
+                    "completed": completed,
+                    "partial_xcf": partial_xcf,
+                    "partial_mask": partial_mask,
+                    "pending": total - completed - partial_xcf - partial_mask,
+                }
+        return stats
+
+    def recount_progress(self):
+        """Recomputes progress_counters from scratch; used when assignments or the image
+        set change. Status changes adjust the counters incrementally instead."""
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT a.annotator, COUNT(*), "
+                "COALESCE(SUM(s.xcf_mtime IS NOT NULL AND s.mask_filename IS NOT NULL), 0), "
+                "COALESCE(SUM(s.xcf_mtime IS NOT NULL AND s.mask_filename IS NULL), 0), "
+                "COALESCE(SUM(s.xcf_mtime IS NULL AND s.mask_filename IS NOT NULL), 0) "
+                "FROM assignments a LEFT JOIN images i ON i.filename = a.filename "
+                "LEFT JOIN annotation_status s ON s.base = i.base GROUP BY a.annotator").fetchall()
+            conn.execute("DELETE FROM progress_counters")
+            conn.executemany("INSERT INTO progress_counters (annotator, total, completed, partial_xcf, partial_mask) "
+                             "VALUES (?, ?, ?, ?, ?)", rows)
+            self._bump_progress_version(conn)
+
+    def progress_version(self):
+        """Changes whenever any progress counter does; cheap to poll."""
+        rows = self._query("SELECT value FROM meta WHERE key = 'progress_version'")
+        return int(rows[0][0]) if rows else 0
+
+    def completion_rates(self, since):
+        """{annotator: (completions since `since`, time of the first one)} from the completion log."""
+        return {annotator_name: (count, first) for annotator_name, count, first in self._query(
+            "SELECT annotator, COUNT(*), MIN(created_at) FROM completion_events "
+            "WHERE created_at >= ? GROUP BY annotator", (since,))}
+
+    @staticmethod
+    def _bump_progress_version(conn):
+        conn.execute("INSERT INTO meta (key, value) VALUES ('progress_version', '1') "
+                     "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+
+    def _apply_transition(self, conn, base, old_row, new_row, log_completion):
+        """Moves base's annotator(s) from old_row's progress bucket to new_row's."""
+        old, new = _category(old_row), _category(new_row)
+        if old == new:
+            return False
+        annotators = [a for (a,) in conn.execute(
+            "SELECT a.annotator FROM images i JOIN assignments a ON a.filename = i.filename WHERE i.base = ?",
+            (base,))]
+        changes = []
+        if old != 'pending':
+            changes.append(f"{old} = {old} - 1")
+        if new != 'pending':
+            changes.append(f"{new} = {new} + 1")
+        for annotator_name in annotators:
+            conn.execute(f"UPDATE progress_counters SET {', '.join(changes)} WHERE annotator = ?", (annotator_name,))
+            if log_completion and new == 'completed':
+                conn.execute("INSERT INTO completion_events (annotator, base, created_at) VALUES (?, ?, ?)",
+                             (annotator_name, base, time.time()))
+        return bool(annotators)
+
+    # --- Annotation status ---
+    def get_status(self, base):
+        rows = self._query("SELECT xcf_mtime, xcf_size, mask_filename, mask_mtime, mask_size "
+                           "FROM annotation_status WHERE base = ?", (base,))
+        return _status_entry(rows[0]) if rows else {'xcf': None, 'mask': None}
+
+    def set_status(self, base, kind, record):
+        """Updates one side ('xcf' or 'mask') of an image's status; record None = file gone."""
+        if kind == 'xcf':
+            sql = ("INSERT INTO annotation_status (base, xcf_mtime, xcf_size) VALUES (?, ?, ?) "
+                   "ON CONFLICT(base) DO UPDATE SET xcf_mtime = excluded.xcf_mtime, xcf_size = excluded.xcf_size")
+            params = (base,) + (tuple(record) if record else (None, None))
+        else:
+            sql = ("INSERT INTO annotation_status (base, mask_filename, mask_mtime, mask_size) VALUES (?, ?, ?, ?) "
+                   "ON CONFLICT(base) DO UPDATE SET mask_filename = excluded.mask_filename, "
+                   "mask_mtime = excluded.mask_mtime, mask_size = excluded.mask_size")
+            params = (base,) + (tuple(record) if record else (None, None, None))
+        with self.transaction() as conn:
+            old_row = conn.execute("SELECT xcf_mtime, xcf_size, mask_filename, mask_mtime, mask_size "
+                                   "FROM annotation_status WHERE base = ?", (base,)).fetchone()
+            conn.execute(sql, params)
+            new_row = conn.execute("SELECT xcf_mtime, xcf_size, mask_filename, mask_mtime, mask_size "
+                                   "FROM annotation_status WHERE base = ?", (base,)).fetchone()
+            if self._apply_transition(conn, base, old_row, new_row, log_completion=True):
+                self._bump_progress_version(conn)
+
+    def sync_statuses(self, entries):
+        """Makes annotation_status match {base: {'xcf': ..., 'mask': ...}}, writing only differences."""
+        wanted = {base: _status_row(entry) for base, entry in entries.items()}
+        with self.transaction() as conn:
+            current = {row[0]: tuple(row[1:]) for row in conn.execute(
+                "SELECT base, xcf_mtime, xcf_size, mask_filename, mask_mtime, mask_size FROM annotation_status")}
+            changed = [base for base in current.keys() | wanted.keys() if current.get(base) != wanted.get(base)]
+            conn.executemany("DELETE FROM annotation_status WHERE base = ?",
+                             ((base,) for base in current.keys() - wanted.keys()))
+            conn.executemany(
+                "INSERT OR REPLACE INTO annotation_status "
+                "(base, xcf_mtime, xcf_size, mask_filename, mask_mtime, mask_size) VALUES (?, ?, ?, ?, ?, ?)",
+                ((base,) + wanted[base] for base in changed if base in wanted))
+            # Files that changed outside the app move the counters but are not logged as
+            # completions, so the first scan does not look like a burst of work
+            moved = [self._apply_transition(conn, base, current.get(base), wanted.get(base), log_completion=False)
+                     for base in changed]
+            if any(moved):
+                self._bump_progress_version(conn)
+
+    # --- Upload log (append-only) ---
+    def record_upload(self, annotator_name, filename, kind, size=None, method=None):
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO upload_events (created_at, annotator, filename, kind, size, method) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (time.time(), annotator_name, filename, kind, size, method))
+
+    def upload_events(self, annotator_name=None, since=None, limit=100):
+        sql = "SELECT id, created_at, annotator, filename, kind, size, method FROM upload_events"
+        clauses, params = [], []
+        if annotator_name is not None:
+            clauses.append("annotator = ?")
+            params.append(annotator_name)
+        if since is not None:
+            clauses.append("created_at > ?")
+            params.append(since)
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        keys = ("id", "created_at", "annotator", "filename", "kind", "size", "method")
+        return [dict(zip(keys, row)) for row in self._query(sql, params)]
+
+    # --- Replication journal ---
+    def journal_replication(self, filename):
+        """Records that filename was saved and still has to be copied to the mirror."""
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO replication_journal (filename, created_at) VALUES (?, ?)",
+                         (filename, time.time()))
+
+    def claim_replication(self, limit, lease_seconds):
+        """Leases up to `limit` files with pending entries to the caller.
+
+        Returns {filename: [entry ids]}: all pending entries of a file are
+        claimed together so it is copied once. Entries whose lease ran out
+        (e.g. the process died mid-copy) become claimable again.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, filename FROM replication_journal WHERE state = 'pending' "
+                "AND (claimed_until IS NULL OR claimed_until < ?) ORDER BY id", (now,)).fetchall()
+            claimed = {}
+            for entry_id, filename in rows:
+                if filename not in claimed and len(claimed) >= limit:
+                    continue
+                claimed.setdefault(filename, []).append(entry_id)
+            conn.executemany("UPDATE replication_journal SET claimed_until = ?, attempts = attempts + 1 WHERE id = ?",
+                             ((now + lease_seconds, entry_id) for ids in claimed.values() for entry_id in ids))
+        return claimed
+
+    def finish_replication(self, entry_ids, sha256=None, error=None, retry_after=None, max_attempts=None):
+        """Marks entries done, or records the error and either retries them after
+        retry_after seconds or, past max_attempts, marks them failed."""
+        now = time.time()
+        with self.transaction() as conn:
+            for entry_id in entry_ids:
+                if error is None:
+                    conn.execute("UPDATE replication_journal SET state = 'done', sha256 = ?, error = NULL, "
+                                 "finished_at = ? WHERE id = ?", (sha256, now, entry_id))
+                else:
+                    conn.execute("UPDATE replication_journal SET error = ?, claimed_until = ?, "
+                                 "state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                                 "finished_at = CASE WHEN attempts >= ? THEN ? ELSE NULL END WHERE id = ?",
+                                 (error, now + (retry_after or 0), max_attempts or 1, max_attempts or 1, now, entry_id))
+
+    def replication_summary(self):
+        """{'pending': n, 'done': n, 'failed': n, 'oldest_pending': created_at | None, 'recent_failures': [...]}"""
+        summary = {'pending': 0, 'done': 0, 'failed': 0}
+        summary.update(dict(self._query("SELECT state, COUNT(*) FROM replication_journal GROUP BY state")))
+        summary['oldest_pending'] = self._query(
+            "SELECT MIN(created_at) FROM replication_journal WHERE state = 'pending'")[0][0]
+        summary['recent_failures'] = [
+            {"filename": filename, "error": error, "attempts": attempts}
+            for filename, error, attempts in self._query(
+                "SELECT filename, error, attempts FROM replication_journal WHERE state = 'failed' "
+                "ORDER BY id DESC LIMIT 20")]
+        return summary
+
+    # --- Mask QC ---
+    def save_mask_qc(self, base, mask_filename, qc):
+        """Stores the compute_mask_qc() result for an image's mask (replacing any older one)."""
+        row = (base, mask_filename, qc.get('mask_mtime'), qc.get('mask_size'), time.time(),
+               qc['width'], qc['height'], qc.get('original_width'), qc.get('original_height'),
+               int(qc['dimension_mismatch']), qc['coverage'], qc['components'], qc['largest_component_fraction'],
+               qc['colored_fraction'], qc['soft_fraction'], ','.join(qc['flags']), len(qc['flags']),
+               json.dumps(qc))
+        with self.transaction() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO mask_qc ({', '.join(QC_COLUMNS)}) "
+                         f"VALUES ({', '.join('?' * len(QC_COLUMNS))})", row)
+
+    def get_mask_qc(self, base):
+        rows = self._query("SELECT details FROM mask_qc WHERE base = ?", (base,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def masks_needing_qc(self):
+        """[(base, original filename, mask filename)] for masks with no QC, or QC of an older file."""
+        return self._query(
+            "SELECT s.base, i.filename, s.mask_filename FROM annotation_status s "
+            "JOIN images i ON i.base = s.base LEFT JOIN mask_qc q ON q.base = s.base "
+            "WHERE s.mask_filename IS NOT NULL AND (q.base IS NULL OR q.mask_mtime IS NOT s.mask_mtime "
+            "OR q.mask_size IS NOT s.mask_size OR q.mask_filename IS NOT s.mask_filename)")
+
+    def mask_qc_report(self, sort='flag_count', descending=True, flag=None, annotator_name=None,
+                       limit=None, offset=0):
+        """QC rows joined with the image's annotator and whether the mask changed since
+        (stale). Returns (rows as dicts, total matching)."""
+        if sort not in QC_SORT_COLUMNS:
+            raise ValueError(f"sort must be one of {', '.join(QC_SORT_COLUMNS)}")
+        where, params = [], []
+        if flag:
+            where.append("(',' || q.flags || ',') LIKE ?")
+            params.append(f"%,{flag},%")
+        if annotator_name:
+            where.append("a.annotator = ?")
+            params.append(annotator_name)
+        sql_from = ("FROM mask_qc q LEFT JOIN images i ON i.base = q.base "
+                    "LEFT JOIN assignments a ON a.filename = i.filename "
+                    "LEFT JOIN annotation_status s ON s.base = q.base")
+        if where:
+            sql_from += " WHERE " + " AND ".join(where)
+        total = self._query(f"SELECT COUNT(*) {sql_from}", params)[0][0]
+        order_column = 'a.annotator' if sort == 'annotator' else f'q.{sort}'
+        sql = (f"SELECT {', '.join('q.' + c for c in QC_COLUMNS)}, i.filename, a.annotator, "
+               f"(s.mask_mtime IS NOT q.mask_mtime OR s.mask_size IS NOT q.mask_size) {sql_from} "
+               f"ORDER BY {order_column} {'DESC' if descending else 'ASC'}, q.base LIMIT ? OFFSET ?")
+        rows = []
+        for row in self._query(sql, params + [-1 if limit is None else limit, offset]):
+            record = dict(zip(QC_COLUMNS, row))
+            record['details'] = json.loads(record['details'])
+            record['flags'] = [f for f in record['flags'].split(',') if f]
+            record['original'], record['annotator'], record['stale'] = row[-3], row[-2], bool(row[-1])
+            rows.append(record)
+        return rows, total
+
+    # --- Inter-annotator agreement ---
+    def agreement_versions(self):
+        """{(mask_a, mask_b): (mtime_a, size_a, mtime_b, size_b, max_dim, tolerance)} of stored comparisons."""
+        return {(row[0], row[1]): tuple(row[2:]) for row in self._query(
+            "SELECT mask_a, mask_b, mtime_a, size_a, mtime_b, size_b, max_dim, tolerance FROM mask_agreement")}
+
+    def save_agreement(self, results, max_dim, tolerance):
+        """Stores (mask_a, mask_b, (mtime_a, size_a), (mtime_b, size_b), metrics, error_msg) results."""
+        now = time.time()
+        rows = []
+        for mask_a, mask_b, version_a, version_b, metrics, error_msg in results:
+            metrics = metrics or {}
+            rows.append((mask_a, mask_b, mask_a[:mask_a.rindex('_mask.')], mask_b[:mask_b.rindex('_mask.')])
+                        + tuple(version_a) + tuple(version_b)
+                        + (max_dim, tolerance, metrics.get('iou'), metrics.get('dice'),
+                           metrics.get('boundary_precision'), metrics.get('boundary_recall'),
+                           metrics.get('boundary_f'), error_msg, now))
+        with self.transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO mask_agreement (mask_a, mask_b, base_a, base_b, mtime_a, size_a, "
+                             "mtime_b, size_b, max_dim, tolerance, iou, dice, boundary_precision, boundary_recall, "
+                             "boundary_f, error, computed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             rows)
+
+    def prune_agreement(self, pairs):
+        """Drops stored comparisons whose pair is not in pairs any more."""
+        keep = set(pairs)
+        stale = [pair for pair in self.agreement_versions() if pair not in keep]
+        if stale:
+            with self.transaction() as conn:
+                conn.executemany("DELETE FROM mask_agreement WHERE mask_a = ? AND mask_b = ?", stale)
+
+    def agreement_report(self):
+        """Stored comparisons with each mask's annotator, least agreement first."""
+        columns = ('mask_a', 'mask_b', 'base_a', 'base_b', 'iou', 'dice', 'boundary_precision', 'boundary_recall',
+                   'boundary_f', 'error', 'computed_at', 'original_a', 'original_b', 'annotator_a', 'annotator_b')
+        rows = self._query(
+            "SELECT g.mask_a, g.mask_b, g.base_a, g.base_b, g.iou, g.dice, g.boundary_precision, "
+            "g.boundary_recall, g.boundary_f, g.error, g.computed_at, ia.filename, ib.filename, "
+            "aa.annotator, ab.annotator FROM mask_agreement g "
+            "LEFT JOIN images ia ON ia.base = g.base_a LEFT JOIN assignments aa ON aa.filename = ia.filename "
+            "LEFT JOIN images ib ON ib.base = g.base_b LEFT JOIN assignments ab ON ab.filename = ib.filename "
+            "ORDER BY g.error IS NULL, g.iou, g.mask_a, g.mask_b")
+        return [dict(zip(columns, row)) for row in rows]
+
+    # --- Revision history (see blob_store.py) ---
+    def add_revision(self, filename, kind, sha256, size, annotator=None, method=None, source_sha256=None,
+                     created_at=None):
+        """Records that filename now points at blob sha256. Returns the new revision dict."""
+        created_at = time.time() if created_at is None else created_at
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO revisions (filename, kind, sha256, size, created_at, annotator, method, source_sha256) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (filename, kind, sha256, size, created_at, annotator, method, source_sha256))
+            revision_id = cursor.lastrowid
+        return dict(zip(REVISION_COLUMNS, (revision_id, filename, kind, sha256, size, created_at, annotator,
+                                                method, source_sha256)))
+
+    def revisions(self, filename):
+        """All revisions of filename, newest (the current one) first."""
+        rows = self._query(f"SELECT {', '.join(REVISION_COLUMNS)} FROM revisions "
+                           "WHERE filename = ? ORDER BY id DESC", (filename,))
+        return [dict(zip(REVISION_COLUMNS, row)) for row in rows]
+
+    def latest_revision(self, filename):
+        rows = self._query(f"SELECT {', '.join(REVISION_COLUMNS)} FROM revisions "
+                           "WHERE filename = ? ORDER BY id DESC LIMIT 1", (filename,))
+        return dict(zip(REVISION_COLUMNS, rows[0])) if rows else None
+
+    def get_revision(self, revision_id):
+        rows = self._query(f"SELECT {', '.join(REVISION_COLUMNS)} FROM revisions WHERE id = ?",
+                           (revision_id,))
+        return dict(zip(REVISION_COLUMNS, rows[0])) if rows else None
@@ -0,0 +1,114 @@
+import os
+import threading
+
+from storage_layout import as_layout
+
+
+class AnnotationStatusIndex:
+    """In-process index of the .xcf and mask files present in the annotation root.
+
+    Built with a single os.scandir pass, updated by the upload handlers and
+    reconciled against the directory in the background, so pages can report
+    annotation status without touching the filesystem.
+
+    With a StateStore, every change is written through to its
+    annotation_status table and reads go to the store, so all worker
+    processes see the same status.
+    """
+
+    def __init__(self, layout, mask_extensions, store=None):
+        self.layout = as_layout(layout)
+        self.store = store
+        self.mask_suffixes = {f"_mask.{ext}": ext for ext in mask_extensions}
+        # base filename -> {'xcf': (mtime, size) | None, 'mask': (filename, mtime, size) | None}
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._reconciler = None
+        self._stop = threading.Event()
+
+    def _classify(self, filename):
+        """Returns (base, 'xcf' | 'mask') for annotation files, or (None, None)."""
+        if filename.startswith('.'):
+            return None, None
+        if filename.endswith('.xcf'):
+            return filename[:-len('.xcf')], 'xcf'
+        for suffix in self.mask_suffixes:
+            if filename.endswith(suffix):
+                return filename[:-len(suffix)], 'mask'
+        return None, None
+
+    @staticmethod
+    def _record(kind, filename, st):
+        if kind == 'xcf':
+            return (st.st_mtime, st.st_size)
+        return (filename, st.st_mtime, st.st_size)
+
+    def rebuild(self):
+        """Rescans the annotation root in one pass and swaps in the fresh index."""
+        entries = {}
+        try:
+            for entry in self.layout.iter_annotations():
+                base, kind = self._classify(entry.name)
+                if kind is None:
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.setdefault(base, {'xcf': None, 'mask': None})[kind] = self._record(kind, entry.name, st)
+        except FileNotFoundError:
+            print(f"Error: Annotation directory '{self.layout.annotation_root}' not found while indexing annotations.")
+        with self._lock:
+            self._entries = entries
+        if self.store is not None:
+            self.store.sync_statuses(entries)
+
+    def refresh(self, filename):
+        """Re-stats a single annotation file, e.g. right after it was saved."""
+        base, kind = self._classify(filename)
+        if kind is None:
+            return
+        try:
+            st = os.stat(self.layout.annotation_path(filename))
+            record = self._record(kind, filename, st)
+        except OSError:
+            record = None
+        with self._lock:
+            entry = self._entries.setdefault(base, {'xcf': None, 'mask': None})
+            entry[kind] = record
+        if self.store is not None:
+            self.store.set_status(base, kind, record)
+
+    def get(self, base):
+        if self.store is not None:
+            return self.store.get_status(base)
+        with self._lock:
+            entry = self._entries.get(base)
+            return dict(entry) if entry else {'xcf': None, 'mask': None}
+
+    def status(self, base):
+        """Returns (xcf_exists, mask_exists) for an original's base filename."""
+        if self.store is not None:
+            entry = self.store.get_status(base)
+        else:
+            with self._lock:
+                entry = self._entries.get(base)
+        if not entry:
+            return False, False
+        return entry['xcf'] is not None, entry['mask'] is not None
+
+    def start_reconciler(self, interval_seconds):
+        """Rebuilds the index every interval_seconds in a daemon thread, picking up
+        files that changed outside the app (rsync, manual copies)."""
+        if self._reconciler is not None:
+            return
+
+        def loop():
+            while not self._stop.wait(interval_seconds):
+                self.rebuild()
+
+        self._reconciler = threading.Thread(target=loop, name='status-index-reconciler', daemon=True)
+        self._reconciler.start()
+
+    def stop_reconciler(self):
+        self._stop.set()
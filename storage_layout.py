@@ -0,0 +1,221 @@
+"""Where originals and annotation files (<base>.xcf, <base>_mask.png) live on disk.
+
+The original layout is one flat directory holding everything side by side.
+With shard_levels > 0 each file is stored as <root>/<ab>[/<cd>]/<file>,
+where ab, cd are the leading hex digits of the SHA-1 of the image's base
+name: an image's original, XCF and mask land in the same small
+subdirectory, and every path is computed rather than searched for.
+Originals are read from one or more roots (the first that has the file
+wins; all but the first are typically read-only source trees), and
+annotations are written under their own root.
+
+Run directly to move a flat directory into a sharded layout (re-runnable;
+files already in place are skipped):
+
+    python storage_layout.py ./images_train/ --originals-dir /data/originals \\
+        --annotations-dir /data/annotations --shard-levels 1 --dry-run
+"""
+import os
+import shutil
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+VALID_IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff'}
+
+
+def is_annotation(filename):
+    """XCF files and masks; everything else with an image extension is an original."""
+    return filename.endswith('.xcf') or '_mask' in filename
+
+
+def base_name(filename):
+    """The image base name a file belongs to: foo.jpg, foo.xcf and foo_mask.png -> foo."""
+    if filename.endswith('.xcf'):
+        return filename[:-len('.xcf')]
+    index = filename.rfind('_mask.')
+    if index != -1:
+        return filename[:index]
+    return os.path.splitext(filename)[0]
+
+
+class StorageLayout:
+    def __init__(self, original_roots, annotation_root=None, shard_levels=0):
+        if isinstance(original_roots, str):
+            original_roots = [original_roots]
+        self.original_roots = list(original_roots)
+        self.annotation_root = annotation_root or self.original_roots[0]
+        self.shard_levels = shard_levels
+        # original filename -> root it was found in; only consulted with several roots
+        self._original_root = {}
+
+    @property
+    def roots(self):
+        """Every root, writable annotation root first, without duplicates."""
+        return list(dict.fromkeys([self.annotation_root] + self.original_roots))
+
+    def shard(self, filename):
+        if not self.shard_levels:
+            return ''
+        digest = hashlib.sha1(base_name(filename).encode('utf-8')).hexdigest()
+        return os.path.join(*(digest[2 * i:2 * i + 2] for i in range(self.shard_levels)))
+
+    def relative_path(self, filename):
+        """Path of filename below its root (the filename itself in the flat layout)."""
+        return os.path.join(self.shard(filename), filename)
+
+    def original_path(self, filename):
+        relative = self.relative_path(filename)
+        if len(self.original_roots) == 1:
+            return os.path.join(self.original_roots[0], relative)
+        root = self._original_root.get(filename)
+        if root is None:
+            root = next((r for r in self.original_roots if os.path.exists(os.path.join(r, relative))), None)
+            if root is None:
+                return os.path.join(self.original_roots[0], relative)
+            self._original_root[filename] = root
+        return os.path.join(root, relative)
+
+    def annotation_path(self, filename):
+        return os.path.join(self.annotation_root, self.relative_path(filename))
+
+    def path(self, filename):
+        return self.annotation_path(filename) if is_annotation(filename) else self.original_path(filename)
+
+    def _shard_dirs(self, root):
+        dirs = [root]
+        for _ in range(self.shard_levels):
+            subdirs = []
+            for directory in dirs:
+                with os.scandir(directory) as it:
+                    subdirs.extend(entry.path for entry in it
+                                   if len(entry.name) == 2 and not entry.name.startswith('.') and entry.is_dir())
+            dirs = subdirs
+        return dirs
+
+    def scan(self, root):
+        """Yields the DirEntry of every visible regular file stored under root. Raises
+        FileNotFoundError if root does not exist."""
+        for directory in self._shard_dirs(root):
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    try:
+                        if entry.is_file():
+                            yield entry
+                    except OSError:
+                        continue
+
+    def iter_originals(self):
+        """DirEntries of the originals in all roots; a name found in several roots is
+        listed once, from the first of them."""
+        seen = set()
+        for root in self.original_roots:
+            for entry in self.scan(root):
+                name = entry.name
+                if is_annotation(name) or os.path.splitext(name)[1].lower() not in VALID_IMAGE_EXTENSIONS \
+                   or name in seen:
+                    continue
+                seen.add(name)
+                if len(self.original_roots) > 1:
+                    self._original_root[name] = root
+                yield entry
+
+    def iter_annotations(self):
+        for entry in self.scan(self.annotation_root):
+            if is_annotation(entry.name):
+                yield entry
+
+
+def as_layout(layout_or_dir):
+    """Lets the components that used to take an image directory take a layout instead."""
+    if isinstance(layout_or_dir, StorageLayout):
+        return layout_or_dir
+    return StorageLayout(layout_or_dir)
+
+
+def add_layout_arguments(parser, positional=False):
+    """The options describing a layout, for the command-line tools."""
+    if positional:
+        parser.add_argument('image_dir', nargs='?', default='./images_train/')
+    else:
+        parser.add_argument('--images-dir', dest='image_dir', default='./images_train/')
+    parser.add_argument('--source-dir', action='append', default=[],
+                        help='Further (read-only) root with originals; may be repeated')
+    parser.add_argument('--annotations-dir', default=None, help='Root of the XCF / mask files (default: image_dir)')
+    parser.add_argument('--shard-levels', type=int, default=0)
+
+
+def layout_from_args(args):
+    return StorageLayout([args.image_dir] + args.source_dir, args.annotations_dir, args.shard_levels)
+
+
+def _move(src, dest):
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        os.rename(src, dest)
+    except OSError:
+        shutil.move(src, dest) # Another filesystem: copy, then remove
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source_dir', help='The flat directory to convert')
+    parser.add_argument('--originals-dir', default=None, help='Root for originals (default: source_dir)')
+    parser.add_argument('--annotations-dir', default=None, help='Root for XCF / mask files (default: originals dir)')
+    parser.add_argument('--shard-levels', type=int, default=1, help='1: 256 subdirectories per root, 2: 65536')
+    parser.add_argument('--workers', type=int, default=8, help='Parallel moves (matters across filesystems)')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    layout = StorageLayout(args.originals_dir or args.source_dir, args.annotations_dir, args.shard_levels)
+    moves, conflicts, hidden = [], [], 0
+    with os.scandir(args.source_dir) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                hidden += 1
+                continue
+            if not entry.is_file():
+                continue
+            name = entry.name
+            is_image = os.path.splitext(name)[1].lower() in VALID_IMAGE_EXTENSIONS
+            if not (is_annotation(name) or is_image):
+                continue
+            dest = layout.path(name)
+            if os.path.abspath(dest) == os.path.abspath(entry.path):
+                continue
+            if os.path.exists(dest):
+                conflicts.append(name)
+                continue
+            moves.append((entry.path, dest))
+
+    print(f"{len(moves)} files to move, {len(conflicts)} already present at their destination (left alone).")
+    if hidden:
+        print(f"Skipping {hidden} hidden files (e.g. unfinished chunked uploads); finish or abort those first.")
+    for name in conflicts[:20]:
+        print(f"  conflict: {name}")
+    if args.dry_run:
+        for src, dest in moves[:20]:
+            print(f"  {src} -> {dest}")
+        return
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = [(src, pool.submit(_move, src, dest)) for src, dest in moves]
+        for src, future in futures:
+            try:
+                future.result()
+            except OSError as e:
+                failed += 1
+                print(f"  {src}: {e}")
+    print(f"Done: {len(moves) - failed} moved, {failed} failed.")
+    print("Point app_v1.py at the new layout:")
+    print(f"    IMAGES_BASE_DIR = {layout.original_roots[0]!r}")
+    print(f"    ANNOTATIONS_DIR = {layout.annotation_root!r}")
+    print(f"    STORAGE_SHARD_LEVELS = {layout.shard_levels}")
+    print("Pending replication entries name files by their old paths; let the replicator drain before migrating.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,9 @@
 #!/bin/bash
 
+# app_v1.py copies every upload to the mirror itself when REPLICATION_MIRROR_DIR is set
+# (see replication.py). This full-tree rsync is then only needed for the initial copy and
+# for files added to images_train/ outside the app.
+
 # Define source and destination directories
 SRC="/ssd_scratch/pratyush.jena/Aug_LineTR/annotation_tool/images_train/"
 DEST="/nas/pratyush.jena/Aug_LineTR/annotation_tool/images_train/"
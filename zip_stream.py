@@ -0,0 +1,67 @@
+import io
+import os
+import time
+import zipfile
+
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class _ZipSink(io.RawIOBase):
+    """Write-only, non-seekable file object that collects what ZipFile writes
+    until the generator drains it. Because seek() is unsupported, ZipFile
+    writes data descriptors after each member instead of seeking back."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+
+def _zip_date_time(timestamp):
+    # ZIP timestamps cannot predate 1980
+    return max(time.localtime(timestamp)[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def stream_zip(entries, block_size=COPY_BLOCK_SIZE):
+    """Yields a ZIP archive of entries (iterable of (arcname, path)) as byte chunks.
+
+    Members are stored uncompressed (the PNGs and XCFs are already compressed)
+    and read block by block, so memory stays constant regardless of archive
+    size and nothing is written to a temp file. Paths that disappear before
+    they are read are skipped.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for arcname, path in entries:
+            try:
+                src = open(path, 'rb')
+            except OSError as e:
+                print(f"Skipping '{path}' in ZIP stream: {e}")
+                continue
+            with src:
+                st = os.fstat(src.fileno())
+                zinfo = zipfile.ZipInfo(arcname, date_time=_zip_date_time(st.st_mtime))
+                zinfo.compress_type = zipfile.ZIP_STORED
+                # Declaring the size up front lets ZipFile decide on ZIP64 for >4 GB members
+                zinfo.file_size = st.st_size
+                with zf.open(zinfo, 'w') as dst:
+                    for block in iter(lambda: src.read(block_size), b''):
+                        dst.write(block)
+                        yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()